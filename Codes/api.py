@@ -0,0 +1,207 @@
+import argparse
+import json
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from config import API_CONFIG
+import auth
+from data import (get_medicines, find_medicines, find_by_code, sell_medicine,
+                  checkout_medicines, start_change_listener, start_journal)
+import sales
+import search_index
+
+# 供扫码枪、收银终端使用的轻量 HTTP 接口，与页面共用 data.py 中的数据函数与进程内缓存。
+# 登录后返回 auth.py 签发的会话令牌，之后的请求带 Authorization: Bearer <令牌>；
+# 本进程验证过的令牌只查内存中的会话表，不再计算口令哈希，也不访问数据库。
+#
+#   POST /api/login              {"username", "password"} -> {"token", "expires_at", "user"}
+#   GET  /api/medicines?code=..  按编码查找本药店药品
+#   GET  /api/medicines?q=..     按名称/生产商/编码/拼音首字母搜索；不带参数返回本药店全部药品
+#   POST /api/sell               {"code" 或 "medicine_id", "quantity"}
+#   POST /api/sell/batch         {"lines": [{"code" 或 "medicine_id", "quantity"}, ...]}，整单成功或整单失败
+#   GET  /api/health
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def _medicine_json(row):
+    return {
+        "medicine_id": row['medicine_id'],
+        "name": row['name'],
+        "manufacturer": row['manufacturer'],
+        "code": row['code'],
+        "price": row['price'],
+        "stock": row['stock'],
+    }
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat(sep=" ")
+    raise TypeError(f"无法序列化 {type(value).__name__}")
+
+# 把请求中的一行（按编码或药品ID）解析为本药店的药品行，不属于本药店的药品视为不存在
+def resolve_medicine(user, line):
+    pharmacy_id = user['pharmacy_id']
+    if line.get("code"):
+        row = find_by_code(pharmacy_id, str(line["code"]))
+    elif line.get("medicine_id") is not None:
+        row = search_index.ensure_index(pharmacy_id, get_medicines(pharmacy_id)).rows.get(line["medicine_id"])
+    else:
+        raise ApiError(400, "缺少 code 或 medicine_id")
+    if row is None:
+        raise ApiError(404, f"本药店没有该药品：{line.get('code') or line.get('medicine_id')}")
+    return row
+
+def _quantity(line):
+    quantity = line.get("quantity", 1)
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+        raise ApiError(400, "quantity 必须是正整数")
+    return quantity
+
+def handle_login(user, query, body):
+    if not body.get("username") or not body.get("password"):
+        raise ApiError(400, "缺少 username 或 password")
+    result = auth.login(body["username"], body["password"])
+    if result is None:
+        raise ApiError(401, "用户名或密码错误")
+    token, user = result
+    return {"token": token, "expires_at": auth.token_expires_at(token), "user": user}
+
+def handle_medicines(user, query, body):
+    pharmacy_id = user['pharmacy_id']
+    if "code" in query:
+        row = find_by_code(pharmacy_id, query["code"][0])
+        if row is None:
+            raise ApiError(404, "本药店没有该编码的药品")
+        return {"medicine": _medicine_json(row)}
+    if "q" in query:
+        search_index.ensure_index(pharmacy_id, get_medicines(pharmacy_id))
+        return {"medicines": [_medicine_json(m) for m in find_medicines(pharmacy_id, query["q"][0])]}
+    return {"medicines": [_medicine_json(m) for m in get_medicines(pharmacy_id)]}
+
+def handle_sell(user, query, body):
+    row = resolve_medicine(user, body)
+    quantity = _quantity(body)
+    result = sell_medicine(row['medicine_id'], quantity, user['user_id'], user['pharmacy_id'])
+    if not result:
+        raise ApiError(409, f"库存不足：{row['name']}")
+    # 记入本地日志的销售 pending 为 true、sale_id 为 null，写库在后台完成
+    return {"sale_id": result['sale_id'], "sale_time": result['sale_time'], "medicine_id": row['medicine_id'],
+            "quantity": quantity, "stock": result['stock'], "pending": result.get('pending', False)}
+
+def handle_sell_batch(user, query, body):
+    lines = body.get("lines")
+    if not isinstance(lines, list) or not lines:
+        raise ApiError(400, "lines 必须是非空数组")
+    if len(lines) > API_CONFIG["max_batch_lines"]:
+        raise ApiError(400, f"单次最多 {API_CONFIG['max_batch_lines']} 行")
+    resolved = [(resolve_medicine(user, line)['medicine_id'], _quantity(line)) for line in lines]
+    try:
+        result = checkout_medicines(resolved, user['user_id'], user['pharmacy_id'])
+    except sales.InsufficientStock as e:
+        raise ApiError(409, f"库存不足，整单未销售：{sorted(e.medicine_ids)}")
+    return {"lines": [{"medicine_id": mid, "stock": row['stock']} for mid, row in result.items()],
+            "pending": any(row.get('pending') for row in result.values())}
+
+def handle_health(user, query, body):
+    return {"status": "ok"}
+
+# (方法, 路径) -> (处理函数, 是否需要登录)
+ROUTES = {
+    ("POST", "/api/login"): (handle_login, False),
+    ("GET", "/api/medicines"): (handle_medicines, True),
+    ("POST", "/api/sell"): (handle_sell, True),
+    ("POST", "/api/sell/batch"): (handle_sell_batch, True),
+    ("GET", "/api/health"): (handle_health, False),
+}
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    # 保持连接，终端可以复用同一 TCP 连接连续发请求
+    protocol_version = "HTTP/1.1"
+    server_version = "PharmacyAPI/1.0"
+    # 响应头与响应体分两次写出，关闭 Nagle 算法避免与客户端的延迟确认叠加出约 40ms 的等待
+    disable_nagle_algorithm = True
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False, default=_json_default).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        route = ROUTES.get((method, url.path))
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            if route is None:
+                raise ApiError(404, "接口不存在")
+            handler, needs_auth = route
+            user = None
+            if needs_auth:
+                header = self.headers.get("Authorization", "")
+                user = auth.verify_session(header[7:]) if header.startswith("Bearer ") else None
+                if user is None:
+                    raise ApiError(401, "未登录或令牌已过期")
+                if user['role'] not in (1, 2) or user['pharmacy_id'] is None:
+                    raise ApiError(403, "只有药店账号可以使用收银接口")
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                raise ApiError(400, "请求体不是合法的 JSON")
+            if not isinstance(body, dict):
+                raise ApiError(400, "请求体必须是 JSON 对象")
+            self._send(200, handler(user, parse_qs(url.query), body))
+        except ApiError as e:
+            self._send(e.status, {"error": e.message})
+        except Exception as e:
+            self.log_error("internal error: %r", e)
+            self._send(500, {"error": "服务器内部错误"})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    # 高并发下逐条打印访问日志本身就是瓶颈，只打印错误
+    def log_message(self, format, *args):
+        pass
+
+    def log_error(self, format, *args):
+        BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(host=None, port=None):
+    server = ThreadingHTTPServer((host or API_CONFIG["host"], API_CONFIG["port"] if port is None else port), ApiHandler)
+    server.daemon_threads = True
+    # 接口进程同样接收其他实例的变更事件，保持库存缓存一致
+    start_change_listener()
+    start_journal()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="收银终端 HTTP 接口")
+    parser.add_argument("--host", default=API_CONFIG["host"])
+    parser.add_argument("--port", type=int, default=API_CONFIG["port"])
+    args = parser.parse_args()
+    server = make_server(args.host, args.port)
+    print(f"API Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
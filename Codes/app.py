@@ -1,109 +1,45 @@
+import json
+import os
 import streamlit as st
-import psycopg2
+from streamlit.errors import StreamlitAPIException
 import pandas as pd
-from config import DB_CONFIG
-from psycopg2.extras import RealDictCursor
-
-# 缓存数据库连接（生命周期为 session）
-@st.cache_resource
-def get_conn():
-    return psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
-
-@st.cache_data(ttl=300)
-def authenticate(username, password):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT user_id, role, pharmacy_id 
-                FROM users 
-                WHERE username = %s AND password = %s
-            """, (username, password))
-            return cur.fetchone()
-
-@st.cache_data(ttl=60)
-def get_medicines(pharmacy_id):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT medicine_id, name, manufacturer, code, price, stock 
-                FROM medicines 
-                WHERE pharmacy_id = %s
-            """, (pharmacy_id,))
-            return cur.fetchall()
-
-@st.cache_data(ttl=60)
-def search_medicines(pharmacy_id, keyword):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT * FROM medicines 
-                WHERE pharmacy_id = %s 
-                AND (name ILIKE %s OR manufacturer ILIKE %s OR code ILIKE %s)
-            """, (pharmacy_id, f'%{keyword}%', f'%{keyword}%', f'%{keyword}%'))
-            return cur.fetchall()
-
-def sell_medicine(medicine_id, quantity, user_id):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT stock FROM medicines WHERE medicine_id = %s", (medicine_id,))
-            row = cur.fetchone()
-            if row and row['stock'] >= quantity:
-                cur.execute("UPDATE medicines SET stock = stock - %s WHERE medicine_id = %s", (quantity, medicine_id))
-                cur.execute("INSERT INTO sales (medicine_id, quantity, user_id) VALUES (%s, %s, %s)", (medicine_id, quantity, user_id))
-                conn.commit()
-                st.cache_data.clear()
-                return True
-            return False
-
-def manage_users(action, **kwargs):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            try:
-                if action == "add":
-                    cur.execute("INSERT INTO users (username, password, role, pharmacy_id) VALUES (%s, %s, %s, %s)",
-                                (kwargs['username'], kwargs['password'], kwargs['role'], kwargs['pharmacy_id']))
-                elif action == "delete":
-                    cur.execute("DELETE FROM users WHERE user_id = %s", (kwargs['user_id'],))
-                elif action == "update":
-                    cur.execute("UPDATE users SET username = %s, password = %s, role = %s, pharmacy_id = %s WHERE user_id = %s",
-                                (kwargs['username'], kwargs['password'], kwargs['role'], kwargs['pharmacy_id'], kwargs['user_id']))
-                conn.commit()
-                st.cache_data.clear()
-            except psycopg2.IntegrityError:
-                st.error("操作失败：用户名已存在或其他约束冲突")
-
-def manage_pharmacies(action, **kwargs):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            if action == "add":
-                cur.execute("INSERT INTO pharmacies (name, address) VALUES (%s, %s)", (kwargs['name'], kwargs['address']))
-            elif action == "delete":
-                cur.execute("DELETE FROM pharmacies WHERE pharmacy_id = %s", (kwargs['pharmacy_id'],))
-            elif action == "update":
-                cur.execute("UPDATE pharmacies SET name = %s, address = %s WHERE pharmacy_id = %s",
-                            (kwargs['name'], kwargs['address'], kwargs['pharmacy_id']))
-            conn.commit()
-            st.cache_data.clear()
-
-def manage_medicines(action, **kwargs):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            if action == "add":
-                cur.execute("""
-                    INSERT INTO medicines (name, manufacturer, code, price, stock, pharmacy_id)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (kwargs['name'], kwargs['manufacturer'], kwargs['code'], kwargs['price'], kwargs['stock'], kwargs['pharmacy_id']))
-            elif action == "delete":
-                cur.execute("DELETE FROM medicines WHERE medicine_id = %s", (kwargs['medicine_id'],))
-            elif action == "update":
-                cur.execute("""
-                    UPDATE medicines 
-                    SET name = %s, manufacturer = %s, code = %s, price = %s, stock = %s
-                    WHERE medicine_id = %s
-                """, (kwargs['name'], kwargs['manufacturer'], kwargs['code'], kwargs['price'], kwargs['stock'], kwargs['medicine_id']))
-            conn.commit()
-            st.cache_data.clear()
-
+from datetime import date, datetime, timedelta
+from config import EXPORT_CONFIG
+from db import get_read_conn, pool_stats, replica_stats
+from cache import cache_stats
+from notify import listener_stats
+import auth
+from data import (get_medicines, find_medicines, sell_medicine, checkout_medicines,
+                  export_sales_file, sales_report, import_medicines_file, manage_users, manage_pharmacies,
+                  manage_medicines, recent_sales_of, soft_delete, restore, start_deletion, deletion_jobs,
+                  list_soft_deleted, start_change_listener, start_deletion_worker, start_journal,
+                  journal_conflicts, resolve_journal_conflicts, replenishment_last_run, replenishment_stats,
+                  transfer_suggestions, replenishment_summary, run_replenishment)
+from profiler import timed_section
+import profiler
+import search_index
+import sales
+import export
+import grids
+import importer
+import journal
+import replenish
+import statements
+
+ROLE_MAP = {0: "系统管理员", 1: "药店管理员", 2: "销售员"}
+
+# 调拨建议表格的列名
+TRANSFER_COLUMNS = {
+    "from_pharmacy": "调出药店",
+    "to_pharmacy": "调入药店",
+    "name": "药品名称",
+    "manufacturer": "药品产商",
+    "quantity": "建议数量",
+    "from_medicine_id": "调出药品ID",
+    "to_medicine_id": "调入药品ID"
+}
+
+@timed_section("登录")
 def login_section():
     st.title("💊 连锁药店管理系统")
     st.markdown("欢迎使用，请输入账号密码进行登录")
@@ -111,82 +47,163 @@ def login_section():
         user = st.text_input("用户名")
         pwd = st.text_input("密码", type="password")
         if st.form_submit_button("登录"):
-            auth = authenticate(user, pwd)
-            if auth:
-                st.session_state.user = auth
+            result = auth.login(user, pwd)
+            if result:
+                st.session_state.session_token, st.session_state.user = result
                 st.rerun()
             else:
                 st.error("用户名或密码错误")
 
+# 在 fragment 中请求只重跑当前 fragment；若此时处于整页运行中（如整页重跑与控件事件合并处理），退回整页重跑
+def rerun_fragment():
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+# 各管理模块都是独立重跑的 fragment：模块内的操作只重跑本模块，不重建侧边栏与其他模块；
+# 表格、删除、更新面板又各自是嵌套的 fragment，翻页、过滤只重跑表格，切换选中项只重跑该面板。
+# 表格只取当前页，选择器只取匹配的前几行，表单只取所选的一行（见 grids.py）。
+# 面板内修改了数据时整页重跑，以刷新模块上方的表格
+@st.fragment
+@timed_section("用户管理")
 def admin_user_section():
     st.subheader("👤 用户管理")
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, username, password, role, pharmacy_id FROM users")
-        rows = cur.fetchall()
-        users_df = pd.DataFrame(rows, columns=[desc[0] for desc in cur.description])
-        role_map = {0: "系统管理员", 1: "药店管理员", 2: "销售员"}
-        users_df["角色"] = users_df["role"].map(role_map)
-        users_df.rename(columns={
-            "user_id": "用户ID",
-            "username": "用户名",
-            "password": "密码",
-            "pharmacy_id": "药店ID"
-        }, inplace=True)
-        st.dataframe(users_df[["用户ID", "用户名", "密码", "角色", "药店ID"]], use_container_width=True)
+    user_grid_panel()
 
     # 添加用户部分
     st.markdown("### 添加用户")
     with st.form("添加用户表单"):
         new_username = st.text_input("用户名", key="add_username")
         new_password = st.text_input("密码", type="password", key="add_password")
-        new_role = st.selectbox("角色", options=[0, 1, 2], format_func=lambda x: role_map[x], key="add_role")
+        new_role = st.selectbox("角色", options=[0, 1, 2], format_func=lambda x: ROLE_MAP[x], key="add_role")
         new_pharmacy_id = st.number_input("药店ID", min_value=1, step=1, key="add_pharmacy_id")
         if st.form_submit_button("添加用户"):
-            manage_users("add", username=new_username, password=new_password, role=new_role, pharmacy_id=new_pharmacy_id)
-            st.success("用户添加成功")
-            st.rerun()
+            if manage_users("add", username=new_username, password=new_password, role=new_role, pharmacy_id=new_pharmacy_id):
+                st.success("用户添加成功")
+                rerun_fragment()
+            else:
+                st.error("操作失败：用户名已存在或其他约束冲突")
 
+    user_delete_panel()
+    user_update_panel()
+
+# 表格的分页游标：{prefix}_cursors[i] 为第 i 页的起点（上一页最后一行的排序键），
+# session 中只保存游标，不保存记录本身；过滤条件或排序方式变化后从第一页开始
+def grid_cursors(prefix, filters):
+    if st.session_state.get(f"{prefix}_filters") != filters:
+        st.session_state[f"{prefix}_filters"] = filters
+        st.session_state[f"{prefix}_cursors"] = [None]
+    return st.session_state[f"{prefix}_cursors"]
+
+# 页码与翻页按钮，翻页只重跑表格所在的 fragment
+def grid_pager(prefix, cursors, rows, has_more, total, sort):
+    shown = f"{grids.COUNT_LIMIT}+" if total > grids.COUNT_LIMIT else total
+    st.caption(f"第 {len(cursors)} 页，共 {shown} 条记录")
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("上一页", disabled=len(cursors) == 1, key=f"{prefix}_prev"):
+            cursors.pop()
+            rerun_fragment()
+    with col2:
+        if st.button("下一页", disabled=not has_more, key=f"{prefix}_next"):
+            cursors.append(grids.page_cursor(rows, sort))
+            rerun_fragment()
+
+# 即输即查的ID选择器：按输入的ID或名称前缀从数据库取前 PICKER_LIMIT 条匹配项，下拉框只列出这些项。
+# 返回选中的ID，没有匹配项时返回 None
+def id_picker(label, key, search_label, read_key, pick, id_column, name_column):
+    keyword = st.text_input(search_label, key=f"{key}_keyword").strip()
+    with get_read_conn(read_key) as conn:
+        matches = pick(conn, keyword)
+    if not matches:
+        st.info("没有匹配的记录")
+        return None
+    names = {row[id_column]: row[name_column] for row in matches}
+    return st.selectbox(label, list(names), format_func=lambda x: f"{x} | {names[x]}", key=key)
+
+def pick_user(label, key):
+    return id_picker(label, key, "查找用户（用户ID或用户名前缀）", ("users",), grids.pick_users, "user_id", "username")
+
+def pick_pharmacy(label, key):
+    return id_picker(label, key, "查找药店（药店ID或名称前缀）", ("pharmacies",), grids.pick_pharmacies, "pharmacy_id", "name")
+
+@st.fragment
+def user_grid_panel():
+    col1, col2, col3, col4 = st.columns(4)
+    keyword = col1.text_input("用户ID或用户名前缀", key="user_grid_keyword").strip()
+    role = col2.selectbox("角色", [None, 0, 1, 2], format_func=lambda x: "全部" if x is None else ROLE_MAP[x],
+                          key="user_grid_role")
+    pharmacy_id = col3.number_input("药店ID（0 表示全部药店）", min_value=0, step=1, value=0, key="user_grid_pharmacy") or None
+    sort_name = col4.selectbox("排序", list(grids.USER_SORTS), key="user_grid_sort")
+    sort = grids.USER_SORTS[sort_name]
+    cursors = grid_cursors("user_grid", (keyword, role, pharmacy_id, sort_name))
+
+    with get_read_conn(("users",)) as conn:
+        total = grids.user_count(conn, keyword, role, pharmacy_id)
+        rows, has_more = grids.user_page(conn, keyword, role, pharmacy_id, sort, after=cursors[-1])
+        if not rows and len(cursors) > 1:
+            # 当前页的用户已不存在（例如被删除），回到第一页
+            cursors[:] = [None]
+            rows, has_more = grids.user_page(conn, keyword, role, pharmacy_id, sort)
+    if not rows:
+        st.info("没有符合条件的用户")
+        return
+
+    users_df = pd.DataFrame(rows)
+    users_df["角色"] = users_df["role"].map(ROLE_MAP)
+    users_df.rename(columns={
+        "user_id": "用户ID",
+        "username": "用户名",
+        "pharmacy_id": "药店ID"
+    }, inplace=True)
+    st.dataframe(users_df[["用户ID", "用户名", "角色", "药店ID"]], use_container_width=True, hide_index=True)
+    grid_pager("user_grid", cursors, rows, has_more, total, sort)
+
+@st.fragment
+def user_delete_panel():
     # 删除用户部分
     st.markdown("### 删除用户")
-    user_ids = users_df["用户ID"].tolist()
-    user_to_delete = st.selectbox("选择要删除的用户ID", user_ids)
-    if st.button("删除用户"):
-        manage_users("delete", user_id=user_to_delete)
-        st.success(f"用户ID {user_to_delete} 已删除")
-        st.rerun()
+    user_to_delete = pick_user("选择要删除的用户ID", "delete_user_select")
+    if user_to_delete is not None and st.button("删除用户"):
+        if manage_users("delete", user_id=user_to_delete):
+            st.success(f"用户ID {user_to_delete} 已删除")
+            st.rerun()
+        else:
+            st.error("操作失败：用户名已存在或其他约束冲突")
 
+@st.fragment
+def user_update_panel():
     # 更新用户部分
     st.markdown("### 更新用户")
-    user_to_update = st.selectbox("选择要更新的用户ID", user_ids, key="update_user_select")
-    if user_to_update:
-        user_info = users_df[users_df["用户ID"] == user_to_update].iloc[0]
-        with st.form("更新用户表单"):
-            username = st.text_input("用户名", value=user_info["用户名"])
-            role_option = st.selectbox("角色", options=[0, 1, 2],
-                                       format_func=lambda x: role_map[x],
-                                       index={0: 0, 1: 1, 2: 2}[user_info["角色"] == "系统管理员" and 0 or user_info["角色"] == "药店管理员" and 1 or 2])
-            pharmacy_id = st.number_input("药店ID", min_value=1, step=1, value=int(user_info["药店ID"]))
-            password = st.text_input("密码（留空则不修改）", type="password")
-            if st.form_submit_button("更新"):
-                if password == "":
-                    with get_conn() as conn:
-                        with conn.cursor() as cur:
-                            cur.execute("SELECT password FROM users WHERE user_id = %s", (user_to_update,))
-                            password = cur.fetchone()["password"]
-                manage_users("update", user_id=user_to_update, username=username, password=password, role=role_option, pharmacy_id=pharmacy_id)
+    user_to_update = pick_user("选择要更新的用户ID", "update_user_select")
+    if user_to_update is None:
+        return
+    with get_read_conn(("users",)) as conn:
+        user_info = grids.get_user(conn, user_to_update)
+    if user_info is None:
+        st.info("该用户已不存在")
+        return
+    with st.form("更新用户表单"):
+        username = st.text_input("用户名", value=user_info["username"])
+        role_option = st.selectbox("角色", options=[0, 1, 2],
+                                   format_func=lambda x: ROLE_MAP[x],
+                                   index=user_info["role"])
+        pharmacy_id = st.number_input("药店ID", min_value=1, step=1, value=user_info["pharmacy_id"] or 1)
+        password = st.text_input("密码（留空则不修改）", type="password")
+        if st.form_submit_button("更新"):
+            # 留空时不修改，数据库中保留原口令哈希
+            if manage_users("update", user_id=user_to_update, username=username, password=password, role=role_option, pharmacy_id=pharmacy_id):
                 st.success("用户更新成功")
                 st.rerun()
+            else:
+                st.error("操作失败：用户名已存在或其他约束冲突")
 
+@st.fragment
+@timed_section("药店管理")
 def admin_pharmacy_section():
     st.subheader("🏪 药店管理")
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT pharmacy_id, name, address FROM pharmacies")
-        rows = cur.fetchall()
-        df = pd.DataFrame(rows, columns=[desc[0] for desc in cur.description])
-        df.rename(columns={"pharmacy_id": "药店ID", "name": "药店名称", "address": "地址"}, inplace=True)
-    st.dataframe(df, use_container_width=True)
+    pharmacy_grid_panel()
 
     # 添加药店部分
     st.markdown("### 添加药店")
@@ -196,30 +213,258 @@ def admin_pharmacy_section():
         if st.form_submit_button("添加药店"):
             manage_pharmacies("add", name=new_name, address=new_address)
             st.success("药店添加成功")
-            st.rerun()
+            rerun_fragment()
+
+    pharmacy_delete_panel()
+    pharmacy_update_panel()
+
+@st.fragment
+def pharmacy_grid_panel():
+    col1, col2 = st.columns(2)
+    keyword = col1.text_input("药店ID或名称前缀", key="pharmacy_grid_keyword").strip()
+    sort_name = col2.selectbox("排序", list(grids.PHARMACY_SORTS), key="pharmacy_grid_sort")
+    sort = grids.PHARMACY_SORTS[sort_name]
+    cursors = grid_cursors("pharmacy_grid", (keyword, sort_name))
+
+    with get_read_conn(("pharmacies",)) as conn:
+        total = grids.pharmacy_count(conn, keyword)
+        rows, has_more = grids.pharmacy_page(conn, keyword, sort, after=cursors[-1])
+        if not rows and len(cursors) > 1:
+            cursors[:] = [None]
+            rows, has_more = grids.pharmacy_page(conn, keyword, sort)
+    if not rows:
+        st.info("没有符合条件的药店")
+        return
+
+    df = pd.DataFrame(rows)
+    df.rename(columns={"pharmacy_id": "药店ID", "name": "药店名称", "address": "地址"}, inplace=True)
+    st.dataframe(df, use_container_width=True, hide_index=True)
+    grid_pager("pharmacy_grid", cursors, rows, has_more, total, sort)
 
+# 停用药店：药店、其药品与员工账号立即不可用，历史数据保留；彻底删除由后台任务分批删除销售记录、药品与员工
+@st.fragment
+def pharmacy_delete_panel():
     # 删除药店
     st.markdown("### 删除药店")
-    pharmacy_ids = df["药店ID"].tolist()
-    pharmacy_to_delete = st.selectbox("选择要删除的药店ID", pharmacy_ids)
-    if st.button("删除药店"):
-        manage_pharmacies("delete", pharmacy_id=pharmacy_to_delete)
-        st.success(f"药店ID {pharmacy_to_delete} 已删除")
-        st.rerun()
+    pharmacy_to_delete = pick_pharmacy("选择要删除的药店ID", "delete_pharmacy_select")
+    if pharmacy_to_delete is not None:
+        col1, col2 = st.columns(2)
+        if col1.button("停用药店", help="保留全部数据，之后可以恢复"):
+            soft_delete("pharmacy", pharmacy_to_delete)
+            st.success(f"药店ID {pharmacy_to_delete} 已停用")
+            st.rerun()
+        purge_confirm = col2.checkbox("我理解这将永久删除该药店的药品、员工与销售记录", key="pharmacy_purge_confirm")
+        if col2.button("删除药店", disabled=not purge_confirm):
+            job_id = start_deletion("pharmacy", pharmacy_to_delete, st.session_state.user['user_id'])
+            st.success(f"药店ID {pharmacy_to_delete} 已停用，关联数据将由删除任务 #{job_id} 在后台分批删除")
+            st.rerun()
+    deletion_jobs_panel("pharmacy")
 
+@st.fragment
+def pharmacy_update_panel():
     # 更新药店
     st.markdown("### 更新药店")
-    pharmacy_to_update = st.selectbox("选择要更新的药店ID", pharmacy_ids, key="update_pharmacy_select")
-    if pharmacy_to_update:
-        pharmacy_info = df[df["药店ID"] == pharmacy_to_update].iloc[0]
-        with st.form("更新药店表单"):
-            name = st.text_input("药店名称", value=pharmacy_info["药店名称"])
-            address = st.text_area("地址", value=pharmacy_info["地址"])
-            if st.form_submit_button("更新"):
-                manage_pharmacies("update", pharmacy_id=pharmacy_to_update, name=name, address=address)
-                st.success("药店更新成功")
-                st.rerun()
+    pharmacy_to_update = pick_pharmacy("选择要更新的药店ID", "update_pharmacy_select")
+    if pharmacy_to_update is None:
+        return
+    with get_read_conn(("pharmacies",)) as conn:
+        pharmacy_info = grids.get_pharmacy(conn, pharmacy_to_update)
+    if pharmacy_info is None:
+        st.info("该药店已不存在或已停用")
+        return
+    with st.form("更新药店表单"):
+        name = st.text_input("药店名称", value=pharmacy_info["name"])
+        address = st.text_area("地址", value=pharmacy_info["address"])
+        if st.form_submit_button("更新"):
+            manage_pharmacies("update", pharmacy_id=pharmacy_to_update, name=name, address=address)
+            st.success("药店更新成功")
+            st.rerun()
+
+@timed_section("数据导出")
+def admin_export_section():
+    st.subheader("📤 销售数据导出")
+    st.markdown("按药店与日期范围导出销售记录，结果由服务端游标流式写出。超大范围建议在服务器上运行 `python export.py`")
+    with st.form("销售导出表单"):
+        pharmacy_id = st.number_input("药店ID（0 表示全部药店）", min_value=0, step=1, value=0)
+        col1, col2 = st.columns(2)
+        with col1:
+            start = st.date_input("起始日期", value=date.today() - timedelta(days=29))
+        with col2:
+            end = st.date_input("截止日期", value=date.today())
+        fmt = st.selectbox("导出格式", list(export.FORMATS), index=1)
+        submitted = st.form_submit_button("生成导出文件")
+    if submitted:
+        if start > end:
+            st.error("起始日期不能晚于截止日期")
+            return
+        with st.spinner("正在导出..."):
+            path, downloadable = export_sales_file(fmt, pharmacy_id=pharmacy_id or None,
+                                                   start=start, end=end + timedelta(days=1))
+        export_download(path, downloadable, "下载导出文件",
+                        f"销售记录_{pharmacy_id or '全部'}_{start}_{end}{export.FORMATS[fmt]}")
+
+# 导出完成后：不超过下载上限的文件读入页面供下载，并从服务器上删除；
+# 更大的文件不读入 streamlit 进程，留在服务器的导出目录中，提示其路径
+def export_download(path, downloadable, label, file_name):
+    size_mb = os.path.getsize(path) / 1e6
+    if not downloadable:
+        st.warning(f"导出文件 {size_mb:.1f} MB，超过页面下载上限 {EXPORT_CONFIG['download_limit_mb']} MB，"
+                   f"已保存在服务器上：`{path}`（保留 {EXPORT_CONFIG['retention_hours']} 小时）。"
+                   f"超大范围建议在服务器上运行 `python export.py`")
+        return
+    with open(path, "rb") as f:
+        data = f.read()
+    os.remove(path)
+    st.download_button(
+        label=f"{label}（{size_mb:.1f} MB）",
+        data=data,
+        file_name=file_name,
+        mime="application/octet-stream"
+    )
+
+@timed_section("销售报表")
+def admin_report_section():
+    st.subheader("📊 销售报表")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        pharmacy_id = st.number_input("药店ID（0 表示全部药店）", min_value=0, step=1, value=0, key="report_pharmacy")
+    with col2:
+        start = st.date_input("起始日期", value=date.today() - timedelta(days=29), key="report_start")
+    with col3:
+        end = st.date_input("截止日期", value=date.today(), key="report_end")
+    if start > end:
+        st.error("起始日期不能晚于截止日期")
+        return
+
+    report = sales_report(start, end + timedelta(days=1), pharmacy_id or None)
+    by_day = pd.DataFrame(report['by_day'], columns=["day", "sale_count", "quantity", "amount"])
+    col1, col2, col3 = st.columns(3)
+    col1.metric("销售笔数", int(by_day['sale_count'].sum()))
+    col2.metric("销售数量", int(by_day['quantity'].sum()))
+    col3.metric("销售金额", f"¥{float(by_day['amount'].sum()):,.2f}")
+    if by_day.empty:
+        st.info("该范围内没有销售记录")
+        return
+
+    st.markdown("**每日销售金额**")
+    st.line_chart(by_day.set_index("day")['amount'].astype(float))
+    st.markdown("**各时段销售笔数**")
+    by_hour = pd.DataFrame(report['by_hour'])
+    st.bar_chart(by_hour.set_index("hour")['sale_count'].astype(int))
+
+    if report['by_pharmacy']:
+        st.markdown("**药店销售排行**")
+        st.dataframe(pd.DataFrame(report['by_pharmacy']).rename(columns={
+            "pharmacy_id": "药店ID", "name": "药店名称", "sale_count": "销售笔数",
+            "quantity": "销售数量", "amount": "销售金额"
+        }), use_container_width=True)
+    st.markdown("**药品销售排行**")
+    st.dataframe(pd.DataFrame(report['top_medicines']).rename(columns={
+        "medicine_id": "药品ID", "name": "药品名称", "manufacturer": "药品产商",
+        "quantity": "销售数量", "amount": "销售金额"
+    }), use_container_width=True)
+
+@timed_section("补货调拨")
+def admin_replenish_section():
+    st.subheader("📦 补货与调拨")
+    run = replenishment_last_run()
+    if run is None:
+        st.info("尚未计算补货统计")
+    else:
+        st.caption(f"最近一次计算：{run['run_at']:%Y-%m-%d %H:%M}（{'全量' if run['full_rebuild'] else '增量'}，"
+                   f"销售统计截至 {run['through']}，耗时 {run['seconds']:.1f} 秒）。建议用 cron 定时运行 `python replenish.py`")
+    if st.button("立即重新计算"):
+        with st.spinner("正在计算..."):
+            result = run_replenishment()
+        if result is None:
+            st.warning("另一个补货计算正在进行，请稍后刷新")
+        else:
+            st.rerun()
+    if run is None:
+        return
 
+    summary = pd.DataFrame(replenishment_summary())
+    col1, col2, col3 = st.columns(3)
+    col1.metric("低于补货点的药品", int(summary["below_reorder"].sum()) if not summary.empty else 0)
+    col2.metric("已缺货的药品", int(summary["out_of_stock"].sum()) if not summary.empty else 0)
+    col3.metric("调拨建议", run['transfers'])
+    st.markdown("**各药店库存状况**")
+    st.dataframe(summary.rename(columns={
+        "pharmacy_id": "药店ID", "name": "药店名称", "medicines": "药品数", "below_reorder": "低于补货点",
+        "out_of_stock": "已缺货", "transfers_in": "建议调入", "transfers_out": "建议调出"
+    }), use_container_width=True, hide_index=True)
+    transfers = pd.DataFrame(transfer_suggestions(), columns=list(TRANSFER_COLUMNS))
+    st.markdown("**跨店调拨建议（按数量排序，最多 500 条）**")
+    if transfers.empty:
+        st.info("当前没有调拨建议")
+    else:
+        st.dataframe(transfers.rename(columns=TRANSFER_COLUMNS), use_container_width=True, hide_index=True)
+
+@timed_section("性能分析")
+def admin_profiler_section():
+    st.subheader("⏱️ 性能分析")
+    snap = profiler.snapshot()
+    st.caption(f"统计自 {snap['since']}（本进程），慢查询阈值 {snap['slow_query_ms']} ms")
+
+    queries = pd.DataFrame([
+        {"语句": name, "次数": q['count'], "总耗时(ms)": q['total_ms'], "平均(ms)": q['avg_ms'],
+         "p50(ms)": q['p50_ms'], "p95(ms)": q['p95_ms'], "p99(ms)": q['p99_ms'], "最大(ms)": q['max_ms'],
+         "返回行数": q['rows'], "出错": q['errors'], "SQL": q['sql']}
+        for name, q in snap['queries'].items()
+    ])
+    st.markdown("**SQL 语句（按总耗时排序）**")
+    if queries.empty:
+        st.info("暂无数据")
+    else:
+        st.dataframe(queries.sort_values("总耗时(ms)", ascending=False), use_container_width=True)
+
+    sections = pd.DataFrame([
+        {"模块": name, "渲染次数": h['count'], "平均(ms)": h['avg_ms'], "p95(ms)": h['p95_ms'], "最大(ms)": h['max_ms']}
+        for name, h in snap['sections'].items()
+    ])
+    st.markdown("**页面模块渲染时间**")
+    if not sections.empty:
+        st.dataframe(sections.sort_values("平均(ms)", ascending=False), use_container_width=True)
+
+    prepared = pd.DataFrame([
+        {"语句": name, "PREPARE 次数": s['prepares'], "执行次数": s['executions'], "平均(ms)": s['avg_ms'],
+         "最大(ms)": s['max_ms'], "总耗时(ms)": s['total_ms'], "出错": s['errors']}
+        for name, s in statements.stats().items() if s['executions']
+    ])
+    st.markdown("**预备语句（每个连接 PREPARE 一次，之后按名称执行）**")
+    if prepared.empty:
+        st.info("暂无数据")
+    else:
+        st.dataframe(prepared.sort_values("总耗时(ms)", ascending=False), use_container_width=True, hide_index=True)
+
+    wait = snap['pool_wait']
+    col1, col2, col3 = st.columns(3)
+    col1.metric("取连接次数", wait['count'])
+    col2.metric("取连接等待 p95", f"{wait['p95_ms']} ms")
+    col3.metric("取连接等待最大", f"{wait['max_ms']} ms")
+    with st.expander("连接池与缓存"):
+        st.json({"pool": pool_stats(), "replicas": replica_stats(), "cache": cache_stats(),
+                 "sessions": auth.session_stats(), "change_listener": listener_stats(), "journal": journal.stats()})
+
+    st.markdown("**慢查询（参数已脱敏）**")
+    if snap['slow_queries']:
+        st.dataframe(pd.DataFrame(snap['slow_queries'][::-1]).astype(str), use_container_width=True)
+    else:
+        st.info("暂无慢查询")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("下载指标 JSON", data=json.dumps(dict(snap, statements=statements.stats()),
+                                                       ensure_ascii=False, indent=2, default=str),
+                           file_name="metrics.json", mime="application/json")
+    with col2:
+        if st.button("重置统计"):
+            profiler.metrics.reset()
+            statements.reset_stats()
+            st.rerun()
+
+@st.fragment
+@timed_section("药品管理")
 def pharmacy_admin_section():
     st.subheader("💊 药品管理")
     pharmacy_id = st.session_state.user['pharmacy_id']
@@ -233,10 +478,16 @@ def pharmacy_admin_section():
             "manufacturer": "药品产商",
             "code": "药品编码",
             "price": "药品价格",
-            "stock": "药品库存"
+            "stock": "药品库存",
+            "sales_count": "销售笔数",
+            "last_sold_at": "最近销售"
         }, inplace=True)
         st.dataframe(df, use_container_width=True)
 
+    slow_movers_panel(medicines)
+    replenishment_panel(medicines, pharmacy_id)
+    journal_conflicts_panel(pharmacy_id)
+
     # 添加药品 - 修改为统一风格
     st.markdown("---")
     st.subheader("➕ 添加药品")
@@ -254,8 +505,146 @@ def pharmacy_admin_section():
             manage_medicines("add", name=name, manufacturer=manufacturer, code=code, 
                              price=price, stock=stock, pharmacy_id=pharmacy_id)
             st.success("药品添加成功")
-            st.rerun()
+            rerun_fragment()
 
+    medicine_import_panel(pharmacy_id)
+    medicine_update_panel(medicines)
+    medicine_delete_panel(medicines)
+
+# 滞销药品：超过给定天数没有销售（或从未销售）的药品，按最近销售时间从早到晚排列，
+# 直接读缓存的药品目录上的销售计数，调整天数只重跑本面板，不查询数据库
+@st.fragment
+def slow_movers_panel(medicines):
+    st.markdown("---")
+    st.subheader("🐢 滞销药品")
+    days = st.number_input("超过多少天未销售", min_value=1, value=30, step=1, key="slow_movers_days")
+    if not medicines:
+        st.info("当前没有药品")
+        return
+    cutoff = datetime.now() - timedelta(days=days)
+    slow = [m for m in medicines if m['last_sold_at'] is None or m['last_sold_at'] < cutoff]
+    if not slow:
+        st.success(f"最近 {days} 天内所有药品都有销售")
+        return
+    df = pd.DataFrame(slow, columns=["medicine_id", "name", "manufacturer", "code", "price", "stock",
+                                     "sales_count", "last_sold_at"])
+    df["stock_value"] = df["price"].astype(float) * df["stock"]
+    df.sort_values(["last_sold_at", "stock_value"], ascending=[True, False], na_position="first", inplace=True)
+    col1, col2 = st.columns(2)
+    col1.metric("滞销药品数", f"{len(df)} / {len(medicines)}")
+    col2.metric("积压库存金额", f"¥{df['stock_value'].sum():,.2f}")
+    st.dataframe(df.head(500).rename(columns={
+        "medicine_id": "药品ID",
+        "name": "药品名称",
+        "manufacturer": "药品产商",
+        "code": "药品编码",
+        "price": "药品价格",
+        "stock": "药品库存",
+        "sales_count": "销售笔数",
+        "last_sold_at": "最近销售",
+        "stock_value": "积压金额"
+    }), use_container_width=True, hide_index=True)
+    if len(df) > 500:
+        st.caption(f"仅显示最久未销售的 500 种，共 {len(df)} 种")
+
+# 补货建议：定时计算的销售速度与补货点（见 replenish.py）结合缓存中的实时库存，列出低于补货点的药品与跨店调拨建议
+@st.fragment
+def replenishment_panel(medicines, pharmacy_id):
+    st.markdown("---")
+    st.subheader("📦 补货建议")
+    run = replenishment_last_run()
+    if run is None:
+        st.info("尚未计算补货统计，请联系系统管理员运行补货计算")
+        return
+    st.caption(f"销售速度按截至 {run['through']} 的销售统计（{run['run_at']:%Y-%m-%d %H:%M} 计算），库存为实时库存")
+    low = replenish.low_stock(medicines, replenishment_stats(pharmacy_id))
+    col1, col2, col3 = st.columns(3)
+    col1.metric("低于补货点", len(low))
+    col2.metric("已缺货", int((low["stock"] <= 0).sum()))
+    col3.metric("建议补货总量", int(low["order_qty"].sum()))
+    if low.empty:
+        st.success("所有药品的库存都高于补货点")
+    else:
+        st.dataframe(low.head(500).rename(columns={
+            "medicine_id": "药品ID",
+            "name": "药品名称",
+            "manufacturer": "药品产商",
+            "code": "药品编码",
+            "stock": "药品库存",
+            "velocity": "日均销量",
+            "days_of_cover": "可售天数",
+            "reorder_point": "补货点",
+            "order_qty": "建议补货量"
+        })[["药品ID", "药品名称", "药品产商", "药品编码", "药品库存", "日均销量", "可售天数", "补货点", "建议补货量"]],
+            use_container_width=True, hide_index=True)
+        if len(low) > 500:
+            st.caption(f"仅显示可售天数最少的 500 种，共 {len(low)} 种")
+
+    transfers = pd.DataFrame(transfer_suggestions(pharmacy_id), columns=list(TRANSFER_COLUMNS) + ["from_pharmacy_id", "to_pharmacy_id"])
+    if transfers.empty:
+        return
+    incoming = transfers[transfers["to_pharmacy_id"] == pharmacy_id]
+    outgoing = transfers[transfers["from_pharmacy_id"] == pharmacy_id]
+    for label, frame in (("**建议从其他药店调入**", incoming), ("**建议调出到其他药店**", outgoing)):
+        if not frame.empty:
+            st.markdown(label)
+            st.dataframe(frame[list(TRANSFER_COLUMNS)].rename(columns=TRANSFER_COLUMNS),
+                         use_container_width=True, hide_index=True)
+
+# 离线记账的销售写库时发现的冲突（见 journal.py），没有冲突时不显示
+@st.fragment
+def journal_conflicts_panel(pharmacy_id):
+    conflicts = journal_conflicts(pharmacy_id)
+    if not conflicts:
+        return
+    st.markdown("---")
+    st.subheader("⚠️ 离线销售冲突")
+    st.markdown("以下销售在数据库不可用期间记入本地日志，写库时库存已不足（库存已扣到 0，缺口需盘点核对）或药品已被删除（未写入销售记录）")
+    df = pd.DataFrame(conflicts)
+    df["status"] = df["status"].map({"short": "库存不足", "missing": "药品已删除"})
+    st.dataframe(df.rename(columns={
+        "medicine_id": "药品ID",
+        "name": "药品名称",
+        "username": "销售员",
+        "quantity": "数量",
+        "shortfall": "缺口",
+        "status": "冲突",
+        "sold_at": "销售时间",
+        "applied_at": "写库时间"
+    })[["销售时间", "药品ID", "药品名称", "销售员", "数量", "缺口", "冲突", "写库时间"]],
+        use_container_width=True, hide_index=True)
+    if st.button("全部标记为已处理", key="resolve_journal_conflicts"):
+        resolve_journal_conflicts([c['journal_key'] for c in conflicts], pharmacy_id)
+        rerun_fragment()
+
+@st.fragment
+def medicine_import_panel(pharmacy_id):
+    # 批量导入药品
+    st.markdown("---")
+    st.subheader("📥 批量导入药品")
+    st.markdown("上传 CSV 或 Excel 文件，表头为：药品编码、药品名称、药品产商、药品价格、药品库存。已存在的编码会更新名称、产商、价格与库存")
+    with st.form("批量导入表单"):
+        upload = st.file_uploader("选择文件", type=["csv", "xlsx"])
+        submitted = st.form_submit_button("开始导入")
+    if submitted and upload is not None:
+        try:
+            with st.spinner("正在导入..."):
+                result = import_medicines_file(upload, upload.name, pharmacy_id)
+        except importer.ImportFileError as e:
+            st.error(f"导入失败：{e}")
+        else:
+            st.success(f"导入完成：新增 {result['inserted']} 条，更新 {result['updated']} 条，"
+                       f"不合格 {result['rejected']} 条，用时 {result['elapsed']:.1f} 秒")
+            if result['rejected']:
+                rejects = result['rejects'].rename(columns={
+                    "line": "行号", "code": "药品编码", "name": "药品名称", "reason": "原因"
+                })
+                st.dataframe(rejects.head(1000), use_container_width=True, hide_index=True)
+                st.download_button("下载全部不合格行", rejects.to_csv(index=False).encode('utf-8'),
+                                   file_name="导入不合格行.csv", mime="text/csv")
+
+@st.fragment
+def medicine_update_panel(medicines):
     # 更新药品 - 修改为统一风格
     st.markdown("---")
     st.subheader("✏️ 更新药品信息")
@@ -266,17 +655,18 @@ def pharmacy_admin_section():
         selected_med = next((m for m in medicines if m["medicine_id"] == selected_id), None)
         
         if selected_med:
+            # 表单控件的 key 带上药品ID，切换药品后显示所选药品的当前值，而不是沿用上一个药品的输入
             with st.form("更新药品表单"):
                 col1, col2 = st.columns(2)
                 with col1:
-                    name = st.text_input("药品名称", value=selected_med["name"], key="update_name")
-                    manufacturer = st.text_input("药品产商", value=selected_med["manufacturer"], key="update_manufacturer")
-                    code = st.text_input("药品编码", value=selected_med["code"], key="update_code")
+                    name = st.text_input("药品名称", value=selected_med["name"], key=f"update_name_{selected_id}")
+                    manufacturer = st.text_input("药品产商", value=selected_med["manufacturer"], key=f"update_manufacturer_{selected_id}")
+                    code = st.text_input("药品编码", value=selected_med["code"], key=f"update_code_{selected_id}")
                 with col2:
                     price = st.number_input("药品价格", min_value=0.0, step=0.1, 
-                                          value=float(selected_med["price"]), key="update_price")
+                                          value=float(selected_med["price"]), key=f"update_price_{selected_id}")
                     stock = st.number_input("药品库存", min_value=0, step=1, 
-                                          value=selected_med["stock"], key="update_stock")
+                                          value=selected_med["stock"], key=f"update_stock_{selected_id}")
                 
                 if st.form_submit_button("更新药品"):
                     manage_medicines("update", medicine_id=selected_id, name=name, 
@@ -288,6 +678,8 @@ def pharmacy_admin_section():
     else:
         st.info("当前没有药品可供更新")
 
+@st.fragment
+def medicine_delete_panel(medicines):
     # 删除药品 - 保持原有风格
     st.markdown("---")
     st.subheader("🗑️ 删除药品")
@@ -297,13 +689,9 @@ def pharmacy_admin_section():
         st.markdown("#### 选择药品")
         delete_id = st.selectbox("选择要删除的药品ID", medicine_ids, key="delete_medicine_select")
         
-        # 检查该药品是否存在销售记录
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM sales WHERE medicine_id = %s", (delete_id,))
-                ref_count = cur.fetchone()['count']
-        
+        # 销售引用数取自缓存的药品目录上的销售计数，切换药品不再查询数据库
         selected_med = next((m for m in medicines if m["medicine_id"] == delete_id), None)
+        ref_count = selected_med['sales_count'] if selected_med else 0
         if selected_med:
             st.markdown(f"**药品名称**：{selected_med['name']}")
             st.markdown(f"**药品产商**：{selected_med['manufacturer']}")
@@ -312,52 +700,89 @@ def pharmacy_admin_section():
         # 分支1: 没有销售记录引用 - 直接删除
         if ref_count == 0:
             if st.button("确认删除药品", key="safe_delete_btn"):
-                manage_medicines("delete", medicine_id=delete_id)
-                st.success(f"药品ID {delete_id} 已成功删除（无销售引用）")
-                st.rerun()
+                if manage_medicines("delete", medicine_id=delete_id):
+                    st.success(f"药品ID {delete_id} 已成功删除（无销售引用）")
+                    st.rerun()
+                else:
+                    st.error("该药品已有新的销售记录，无法直接删除，请刷新后使用强制删除")
         
         # 分支2: 存在销售记录引用 - 提供强制删除选项
         else:
-            st.warning(f"⚠️ 该药品在销售记录中有 {ref_count} 条引用，删除将导致关联数据丢失！")
+            last_sold = selected_med['last_sold_at']
+            last_sold_text = f"（最近一次销售于 {last_sold:%Y-%m-%d %H:%M}）" if last_sold else ""
+            st.warning(f"⚠️ 该药品在销售记录中有 {ref_count} 条引用{last_sold_text}，删除将导致关联数据丢失！")
             
-            # 显示关联销售记录预览
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        SELECT s.sale_id, s.quantity, s.sale_time, u.username 
-                        FROM sales s
-                        JOIN users u ON s.user_id = u.user_id
-                        WHERE s.medicine_id = %s
-                        ORDER BY s.sale_time DESC
-                        LIMIT 10
-                    """, (delete_id,))
-                    sales = cur.fetchall()
-                    if sales:
-                        sales_df = pd.DataFrame(sales)
-                        st.dataframe(sales_df)
-                    else:
-                        st.info("无销售记录")
+            # 关联销售记录预览只在展开时查询
+            if st.toggle("查看最近 10 条销售记录", key="delete_preview_toggle"):
+                recent = recent_sales_of(delete_id)
+                if recent:
+                    st.dataframe(pd.DataFrame(recent))
+                else:
+                    st.info("无销售记录")
             
-            # 强制删除选项
+            # 下架：立即从目录与收银中隐藏，销售记录与报表保持不变，可以恢复
+            st.markdown("#### 下架药品")
+            if st.button("下架药品", help="保留全部销售记录，之后可以恢复", key="soft_delete_btn"):
+                soft_delete("medicine", delete_id)
+                st.success(f"药品ID {delete_id} 已下架")
+                st.rerun()
+
+            # 强制删除：先下架，关联的销售记录由后台任务分批删除，不阻塞收银
             st.markdown("#### 强制删除")
             
             # 添加额外的确认步骤
             force_confirm = st.checkbox("我理解这将永久删除所有关联数据", key="force_confirm")
             if st.button("强制删除", disabled=not force_confirm, 
-                       help="删除药品及其所有销售记录", key="force_delete_btn"):
-                with get_conn() as conn:
-                    with conn.cursor() as cur:
-                        # 先删除关联的销售记录
-                        cur.execute("DELETE FROM sales WHERE medicine_id = %s", (delete_id,))
-                        # 再删除药品
-                        cur.execute("DELETE FROM medicines WHERE medicine_id = %s", (delete_id,))
-                        conn.commit()
-                st.success(f"药品ID {delete_id} 及其 {ref_count} 条销售记录已强制删除")
-                st.cache_data.clear()
+                       help="下架药品，并在后台分批删除其所有销售记录", key="force_delete_btn"):
+                job_id = start_deletion("medicine", delete_id, st.session_state.user['user_id'])
+                st.success(f"药品ID {delete_id} 已下架，其 {ref_count} 条销售记录将由删除任务 #{job_id} 在后台分批删除")
                 st.rerun()
     else:
         st.info("当前没有药品可供删除")
 
+    deletion_jobs_panel("medicine", st.session_state.user['pharmacy_id'])
+
+# 已下架（停用）的对象与后台删除任务，展开时才查询；进度不自动刷新，点击刷新只重跑本面板
+@st.fragment
+def deletion_jobs_panel(entity, pharmacy_id=None):
+    label = "药品" if entity == "medicine" else "药店"
+    if not st.toggle(f"显示已{'下架' if entity == 'medicine' else '停用'}{label}与删除任务", key=f"deletion_panel_{entity}"):
+        return
+    key = "medicine_id" if entity == "medicine" else "pharmacy_id"
+    removed = list_soft_deleted(entity, pharmacy_id)
+    if removed:
+        st.dataframe(pd.DataFrame(removed), use_container_width=True, hide_index=True)
+        target = st.selectbox(f"选择{label}ID", [r[key] for r in removed], key=f"deletion_target_{entity}")
+        col1, col2 = st.columns(2)
+        if col1.button("恢复", key=f"restore_btn_{entity}"):
+            if restore(entity, target):
+                st.success(f"{label}ID {target} 已恢复")
+                st.rerun()
+            else:
+                st.error("恢复失败：该对象已登记删除任务")
+        if col2.button("彻底删除", key=f"purge_btn_{entity}"):
+            job_id = start_deletion(entity, target, st.session_state.user['user_id'])
+            st.success(f"已登记删除任务 #{job_id}")
+            rerun_fragment()
+    else:
+        st.info(f"没有已{'下架' if entity == 'medicine' else '停用'}的{label}")
+
+    jobs = deletion_jobs(pharmacy_id, entity)
+    if jobs:
+        df = pd.DataFrame(jobs)
+        df["progress"] = [min(r['deleted_rows'] / r['total_rows'], 1.0) if r['total_rows'] else 0.0 for r in jobs]
+        df.loc[df["status"] == "done", "progress"] = 1.0
+        st.dataframe(df[["job_id", "target_id", "status", "phase", "progress", "deleted_rows", "total_rows",
+                         "error", "created_at", "finished_at"]],
+                     column_config={"progress": st.column_config.ProgressColumn("进度", min_value=0.0, max_value=1.0)},
+                     use_container_width=True, hide_index=True)
+        if st.button("刷新进度", key=f"deletion_refresh_{entity}"):
+            rerun_fragment()
+
+# 销售页分为三个 fragment：检索、收银（选药、销售、购物车）与嵌套在收银中的销售记录。
+# 输入关键字只重跑检索；选药、销售、结算只重跑收银，购物车与销售记录在按钮之后渲染，本次运行中即为最新；
+# 翻页只重跑销售记录
+@timed_section("药品销售")
 def sales_section():
     st.subheader("🛒 药品检索")
     pharmacy_id = st.session_state.user['pharmacy_id']
@@ -369,11 +794,21 @@ def sales_section():
         st.info("当前药店暂无药品")
         return
 
-    med_map = {f"{m['name']} | {m['manufacturer']} | {m['code']}": m for m in medicines}
+    sales_search_fragment(pharmacy_id)
+
+    st.markdown("---")
+    st.subheader("💳 药品销售")
+    sales_counter_fragment(pharmacy_id, user_id)
+
+@st.fragment
+@timed_section("药品检索")
+def sales_search_fragment(pharmacy_id):
+    # 用已加载的库存目录建立（或复用）本药店的搜索索引，搜索不再访问数据库
+    search_index.ensure_index(pharmacy_id, get_medicines(pharmacy_id))
 
     keyword = st.text_input("🔍 搜索药品 (名称/生产商/编码)")
     if keyword:
-        results = search_medicines(pharmacy_id, keyword)
+        results = find_medicines(pharmacy_id, keyword)
         if results:
             st.markdown("#### 搜索结果")
             for med in results:
@@ -381,15 +816,23 @@ def sales_section():
         else:
             st.info("未找到匹配的药品")
 
-    st.markdown("---")
-    st.subheader("💳 药品销售")
+@st.fragment
+@timed_section("收银")
+def sales_counter_fragment(pharmacy_id, user_id):
+    medicines = get_medicines(pharmacy_id)
+    if not medicines:
+        st.info("当前药店暂无药品")
+        return
+    med_map = {f"{m['name']} | {m['manufacturer']} | {m['code']}": m for m in medicines}
 
     # 选择药品
     options = list(med_map.keys())
     selected = st.selectbox("选择药品", options)
 
     selected_med = med_map[selected]
-    st.markdown(f"**药品详情**： 库存：{selected_med['stock']}  |  价格：¥{selected_med['price']:.2f}")
+    # 库存行放在占位符中，销售后原地改写，不必为刷新它重跑
+    stock_line = st.empty()
+    stock_line.markdown(f"**药品详情**： 库存：{selected_med['stock']}  |  价格：¥{selected_med['price']:.2f}")
 
     max_qty = selected_med['stock']
     if max_qty == 0:
@@ -400,117 +843,175 @@ def sales_section():
         quantity = st.number_input("数量", min_value=1, max_value=max_qty, value=1)
         sell_enabled = True
 
-    if st.button("销售", disabled=not sell_enabled):
-        success = sell_medicine(selected_med['medicine_id'], quantity, user_id)
-        if success:
-            st.success(f"成功销售 {quantity} 件《{selected_med['name']}》")
-            # 清除缓存，刷新 medicines 数据
-            st.cache_data.clear()
-            # 立即刷新销售记录显示
-            st.rerun()
-        else:
-            st.error("销售失败，库存不足或药品不存在")
-    
+    # 购物车：{medicine_id: 数量}，结算前只存在于 session 中，不访问数据库
+    cart = st.session_state.setdefault("cart", {})
+
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("销售", disabled=not sell_enabled):
+            result = sell_medicine(selected_med['medicine_id'], quantity, user_id, pharmacy_id)
+            if result:
+                stock_line.markdown(f"**药品详情**： 库存：{result['stock']}  |  价格：¥{selected_med['price']:.2f}")
+                st.success(f"成功销售 {quantity} 件《{selected_med['name']}》，剩余库存 {result['stock']}"
+                           + ("（已记入本地日志，稍后同步）" if result.get('pending') else ""))
+            else:
+                st.error("销售失败，库存不足或药品不存在")
+    with col2:
+        if st.button("加入购物车", disabled=not sell_enabled):
+            in_cart = cart.get(selected_med['medicine_id'], 0)
+            if in_cart + quantity > max_qty:
+                st.error(f"购物车中该药品已有 {in_cart} 件，超出库存")
+            else:
+                cart[selected_med['medicine_id']] = in_cart + quantity
+
+    # 购物车结算板块
+    if cart:
+        st.markdown("#### 🧺 购物车")
+        id_map = {m['medicine_id']: m for m in medicines}
+        cart_df = pd.DataFrame([{
+            "药品名称": id_map[mid]['name'] if mid in id_map else f"药品ID {mid}",
+            "生产商": id_map[mid]['manufacturer'] if mid in id_map else "",
+            "数量": qty,
+            "单价": id_map[mid]['price'] if mid in id_map else None,
+            "小计": qty * id_map[mid]['price'] if mid in id_map else None
+        } for mid, qty in cart.items()])
+        st.dataframe(cart_df, use_container_width=True, hide_index=True)
+        st.markdown(f"**合计**：{int(cart_df['数量'].sum())} 件  |  ¥{cart_df['小计'].sum():.2f}")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("结算"):
+                try:
+                    checkout_medicines(list(cart.items()), user_id, pharmacy_id)
+                    st.success(f"结算成功，共 {len(cart)} 种药品")
+                    cart.clear()
+                    rerun_fragment()
+                except sales.InsufficientStock as e:
+                    names = "、".join(id_map[mid]['name'] if mid in id_map else str(mid) for mid in e.medicine_ids)
+                    st.error(f"结算失败，以下药品库存不足或不存在：{names}，本次结算未做任何修改")
+        with col2:
+            if st.button("清空购物车"):
+                cart.clear()
+                rerun_fragment()
+
     # 销售记录查看板块
     st.markdown("---")
     st.subheader("📊 销售记录")
-    
+    pending = journal.pending_count(user_id)
+    if pending:
+        st.info(f"另有 {pending} 笔销售已记入本地日志、尚未写入数据库，写入后显示在下方记录中")
+    sales_history_fragment(user_id)
+
+@st.fragment
+@timed_section("销售记录")
+def sales_history_fragment(user_id):
     # 时间范围选择器
     time_range = st.selectbox("时间范围", 
-                             ["今日", "最近7天", "最近30天", "全部"],
+                             list(sales.TIME_RANGE_FILTERS),
                              index=0)
-    
-    # 获取销售记录（修复时间范围查询）
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            # 基础查询
-            base_query = """
-                SELECT s.sale_id, s.sale_time, m.name AS medicine_name, 
-                       m.manufacturer, s.quantity, m.price, 
-                       (s.quantity * m.price) AS total_amount,
-                       u.username
-                FROM sales s
-                JOIN medicines m ON s.medicine_id = m.medicine_id
-                JOIN users u ON s.user_id = u.user_id
-                WHERE s.user_id = %s
-            """
-            params = [user_id]
-            
-            # 添加精确的时间过滤条件
-            if time_range == "今日":
-                base_query += " AND s.sale_time >= CURRENT_DATE"
-            elif time_range == "最近7天":
-                base_query += " AND s.sale_time >= CURRENT_DATE - INTERVAL '6 days'"
-            elif time_range == "最近30天":
-                base_query += " AND s.sale_time >= CURRENT_DATE - INTERVAL '29 days'"
-            
-            base_query += " ORDER BY s.sale_time DESC"
-            
-            cur.execute(base_query, params)
-            sales_records = cur.fetchall()
-    
+
+    # 分页游标：history_cursors[i] 为第 i 页的起点（上一页最后一行的 sale_time, sale_id），
+    # session 中只保存游标，不保存记录本身；切换时间范围后从第一页开始
+    if st.session_state.get("history_range") != time_range:
+        st.session_state.history_range = time_range
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    page = len(cursors) - 1
+
+    # 刚销售过的收银员从主库读取，立即看到自己的销售
+    with get_read_conn(("user", user_id)) as conn:
+        totals = sales.history_totals(conn, user_id, time_range)
+        sales_records, has_more = sales.history_page(conn, user_id, time_range, after=cursors[-1])
+        if not sales_records and page > 0:
+            # 当前页的记录已不存在（例如被删除），回到第一页
+            cursors[:] = [None]
+            page = 0
+            sales_records, has_more = sales.history_page(conn, user_id, time_range)
+
     # 显示销售记录
     if sales_records:
+        # 显示统计信息（由数据库汇总，不依赖当前页）
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("总销售额", f"¥{totals['total_amount']:.2f}")
+        with col2:
+            st.metric("总销售数量", f"{totals['total_quantity']} 件")
+
         # 创建数据框
         sales_df = pd.DataFrame(sales_records)
         sales_df.rename(columns={
-            "sale_id": "销售ID",
-            "sale_time": "销售时间",
+            "sale_time_text": "销售时间",
             "medicine_name": "药品名称",
             "manufacturer": "生产商",
             "quantity": "数量",
             "price": "单价",
-            "total_amount": "总金额",
-            "username": "销售员"
+            "total_amount": "总金额"
         }, inplace=True)
-        
-        # 格式化时间列（精确到秒）
-        sales_df["销售时间"] = sales_df["销售时间"].dt.strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 计算总销售金额
-        total_sales = sales_df["总金额"].sum()
-        total_quantity = sales_df["数量"].sum()
-        
-        # 显示统计信息
-        col1, col2 = st.columns(2)
-        with col1:
-            st.metric("总销售额", f"¥{total_sales:.2f}")
-        with col2:
-            st.metric("总销售数量", f"{total_quantity} 件")
-        
+
         # 显示数据表格
         st.dataframe(sales_df[["销售时间", "药品名称", "生产商", "数量", "单价", "总金额"]], 
                      use_container_width=True,
                      hide_index=True)
-        
-        # 添加数据导出功能
-        csv = sales_df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="导出销售记录",
-            data=csv,
-            file_name=f"销售记录_{time_range}.csv",
-            mime="text/csv"
-        )
+
+        # 翻页
+        st.caption(f"第 {page + 1} 页，共 {totals['sale_count']} 条记录")
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("上一页", disabled=page == 0):
+                cursors.pop()
+                rerun_fragment()
+        with col2:
+            if st.button("下一页", disabled=not has_more):
+                last = sales_records[-1]
+                cursors.append((last['sale_time'], last['sale_id']))
+                rerun_fragment()
+
+        # 添加数据导出功能，只在点击后才流式导出完整记录
+        col1, col2 = st.columns(2)
+        with col1:
+            fmt = st.selectbox("导出格式", list(export.FORMATS), key="sales_export_format")
+        with col2:
+            if st.button("准备导出文件"):
+                path, downloadable = export_sales_file(fmt, user_id=user_id, time_range=time_range)
+                export_download(path, downloadable, "导出销售记录", f"销售记录_{time_range}{export.FORMATS[fmt]}")
     else:
         st.info("当前时间段内无销售记录")
 
 def main():
     st.set_page_config(page_title="连锁药店管理系统", layout="wide")
-    if 'user' not in st.session_state:
+    # 每个进程启动一次，接收其他实例的变更事件；后台删除线程接手未完成的删除任务
+    start_change_listener()
+    start_deletion_worker()
+    start_journal()
+    # 每次整页运行都校验会话令牌：本进程验证过的令牌只查内存；口令被修改、账号被删除或药店被停用后令牌失效，回到登录页
+    user = auth.verify_session(st.session_state.get('session_token'))
+    if user is None:
+        st.session_state.pop('session_token', None)
+        st.session_state.pop('user', None)
         login_section()
     else:
-        role = st.session_state.user['role']
+        st.session_state.user = user
+        role = user['role']
         st.sidebar.title(f"当前角色: {'系统管理员' if role == 0 else '药店管理员' if role == 1 else '销售员'}")
         if st.sidebar.button("退出登录"):
+            auth.logout(st.session_state.pop('session_token'))
             st.session_state.pop('user')
             st.rerun()
 
         if role == 0:
-            section = st.sidebar.radio("模块", ["用户管理", "药店管理"])
+            section = st.sidebar.radio("模块", ["用户管理", "药店管理", "销售报表", "补货调拨", "数据导出", "性能分析"])
             if section == "用户管理":
                 admin_user_section()
-            else:
+            elif section == "药店管理":
                 admin_pharmacy_section()
+            elif section == "销售报表":
+                admin_report_section()
+            elif section == "补货调拨":
+                admin_replenish_section()
+            elif section == "数据导出":
+                admin_export_section()
+            else:
+                admin_profiler_section()
         elif role == 1:
             pharmacy_admin_section()
         elif role == 2:
@@ -0,0 +1,225 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import AUTH_CONFIG
+from db import get_conn
+import statements
+
+# 登录与会话：口令以 PBKDF2-SHA256 加盐哈希保存，格式为 pbkdf2_sha256$迭代次数$盐$哈希（盐与哈希为 base64）。
+# 哈希计算刻意很慢，放在有界的工作线程池中执行（hashlib 计算时释放 GIL），登录高峰时排队而不是占满全部 CPU。
+# 登录成功后签发签名的会话令牌，令牌中带用户ID、角色、药店与口令指纹；每个进程在内存中保存已验证的会话，
+# 页面重跑与接口请求只校验令牌签名并查内存，不再计算哈希，也不查询 users。
+# 其他进程签发的令牌首次出现时按用户ID查一次 users，核对口令指纹、角色与药店后放入本进程的会话表；
+# 修改口令、删除用户、停用药店都会发布用户变更事件，各进程据此移除该用户的会话
+
+ALGORITHM = "pbkdf2_sha256"
+
+SECRET = (AUTH_CONFIG["secret"] or secrets.token_hex(32)).encode()
+
+_pool = ThreadPoolExecutor(max_workers=AUTH_CONFIG["hash_workers"], thread_name_prefix="auth-hash")
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def hash_password(password, iterations=None):
+    iterations = iterations or AUTH_CONFIG["pbkdf2_iterations"]
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{ALGORITHM}${iterations}${_b64(salt)}${_b64(digest)}"
+
+def verify_password(password, stored):
+    try:
+        algorithm, iterations, salt, digest = stored.split("$")
+        if algorithm != ALGORITHM:
+            return False
+        actual = hashlib.pbkdf2_hmac("sha256", password.encode(), _unb64(salt), int(iterations))
+    except (ValueError, AttributeError):
+        return False
+    return hmac.compare_digest(actual, _unb64(digest))
+
+# 迭代次数低于当前配置（配置调高过，或由 datagen.py 批量生成）的哈希在下次登录成功时重新计算
+def needs_rehash(stored):
+    try:
+        return int(stored.split("$")[1]) < AUTH_CONFIG["pbkdf2_iterations"]
+    except (IndexError, ValueError):
+        return True
+
+# 在工作线程池中计算，调用方阻塞等待结果
+def hash_password_async(password, iterations=None):
+    return _pool.submit(hash_password, password, iterations).result()
+
+def verify_password_async(password, stored):
+    return _pool.submit(verify_password, password, stored).result()
+
+# 批量哈希（迁移旧账号时使用），结果与输入顺序一致
+def hash_passwords(passwords, iterations=None):
+    return list(_pool.map(lambda password: hash_password(password, iterations), passwords))
+
+# 用户名不存在时也做一次同样代价（按配置的迭代次数）的校验，响应时间不暴露用户名是否存在
+_DUMMY_HASH = hash_password(secrets.token_hex(8))
+
+def _fingerprint(stored):
+    return _b64(hmac.new(SECRET, stored.encode(), hashlib.sha256).digest()[:9])
+
+def issue_token(user, stored):
+    expires_at = int(time.time()) + AUTH_CONFIG["session_ttl"]
+    body = _b64(json.dumps([user['user_id'], user['role'], user['pharmacy_id'], expires_at,
+                            _fingerprint(stored)]).encode())
+    signature = _b64(hmac.new(SECRET, body.encode(), hashlib.sha256).digest())
+    return f"{body}.{signature}", expires_at
+
+def _decode_token(token):
+    try:
+        body, signature = token.split(".")
+        expected = _b64(hmac.new(SECRET, body.encode(), hashlib.sha256).digest())
+        if not hmac.compare_digest(signature, expected):
+            return None
+        user_id, role, pharmacy_id, expires_at, fingerprint = json.loads(_unb64(body))
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if expires_at < time.time():
+        return None
+    return user_id, role, pharmacy_id, expires_at, fingerprint
+
+
+class SessionStore:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # 令牌 -> (用户, 过期时间)，按放入顺序淘汰
+        self._sessions = OrderedDict()
+        # 用户名 -> 令牌集合，用于按用户移除会话
+        self._by_username = {}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, token):
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is None or entry[1] < time.time():
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[0]
+
+    def put(self, token, user, expires_at):
+        with self._lock:
+            self._sessions[token] = (user, expires_at)
+            self._by_username.setdefault(user['username'], set()).add(token)
+            while len(self._sessions) > self.maxsize:
+                old_token, (old_user, _) = self._sessions.popitem(last=False)
+                self._discard_index(old_token, old_user['username'])
+
+    def _discard_index(self, token, username):
+        tokens = self._by_username.get(username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_username[username]
+
+    def remove(self, token):
+        with self._lock:
+            entry = self._sessions.pop(token, None)
+            if entry is not None:
+                self._discard_index(token, entry[0]['username'])
+
+    def remove_user(self, username):
+        with self._lock:
+            for token in self._by_username.pop(username, ()):
+                self._sessions.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._by_username.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "hits": self._hits, "misses": self._misses}
+
+
+sessions = SessionStore(AUTH_CONFIG["max_sessions"])
+
+# 所属药店已停用的账号不能登录
+USER_QUERY = """
+    SELECT user_id, username, password, role, pharmacy_id
+    FROM users u
+    WHERE {condition}
+    AND NOT EXISTS (SELECT 1 FROM pharmacies p WHERE p.pharmacy_id = u.pharmacy_id AND p.deleted_at IS NOT NULL)
+"""
+LOGIN = statements.register("login", USER_QUERY.format(condition="username = $1"))
+USER_BY_ID = statements.register("user_by_id", USER_QUERY.format(condition="user_id = $1"))
+
+def _public(row):
+    return {"user_id": row['user_id'], "username": row['username'], "role": row['role'], "pharmacy_id": row['pharmacy_id']}
+
+# 校验用户名与口令，成功返回 (会话令牌, 用户)，失败返回 None；迭代次数过低的哈希顺带升级
+def login(username, password):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            statements.execute(cur, LOGIN, (username,))
+            row = cur.fetchone()
+    if row is None:
+        verify_password_async(password, _DUMMY_HASH)
+        return None
+    if not verify_password_async(password, row['password']):
+        return None
+    stored = row['password']
+    if needs_rehash(stored):
+        upgraded = hash_password_async(password)
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE users SET password = %s WHERE user_id = %s AND password = %s",
+                            (upgraded, row['user_id'], stored))
+                if cur.rowcount:
+                    stored = upgraded
+    user = _public(row)
+    token, expires_at = issue_token(user, stored)
+    sessions.put(token, user, expires_at)
+    return token, user
+
+# 校验会话令牌，有效时返回用户，否则返回 None。本进程验证过的令牌只查内存
+def verify_session(token):
+    if not token:
+        return None
+    user = sessions.get(token)
+    if user is not None:
+        return user
+    decoded = _decode_token(token)
+    if decoded is None:
+        return None
+    user_id, role, pharmacy_id, expires_at, fingerprint = decoded
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            statements.execute(cur, USER_BY_ID, (user_id,))
+            row = cur.fetchone()
+    if (row is None or row['role'] != role or row['pharmacy_id'] != pharmacy_id
+            or not hmac.compare_digest(_fingerprint(row['password']), fingerprint)):
+        return None
+    user = _public(row)
+    sessions.put(token, user, expires_at)
+    return user
+
+def token_expires_at(token):
+    decoded = _decode_token(token)
+    return decoded[3] if decoded else None
+
+def logout(token):
+    sessions.remove(token)
+
+# 用户被修改、删除或所属药店被停用：移除本进程中该用户的全部会话，之后的令牌重新按数据库校验
+def revoke_user(username):
+    sessions.remove_user(username)
+
+def session_stats():
+    return sessions.stats()
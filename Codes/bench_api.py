@@ -0,0 +1,192 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import quote, urlparse
+
+from db import get_pool
+from loadtest import load_fixtures, percentile_ms
+
+# 收银接口压测：多个线程模拟收银终端，各自登录后在保持的连接上按编码查询、按编码销售，统计延迟分位数与吞吐；
+# 再用 streamlit.testing 在本进程内驱动销售页面完成同样的查询与销售，作为页面路径的对照。
+# 页面路径只计入服务端脚本重跑的时间（不含浏览器与 WebSocket），是页面延迟的下限
+
+OPERATION_WEIGHTS = {
+    "lookup": 3,
+    "sell": 1,
+}
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+def start_server(port):
+    process = subprocess.Popen([sys.executable, "api.py", "--host", "127.0.0.1", "--port", str(port)],
+                               cwd=os.path.dirname(APP_PATH), stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/api/health")
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit("接口进程启动超时")
+
+
+class Terminal:
+    def __init__(self, host, port, user):
+        self.conn = http.client.HTTPConnection(host, port, timeout=30)
+        status, body = self.call("POST", "/api/login",
+                                 {"username": user['username'], "password": f"{user['username']}@pw"})
+        if status != 200:
+            raise RuntimeError(f"登录失败：{user['username']} {body}")
+        self.token = body["token"]
+        status, body = self.call("GET", "/api/medicines")
+        self.codes = [m['code'] for m in body["medicines"] if m['code']]
+
+    def call(self, method, path, payload=None):
+        headers = {"Content-Type": "application/json"}
+        if getattr(self, "token", None):
+            headers["Authorization"] = f"Bearer {self.token}"
+        self.conn.request(method, path, json.dumps(payload) if payload is not None else None, headers)
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def lookup(self):
+        return self.call("GET", f"/api/medicines?code={quote(random.choice(self.codes))}")[0] == 200
+
+    def sell(self):
+        return self.call("POST", "/api/sell", {"code": random.choice(self.codes), "quantity": 1})[0] == 200
+
+
+def run_api(host, port, users, concurrency, duration, weights):
+    names = list(weights)
+    probs = [weights[n] for n in names]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    terminals = [Terminal(host, port, users[i % len(users)]) for i in range(concurrency)]
+    terminals = [t for t in terminals if t.codes]
+    start_barrier = threading.Barrier(len(terminals) + 1)
+
+    def worker(terminal):
+        local_lat = defaultdict(list)
+        local_err = defaultdict(int)
+        start_barrier.wait()
+        stop_at = time.perf_counter() + duration
+        while time.perf_counter() < stop_at:
+            name = random.choices(names, probs)[0]
+            begin = time.perf_counter()
+            try:
+                ok = getattr(terminal, name)()
+            except Exception:
+                ok = False
+            local_lat[name].append(time.perf_counter() - begin)
+            if not ok:
+                local_err[name] += 1
+        with lock:
+            for name, values in local_lat.items():
+                latencies[name].extend(values)
+            for name, count in local_err.items():
+                errors[name] += count
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in terminals]
+    for t in threads:
+        t.start()
+    start_barrier.wait()
+    begin = time.perf_counter()
+    for t in threads:
+        t.join()
+    return latencies, errors, time.perf_counter() - begin
+
+# 页面路径：同一会话内输入编码搜索（一次脚本重跑）、点击"销售"（销售后 st.rerun，共两次重跑）
+def run_streamlit(user, iterations, weights):
+    from streamlit.testing.v1 import AppTest
+    import auth
+    import data
+
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.session_state.session_token, at.session_state.user = auth.login(user['username'], f"{user['username']}@pw")
+    at.run()
+    codes = [m['code'] for m in data.get_medicines(user['pharmacy_id']) if m['code']]
+    names = list(weights)
+    probs = [weights[n] for n in names]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    begin_all = time.perf_counter()
+    for _ in range(iterations):
+        name = random.choices(names, probs)[0]
+        begin = time.perf_counter()
+        if name == "lookup":
+            at.text_input[0].input(random.choice(codes)).run()
+        else:
+            next(b for b in at.button if b.label == "销售").click().run()
+        latencies[name].append(time.perf_counter() - begin)
+        if at.exception or at.error:
+            errors[name] += 1
+    return latencies, errors, time.perf_counter() - begin_all
+
+def report(label, latencies, errors, elapsed):
+    print(f"[{label}]")
+    print(f"{'operation':<10} {'count':>8} {'errors':>7} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    total = 0
+    for name in OPERATION_WEIGHTS:
+        values = latencies.get(name, [])
+        if not values:
+            continue
+        total += len(values)
+        print(f"{name:<10} {len(values):>8} {errors.get(name, 0):>7} {len(values) / elapsed:>9.1f} "
+              f"{percentile_ms(values, 50):>9.2f} {percentile_ms(values, 95):>9.2f} {percentile_ms(values, 99):>9.2f}")
+    print(f"{'total':<10} {total:>8} {sum(errors.values()):>7} {total / elapsed:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="收银接口与页面销售路径的延迟对比压测")
+    parser.add_argument("--url", help="已启动的接口地址，如 http://127.0.0.1:8600；为空时自动启动一个接口进程")
+    parser.add_argument("--port", type=int, default=8601, help="自动启动接口进程时使用的端口")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发终端数")
+    parser.add_argument("--duration", type=float, default=20, help="接口压测秒数")
+    parser.add_argument("--ops", default=",".join(OPERATION_WEIGHTS),
+                        help="参与压测的操作，逗号分隔，可写成 name:weight 覆盖默认权重")
+    parser.add_argument("--streamlit-iterations", type=int, default=200, help="页面路径的操作次数，0 表示不测")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    weights = {}
+    for item in args.ops.split(","):
+        name, _, weight = item.partition(":")
+        if name not in OPERATION_WEIGHTS:
+            parser.error(f"未知操作 {name}，可选：{', '.join(OPERATION_WEIGHTS)}")
+        weights[name] = float(weight) if weight else OPERATION_WEIGHTS[name]
+
+    users, _ = load_fixtures(args.concurrency)
+    process = None
+    if args.url:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = "127.0.0.1", args.port
+        process = start_server(port)
+    try:
+        print(f"API Bench: {args.concurrency} terminals, {args.duration}s, http://{host}:{port}")
+        report("api", *run_api(host, port, users, args.concurrency, args.duration, weights))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.streamlit_iterations:
+        print(f"Streamlit Bench: 1 session, {args.streamlit_iterations} operations")
+        report("streamlit", *run_streamlit(users[0], args.streamlit_iterations, weights))
+    get_pool().closeall()
+
+if __name__ == "__main__":
+    main()
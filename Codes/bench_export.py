@@ -0,0 +1,103 @@
+import argparse
+import os
+import resource
+import tempfile
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+from db import get_conn
+import export
+import partitions
+
+BENCH_USER = "bench_export"
+
+def peak_rss_mb():
+    # Linux 下 ru_maxrss 的单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# 为压测用户生成 rows 条合成销售记录（在服务端用 generate_series 生成，不经过本进程内存）
+def ensure_rows(rows):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id FROM users WHERE username = %s", (BENCH_USER,))
+            row = cur.fetchone()
+            if row is None:
+                cur.execute("""
+                    INSERT INTO users (username, password, role, pharmacy_id)
+                    VALUES (%s, %s, 2, NULL) RETURNING user_id
+                """, (BENCH_USER, os.urandom(8).hex()))
+                row = cur.fetchone()
+            user_id = row['user_id']
+            cur.execute("SELECT COUNT(*) AS n FROM sales WHERE user_id = %s", (user_id,))
+            existing = cur.fetchone()['n']
+            if existing < rows:
+                # 合成记录的时间最早在一年前，先建好这些月份的分区
+                partitions.ensure_partitions(cur, first_month=date.today() - timedelta(days=366))
+                cur.execute("SELECT array_agg(medicine_id) AS ids FROM medicines")
+                medicine_ids = cur.fetchone()['ids']
+                cur.execute("""
+                    INSERT INTO sales (medicine_id, quantity, user_id, sale_time, unit_price, amount)
+                    SELECT g.medicine_id, g.quantity, %(user_id)s, g.sale_time, m.price, g.quantity * m.price
+                    FROM (
+                        SELECT (%(ids)s::int[])[1 + g %% array_length(%(ids)s::int[], 1)] AS medicine_id,
+                               1 + g %% 5 AS quantity,
+                               now() - (g %% 525600) * INTERVAL '1 minute' AS sale_time
+                        FROM generate_series(1, %(n)s) AS g
+                    ) g
+                    JOIN medicines m ON m.medicine_id = g.medicine_id
+                """, {"ids": medicine_ids, "user_id": user_id, "n": rows - existing})
+            return user_id
+
+def cleanup():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM sales WHERE user_id IN (SELECT user_id FROM users WHERE username = %s)", (BENCH_USER,))
+            cur.execute("DELETE FROM users WHERE username = %s", (BENCH_USER,))
+
+# 旧版做法：整个结果集读入 DataFrame，再 to_csv 成字符串并 encode
+def legacy_export(out, user_id):
+    query, params = export.build_query(user_id=user_id)
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            data = pd.DataFrame(cur.fetchall()).to_csv(index=False).encode("utf-8")
+    out.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description="销售记录导出的内存与吞吐压测")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--format", choices=list(export.FORMATS), default="csv")
+    parser.add_argument("--legacy", action="store_true", help="测量旧版 DataFrame 导出方式（行数大时可能耗尽内存）")
+    parser.add_argument("--cleanup", action="store_true", help="结束后删除合成数据")
+    args = parser.parse_args()
+
+    print(f"Generating {args.rows} synthetic sales rows...")
+    user_id = ensure_rows(args.rows)
+
+    # 峰值 RSS 只增不减，每次运行只测一种导出方式
+    baseline = peak_rss_mb()
+    fd, path = tempfile.mkstemp(suffix=export.FORMATS[args.format])
+    try:
+        begin = time.perf_counter()
+        with os.fdopen(fd, "wb") as out:
+            if args.legacy:
+                legacy_export(out, user_id)
+            else:
+                export.export_sales(out, args.format, user_id=user_id)
+        elapsed = time.perf_counter() - begin
+        size_mb = os.path.getsize(path) / 1e6
+    finally:
+        os.remove(path)
+
+    mode = "legacy-dataframe" if args.legacy else f"stream-{args.format}"
+    print(f"[{mode}] rows={args.rows} size={size_mb:.1f}MB elapsed={elapsed:.1f}s "
+          f"throughput={size_mb / elapsed:.1f}MB/s rows/s={args.rows / elapsed:.0f}")
+    print(f"[{mode}] peak_rss={peak_rss_mb():.1f}MB (baseline {baseline:.1f}MB)")
+
+    if args.cleanup:
+        cleanup()
+
+if __name__ == "__main__":
+    main()
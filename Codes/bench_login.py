@@ -0,0 +1,154 @@
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlparse
+
+import auth
+from config import AUTH_CONFIG
+from db import get_pool
+from bench_api import start_server
+from loadtest import load_fixtures, percentile_ms
+
+# 登录高峰压测：启动接口进程（或连接已启动的接口），用栅栏同时放出一批终端线程，各自在新连接上登录，
+# 统计每批登录的延迟分位数与吞吐；再用登录得到的令牌并发调用需要登录的接口，对比令牌校验的开销；
+# 最后在本进程内测量会话校验命中内存与首次按库校验的耗时。
+# 使用 datagen.py 生成的 gen_ 账号；其口令哈希的迭代次数较低，压测前先各登录一次，按当前配置升级哈希
+
+def post_login(host, port, user):
+    conn = http.client.HTTPConnection(host, port, timeout=120)
+    try:
+        conn.request("POST", "/api/login", json.dumps({"username": user['username'], "password": f"{user['username']}@pw"}),
+                     {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        body = json.loads(response.read())
+        return response.status, body.get("token")
+    finally:
+        conn.close()
+
+def upgrade_hashes(users):
+    begin = time.perf_counter()
+    for user in users:
+        auth.login(user['username'], f"{user['username']}@pw")
+    print(f"Upgrade {len(users)} Password Hashes Success! {time.perf_counter() - begin:.1f}s")
+
+# 一批 size 个终端同时登录，返回 (各次延迟, 失败数, 总耗时, 令牌)
+def run_burst(host, port, users, size):
+    latencies = []
+    tokens = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(size + 1)
+
+    def worker(user):
+        barrier.wait()
+        begin = time.perf_counter()
+        try:
+            status, token = post_login(host, port, user)
+        except OSError:
+            status, token = None, None
+        elapsed = time.perf_counter() - begin
+        with lock:
+            latencies.append(elapsed)
+            if status == 200:
+                tokens.append(token)
+            else:
+                errors.append(status)
+
+    threads = [threading.Thread(target=worker, args=(users[i % len(users)],)) for i in range(size)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    begin = time.perf_counter()
+    for t in threads:
+        t.join()
+    return latencies, len(errors), time.perf_counter() - begin, tokens
+
+# 每个令牌一个线程，在保持的连接上连续调用 calls 次按编码查询；查不到编码返回 404，同样经过完整的令牌校验
+def run_authed_calls(host, port, tokens, calls):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(token):
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        headers = {"Authorization": f"Bearer {token}"}
+        local, failed = [], 0
+        for _ in range(calls):
+            begin = time.perf_counter()
+            conn.request("GET", "/api/medicines?code=__bench_login__", headers=headers)
+            response = conn.getresponse()
+            response.read()
+            local.append(time.perf_counter() - begin)
+            if response.status not in (200, 404):
+                failed += 1
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=worker, args=(token,)) for token in tokens]
+    begin = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, sum(errors), time.perf_counter() - begin
+
+def measure_verify(user, iterations):
+    token, _ = auth.login(user['username'], f"{user['username']}@pw")
+    auth.sessions.clear()
+    begin = time.perf_counter()
+    auth.verify_session(token)
+    cold = time.perf_counter() - begin
+    begin = time.perf_counter()
+    for _ in range(iterations):
+        auth.verify_session(token)
+    warm = (time.perf_counter() - begin) / iterations
+    return cold, warm
+
+def report(label, latencies, errors, elapsed):
+    print(f"{label:<14} {len(latencies):>6} {errors:>7} {len(latencies) / elapsed:>9.1f} "
+          f"{percentile_ms(latencies, 50):>9.1f} {percentile_ms(latencies, 95):>9.1f} {max(latencies) * 1000:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="登录高峰与会话校验的延迟压测")
+    parser.add_argument("--url", help="已启动的接口地址，如 http://127.0.0.1:8600；为空时自动启动一个接口进程")
+    parser.add_argument("--port", type=int, default=8602, help="自动启动接口进程时使用的端口")
+    parser.add_argument("--bursts", default="20,50", help="每批同时登录的终端数，逗号分隔")
+    parser.add_argument("--users", type=int, default=50, help="参与登录的账号数，批大小超过时账号重复使用")
+    parser.add_argument("--calls", type=int, default=50, help="每个令牌连续调用需要登录的接口的次数")
+    parser.add_argument("--verify-iterations", type=int, default=100_000, help="本进程内会话校验的次数")
+    args = parser.parse_args()
+
+    users, _ = load_fixtures(args.users)
+    upgrade_hashes(users)
+    process = None
+    if args.url:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = "127.0.0.1", args.port
+        process = start_server(port)
+    try:
+        print(f"Login Bench: {len(users)} users, pbkdf2 {AUTH_CONFIG['pbkdf2_iterations']} iterations, "
+              f"{AUTH_CONFIG['hash_workers']} hash workers, http://{host}:{port}")
+        print(f"{'phase':<14} {'count':>6} {'errors':>7} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        tokens = []
+        for size in (int(s) for s in args.bursts.split(",")):
+            latencies, errors, elapsed, tokens = run_burst(host, port, users, size)
+            report(f"login x{size}", latencies, errors, elapsed)
+        if tokens and args.calls:
+            report("authed call", *run_authed_calls(host, port, tokens, args.calls))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    cold, warm = measure_verify(users[0], args.verify_iterations)
+    print(f"verify_session: first check {cold * 1000:.2f} ms (one users query), cached {warm * 1e6:.2f} us")
+    get_pool().closeall()
+
+if __name__ == "__main__":
+    main()
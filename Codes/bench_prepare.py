@@ -0,0 +1,114 @@
+import argparse
+import time
+
+import auth
+import data
+import rollups
+import sales
+import statements
+from db import get_conn, get_pool
+
+# 预备语句压测：对登记的热点语句，在同一个连接上分别以完整语句文本（每次解析、规划）与预备语句（EXECUTE 名称）
+# 各执行若干次，对比平均延迟；并用 EXPLAIN (SUMMARY) 取出每条语句文本方式下的服务端规划耗时，
+# 用 pg_prepared_statements 查看预备语句实际使用的通用计划与定制计划次数（PostgreSQL 14 及以上）。
+# 销售语句在每次执行后回滚，不改变库存
+
+# 取样本参数的 SQL，样本取真实存在的值
+SAMPLES = {
+    "pharmacy_id": "SELECT pharmacy_id FROM medicines GROUP BY pharmacy_id ORDER BY COUNT(*) DESC LIMIT 1",
+    "user_id": "SELECT user_id FROM sales_daily GROUP BY user_id ORDER BY SUM(sale_count) DESC LIMIT 1",
+    "username": "SELECT username FROM users ORDER BY user_id LIMIT 1",
+    "medicine_id": "SELECT medicine_id FROM medicines WHERE deleted_at IS NULL AND stock > 0 ORDER BY sales_count DESC LIMIT 1",
+}
+
+def load_samples():
+    samples = {}
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            for key, sql in SAMPLES.items():
+                cur.execute(sql)
+                row = cur.fetchone()
+                samples[key] = list(row.values())[0] if row else None
+    return samples
+
+# (语句名, 参数, 是否执行后回滚)
+def cases(samples):
+    first, following = sales.HISTORY_STATEMENTS["最近30天"]
+    return [
+        (auth.LOGIN, (samples["username"],), False),
+        (auth.USER_BY_ID, (samples["user_id"],), False),
+        (data.INVENTORY, (samples["pharmacy_id"],), False),
+        (data.SEARCH, (samples["pharmacy_id"], "%片%"), False),
+        (data.RECENT_SALES, (samples["medicine_id"], 10), False),
+        (first, (samples["user_id"], sales.HISTORY_PAGE_SIZE + 1), False),
+        (following, (samples["user_id"], sales.HISTORY_PAGE_SIZE + 1, "2100-01-01", 0), False),
+        (rollups.USER_TOTALS_STATEMENTS["最近30天"], (samples["user_id"],), False),
+        (sales.SELL, (samples["medicine_id"], 1, samples["user_id"]), True),
+    ]
+
+def run_case(conn, name, params, rollback, iterations, prepare):
+    with conn.cursor() as cur:
+        # 预热：预备方式下完成 PREPARE，并越过按参数生成定制计划的前几次执行
+        for _ in range(10):
+            statements.execute(cur, name, params, prepare=prepare)
+            cur.fetchall()
+            if rollback:
+                conn.rollback()
+        begin = time.perf_counter()
+        for _ in range(iterations):
+            statements.execute(cur, name, params, prepare=prepare)
+            cur.fetchall()
+            if rollback:
+                conn.rollback()
+        elapsed = time.perf_counter() - begin
+    conn.commit()
+    return elapsed / iterations
+
+# 文本方式下服务端的规划耗时（毫秒），只规划不执行
+def planning_ms(conn, name, params):
+    statement = statements.registered()[name]
+    with conn.cursor() as cur:
+        cur.execute(f"EXPLAIN (SUMMARY true, FORMAT json) {statement.text_sql}",
+                    {str(i + 1): v for i, v in enumerate(params)})
+        plan = list(cur.fetchone().values())[0][0]
+    conn.rollback()
+    return plan["Planning Time"]
+
+def plan_counts(conn):
+    with conn.cursor() as cur:
+        try:
+            cur.execute("SELECT name, generic_plans, custom_plans FROM pg_prepared_statements")
+        except Exception:
+            conn.rollback()
+            return {}
+        return {row['name']: (row['generic_plans'], row['custom_plans']) for row in cur.fetchall()}
+
+def main():
+    parser = argparse.ArgumentParser(description="预备语句与完整语句文本的规划开销对比压测")
+    parser.add_argument("--iterations", type=int, default=1000, help="每条语句每种方式的执行次数")
+    args = parser.parse_args()
+
+    samples = load_samples()
+    print(f"Prepare Bench: {args.iterations} executions per statement, samples {samples}")
+    print(f"{'statement':<22} {'plan ms':>8} {'text ms':>9} {'prepared ms':>12} {'saved':>7} {'generic/custom':>15}")
+    total_text = total_prepared = 0.0
+    with get_conn() as conn:
+        results = []
+        for name, params, rollback in cases(samples):
+            planned = planning_ms(conn, name, params)
+            text = run_case(conn, name, params, rollback, args.iterations, prepare=False)
+            prepared = run_case(conn, name, params, rollback, args.iterations, prepare=True)
+            results.append((name, planned, text, prepared))
+            total_text += text
+            total_prepared += prepared
+        counts = plan_counts(conn)
+    for name, planned, text, prepared in results:
+        generic, custom = counts.get(name, ("-", "-"))
+        print(f"{name:<22} {planned:>8.3f} {text * 1000:>9.3f} {prepared * 1000:>12.3f} "
+              f"{(1 - prepared / text) * 100:>6.1f}% {f'{generic}/{custom}':>15}")
+    print(f"{'total':<22} {'':>8} {total_text * 1000:>9.3f} {total_prepared * 1000:>12.3f} "
+          f"{(1 - total_prepared / total_text) * 100:>6.1f}%")
+    get_pool().closeall()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import replenish
+from config import REPLENISH_CONFIG
+
+# 补货计算压测：按给定的药品数 × 天数在内存中合成销售日汇总行（每个药品每天按概率有销量），
+# 分别计时全量统计、增量统计（新进入与移出窗口的日期）与全链调拨建议的向量化计算部分；
+# 加 --db 时再对当前数据库各运行一次全量与增量的 replenish.run，计入读取、写回的完整耗时
+
+def synthesize(medicines, days, density, pharmacies, seed):
+    rng = np.random.default_rng(seed)
+    rows = int(medicines * days * density)
+    medicine_ids = rng.integers(1, medicines + 1, rows)
+    ages = rng.integers(0, days, rows)
+    # 少数药品卖得快：日销量取对数正态分布
+    quantities = np.maximum(rng.lognormal(0.5, 1.0, rows), 1).astype(np.int64)
+    chain = pd.DataFrame({
+        "medicine_id": np.arange(1, medicines + 1),
+        "pharmacy_id": rng.integers(1, pharmacies + 1, medicines),
+        "name": pd.Series(rng.integers(0, medicines // pharmacies + 1, medicines)).astype(str),
+        "manufacturer": "",
+        "stock": rng.integers(0, 500, medicines),
+    })
+    return medicine_ids, ages, quantities, chain
+
+def timed(label, func):
+    begin = time.perf_counter()
+    result = func()
+    print(f"{label:<24} {time.perf_counter() - begin:>8.2f}s")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="补货统计与调拨建议的计算耗时压测")
+    parser.add_argument("--medicines", type=int, default=500_000, help="合成的药品数（全链 SKU 数）")
+    parser.add_argument("--days", type=int, default=REPLENISH_CONFIG["history_days"], help="合成的销售天数")
+    parser.add_argument("--density", type=float, default=0.1, help="每个药品每天有销量的概率")
+    parser.add_argument("--pharmacies", type=int, default=2000, help="合成的药店数，同款药品分布在各药店")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", action="store_true", help="另对当前数据库运行一次全量与增量的 replenish.run")
+    args = parser.parse_args()
+
+    medicine_ids, ages, quantities, chain = synthesize(args.medicines, args.days, args.density,
+                                                       args.pharmacies, args.seed)
+    print(f"Replenish Bench: {args.medicines} medicines x {args.days} days, {len(ages)} daily rows")
+    ids, deltas = timed("full stats", lambda: replenish.window_deltas(
+        medicine_ids, ages, quantities, REPLENISH_CONFIG["history_days"]))
+    frame = pd.DataFrame(deltas, index=ids)
+    timed("derive", lambda: replenish.derive(frame))
+
+    # 增量：前一天的统计加上新的一天，对应取回 age 为 0 以及刚移出两个窗口的日期
+    mask = np.isin(ages, [0, REPLENISH_CONFIG["velocity_days"], REPLENISH_CONFIG["history_days"]])
+    print(f"incremental rows: {mask.sum()}")
+    timed("incremental stats", lambda: replenish.window_deltas(medicine_ids[mask], ages[mask], quantities[mask], 1))
+
+    stats = frame.reindex(chain["medicine_id"], fill_value=0)
+    for column in ("velocity", "reorder_point", "target_stock"):
+        chain[column] = stats[column].to_numpy()
+    transfers = timed("transfers", lambda: replenish.suggest_transfers(chain))
+    print(f"transfers: {len(transfers)}, units: {int(transfers['quantity'].sum()) if len(transfers) else 0}")
+
+    if args.db:
+        for full in (True, False):
+            result = replenish.run(full)
+            if result is None:
+                print("Another Replenishment Run Is in Progress, Skip")
+                break
+            print(f"{'db full run' if full else 'db incremental run':<24} {result['seconds']:>8.2f}s "
+                  f"({result['medicines']} medicines, {result['transfers']} transfers)")
+
+if __name__ == "__main__":
+    main()
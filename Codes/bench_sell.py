@@ -0,0 +1,93 @@
+import argparse
+import threading
+import time
+
+from db import get_conn, get_pool
+import sales
+
+# 旧版"先查后改"的销售流程，仅用于对比演示超卖竞态
+def legacy_sell(conn, medicine_id, quantity, user_id):
+    with conn.cursor() as cur:
+        cur.execute("SELECT stock, price FROM medicines WHERE medicine_id = %s", (medicine_id,))
+        row = cur.fetchone()
+        if row and row['stock'] >= quantity:
+            cur.execute("UPDATE medicines SET stock = stock - %s WHERE medicine_id = %s", (quantity, medicine_id))
+            cur.execute("INSERT INTO sales (medicine_id, quantity, user_id, unit_price, amount) VALUES (%s, %s, %s, %s, %s)",
+                        (medicine_id, quantity, user_id, row['price'], quantity * row['price']))
+            return row
+        return None
+
+def create_bench_medicine(stock):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pharmacy_id FROM pharmacies ORDER BY pharmacy_id LIMIT 1")
+            pharmacy_id = cur.fetchone()['pharmacy_id']
+            cur.execute("SELECT user_id FROM users ORDER BY user_id LIMIT 1")
+            user_id = cur.fetchone()['user_id']
+            cur.execute("""
+                INSERT INTO medicines (name, manufacturer, code, price, stock, pharmacy_id)
+                VALUES ('压测药品', 'bench', %s, 1.0, %s, %s)
+                RETURNING medicine_id
+            """, (f"BENCH-{time.time_ns()}", stock, pharmacy_id))
+            return cur.fetchone()['medicine_id'], user_id
+
+def drop_bench_medicine(medicine_id):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM sales WHERE medicine_id = %s", (medicine_id,))
+            cur.execute("DELETE FROM medicines WHERE medicine_id = %s", (medicine_id,))
+
+def run(mode, threads, attempts, quantity, stock):
+    sell = sales.sell if mode == "atomic" else legacy_sell
+    medicine_id, user_id = create_bench_medicine(stock)
+    succeeded = [0] * threads
+    start_barrier = threading.Barrier(threads + 1)
+
+    def worker(idx):
+        start_barrier.wait()
+        for _ in range(attempts):
+            with get_conn() as conn:
+                if sell(conn, medicine_id, quantity, user_id):
+                    succeeded[idx] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    start_barrier.wait()
+    begin = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - begin
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT stock FROM medicines WHERE medicine_id = %s", (medicine_id,))
+            final_stock = cur.fetchone()['stock']
+            cur.execute("SELECT COALESCE(SUM(quantity), 0) AS sold FROM sales WHERE medicine_id = %s", (medicine_id,))
+            sold = cur.fetchone()['sold']
+    drop_bench_medicine(medicine_id)
+
+    total = sum(succeeded)
+    correct = final_stock >= 0 and final_stock == stock - sold
+    print(f"[{mode}] threads={threads} attempts={threads * attempts} sales={total} "
+          f"elapsed={elapsed:.3f}s rate={total / elapsed:.1f} sales/s")
+    print(f"[{mode}] initial_stock={stock} sold={sold} final_stock={final_stock} "
+          f"expected_final={stock - sold} -> {'OK' if correct else 'OVERSOLD/INCONSISTENT'}")
+    return correct
+
+def main():
+    parser = argparse.ArgumentParser(description="并发销售同一药品的压测")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--attempts", type=int, default=200, help="每个线程的销售次数")
+    parser.add_argument("--quantity", type=int, default=1)
+    parser.add_argument("--stock", type=int, default=1000, help="初始库存，小于总需求时可观察超卖")
+    parser.add_argument("--mode", choices=["atomic", "legacy", "both"], default="both")
+    args = parser.parse_args()
+
+    modes = ["legacy", "atomic"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        run(mode, args.threads, args.attempts, args.quantity, args.stock)
+    get_pool().closeall()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+# 页面交互压测：启动 streamlit 服务（或连接已启动的服务），像浏览器一样通过 WebSocket 收发 protobuf 消息，
+# 按控件标签模拟登录、搜索、选择、点击等操作，统计每次交互从发出请求到脚本运行结束的服务端耗时与下发字节数。
+# 控件位于 st.fragment 中时与浏览器一样只请求重跑该 fragment。服务端耗时取自每次脚本运行后下发的 page_profile
+# （自动启动时打开 browser.gatherUsageStats 以获得该消息；本客户端不会把它转发到任何地方）。
+# 需要 websockets 包（较新版本的 streamlit 已自带）；控件取值的编码方式随 streamlit 版本变化，这里按当前版本编写
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 控件类型 -> WidgetState 中的取值字段
+VALUE_FIELDS = {
+    "text_input": "string_value",
+    "text_area": "string_value",
+    "selectbox": "string_value",
+    "radio": "string_value",
+    "number_input": "double_value",
+    "checkbox": "bool_value",
+}
+
+def start_app(port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", "app.py", "--server.headless", "true",
+         "--server.port", str(port), "--browser.gatherUsageStats", "true"],
+        cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.3)
+    process.kill()
+    raise SystemExit("streamlit 服务启动超时")
+
+
+class UiSession:
+    def __init__(self, ws):
+        self.ws = ws
+        self.widgets = []
+        self.values = {}
+
+    # 发送一次重跑请求并接收消息直到脚本运行结束，返回 (往返秒数, 服务端脚本运行秒数, 下发字节数, 消息数)；
+    # 脚本中调用 st.rerun() 时一次交互包含多次脚本运行，服务端耗时为各次之和
+    def rerun(self, triggers=(), fragment_id=""):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = BackMsg()
+        state = msg.rerun_script
+        state.fragment_id = fragment_id
+        for widget_id, (field, value) in self.values.items():
+            widget = state.widget_states.widgets.add()
+            widget.id = widget_id
+            setattr(widget, field, value)
+        for widget_id in triggers:
+            widget = state.widget_states.widgets.add()
+            widget.id = widget_id
+            widget.trigger_value = True
+
+        begin = time.perf_counter()
+        self.ws.send(msg.SerializeToString())
+        received = messages = 0
+        exec_us = 0
+        while True:
+            data = self.ws.recv()
+            received += len(data)
+            messages += 1
+            forward = ForwardMsg()
+            forward.ParseFromString(data)
+            kind = forward.WhichOneof("type")
+            if kind == "new_session":
+                # 整页运行开始时先前收集的控件全部作废，只重跑 fragment 时作废这些 fragment 中的控件
+                rerun_ids = set(forward.new_session.fragment_ids_this_run)
+                self.widgets = [w for w in self.widgets if rerun_ids and w['fragment_id'] not in rerun_ids]
+            elif kind == "delta":
+                self._collect(forward.delta)
+            elif kind == "page_profile":
+                exec_us += forward.page_profile.exec_time
+            elif kind == "script_finished" and forward.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                return time.perf_counter() - begin, exec_us / 1e6, received, messages
+
+    def _collect(self, delta):
+        if delta.WhichOneof("type") != "new_element":
+            return
+        element = delta.new_element
+        kind = element.WhichOneof("type")
+        proto = getattr(element, kind)
+        if not hasattr(proto, "id") or not hasattr(proto, "label"):
+            return
+        # 片段重跑时同一控件会再次下发，以最新的为准
+        self.widgets = [w for w in self.widgets if w['id'] != proto.id]
+        self.widgets.append({"id": proto.id, "kind": kind, "label": proto.label,
+                             "fragment_id": delta.fragment_id, "form_id": getattr(proto, "form_id", "")})
+
+    def widget(self, label, nth=0):
+        matches = [w for w in self.widgets if w['label'] == label]
+        if len(matches) <= nth:
+            raise LookupError(f"页面上没有控件：{label}")
+        return matches[nth]
+
+    # 修改控件取值；表单内的控件不触发重跑，随提交按钮一起发送
+    def set(self, label, value, nth=0):
+        widget = self.widget(label, nth)
+        field = VALUE_FIELDS[widget['kind']]
+        if field == "double_value":
+            value = float(value)
+        elif field == "string_value":
+            value = str(value)
+        self.values[widget['id']] = (field, value)
+        if widget['form_id']:
+            return None
+        return self.rerun(fragment_id=widget['fragment_id'])
+
+    def click(self, label, nth=0):
+        widget = self.widget(label, nth)
+        return self.rerun(triggers=[widget['id']], fragment_id=widget['fragment_id'])
+
+
+def login(session, username, password):
+    session.rerun()
+    session.set("用户名", username)
+    session.set("密码", password)
+    session.click("登录")
+    session.values.clear()
+
+# 各角色页面上的一组典型交互：(名称, 操作函数)。销售员的交互会真实销售药品；管理员与药店管理员只做只读的交互
+def sales_interactions(session, medicines):
+    yield "search", lambda i: session.set("🔍 搜索药品 (名称/生产商/编码)", medicines[i % len(medicines)]['code'])
+    yield "select", lambda i: session.set("选择药品", medicines[i % len(medicines)]['label'])
+    yield "sell", lambda i: session.click("销售")
+    yield "add_to_cart", lambda i: session.click("加入购物车")
+    yield "checkout", lambda i: session.click("结算")
+    yield "history_page", lambda i: session.set("时间范围", ["今日", "最近7天", "最近30天", "全部"][i % 4])
+
+def manager_interactions(session, medicines):
+    yield "select_update", lambda i: session.set("选择药品ID进行更新", medicines[i % len(medicines)]['medicine_id'])
+    yield "confirm_toggle", lambda i: session.set("我理解这将永久删除所有关联数据", i % 2 == 0)
+    yield "select_delete", lambda i: session.set("选择要删除的药品ID", medicines[(i * 7) % len(medicines)]['medicine_id'])
+
+# 管理员的选择器先按ID查找（第 2 个查找框属于更新面板），只有一个匹配项时自动选中并载入更新表单
+def admin_interactions(session, user_ids, pharmacy_ids):
+    yield "users_page", lambda i: session.click("下一页")
+    yield "select_user", lambda i: session.set("查找用户（用户ID或用户名前缀）", user_ids[i % len(user_ids)], nth=1)
+    yield "to_pharmacies", lambda i: session.set("模块", "药店管理")
+    yield "select_pharm", lambda i: session.set("查找药店（药店ID或名称前缀）", pharmacy_ids[i % len(pharmacy_ids)], nth=1)
+    yield "to_users", lambda i: session.set("模块", "用户管理")
+
+def percentile_ms(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+def run_scenario(url, role, username, iterations):
+    from db import get_conn
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id, pharmacy_id FROM users WHERE username = %s", (username,))
+            user = cur.fetchone()
+            cur.execute("""
+                SELECT medicine_id, name, manufacturer, code FROM medicines
+                WHERE pharmacy_id = %s AND stock > 100 ORDER BY medicine_id LIMIT 50
+            """, (user['pharmacy_id'],))
+            medicines = cur.fetchall()
+            cur.execute("SELECT user_id FROM users WHERE pharmacy_id IS NOT NULL ORDER BY user_id LIMIT 50")
+            user_ids = [r['user_id'] for r in cur.fetchall()]
+            cur.execute("SELECT pharmacy_id FROM pharmacies ORDER BY pharmacy_id LIMIT 50")
+            pharmacy_ids = [r['pharmacy_id'] for r in cur.fetchall()]
+    for m in medicines:
+        m['label'] = f"{m['name']} | {m['manufacturer']} | {m['code']}"
+
+    from websockets.sync.client import connect
+
+    with connect(url.replace("http", "ws", 1).rstrip("/") + "/_stcore/stream", max_size=None) as ws:
+        session = UiSession(ws)
+        login(session, username, f"{username}@pw")
+        if role == "sales":
+            interactions = list(sales_interactions(session, medicines))
+        elif role == "manager":
+            interactions = list(manager_interactions(session, medicines))
+        else:
+            interactions = list(admin_interactions(session, user_ids, pharmacy_ids))
+        results = {name: [] for name, _ in interactions}
+        for i in range(iterations):
+            for name, action in interactions:
+                outcome = action(i)
+                if outcome is not None:
+                    results[name].append(outcome)
+    return results
+
+def report(role, results):
+    print(f"[{role}]")
+    print(f"{'interaction':<14} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'server p50':>11} {'server p95':>11} "
+          f"{'avg KB':>8} {'msgs':>6}")
+    for name, samples in results.items():
+        if not samples:
+            continue
+        times = [s[0] for s in samples]
+        server = [s[1] for s in samples]
+        print(f"{name:<14} {len(samples):>6} {percentile_ms(times, 50):>9.1f} {percentile_ms(times, 95):>9.1f} "
+              f"{percentile_ms(server, 50):>11.1f} {percentile_ms(server, 95):>11.1f} "
+              f"{np.mean([s[2] for s in samples]) / 1024:>8.1f} {np.mean([s[3] for s in samples]):>6.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="页面交互的服务端耗时与下发字节数")
+    parser.add_argument("--url", help="已启动的 streamlit 地址，如 http://127.0.0.1:8501；为空时自动启动")
+    parser.add_argument("--port", type=int, default=8599, help="自动启动时使用的端口")
+    parser.add_argument("--iterations", type=int, default=20, help="每种交互的重复次数")
+    parser.add_argument("--roles", default="sales,manager,admin")
+    parser.add_argument("--sales-user", default="sales")
+    parser.add_argument("--manager-user", default="manager")
+    parser.add_argument("--admin-user", default="admin")
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if not url:
+        process = start_app(args.port)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        users = {"sales": args.sales_user, "manager": args.manager_user, "admin": args.admin_user}
+        for role in args.roles.split(","):
+            report(role, run_scenario(url, role, users[role], args.iterations))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+if __name__ == "__main__":
+    main()
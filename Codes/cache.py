@@ -0,0 +1,123 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_CONFIG
+
+
+# 进程内按键缓存：键为元组，首元素是实体命名空间（如 "medicines"），其后是药店ID等作用域；
+# 每个条目有自己的过期时间，总条目数超过上限时按 LRU 淘汰
+class KeyedCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._misses += 1
+                return False, None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._expirations += 1
+                self._misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return True, value
+
+    # 只读查看，不计入命中统计也不影响 LRU 顺序
+    def peek(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._invalidations += 1
+
+    # 失效所有以 prefix 开头的键，例如 ("search", 3) 会失效药店3的全部搜索结果
+    def invalidate_prefix(self, prefix):
+        n = len(prefix)
+        with self._lock:
+            keys = [k for k in self._data if k[:n] == prefix]
+            for k in keys:
+                del self._data[k]
+            self._invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._data),
+                "max_size": self.maxsize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "invalidations": self._invalidations,
+            }
+
+
+cache = KeyedCache(CACHE_CONFIG["maxsize"])
+
+# 用法类似 st.cache_data：被装饰函数的位置参数构成键，键为 (namespace, *args)
+def cached(namespace, ttl):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (namespace,) + args
+            found, value = cache.get(key)
+            if found:
+                return value
+            value = func(*args)
+            cache.set(key, value, ttl)
+            return value
+        return wrapper
+    return decorator
+
+# 某药店的库存发生变化：只失效该药店的库存列表与搜索结果
+def invalidate_pharmacy(pharmacy_id):
+    cache.invalidate(("medicines", pharmacy_id))
+    cache.invalidate_prefix(("search", pharmacy_id))
+
+# 销售只改变库存数量与销售计数：原地更新已缓存的库存行，不丢弃整份库存列表；搜索结果是独立的行，直接失效。
+# counters 为 {medicine_id: (sales_count, last_sold_at)}，为空时只更新库存
+def update_inventory_stock(pharmacy_id, stocks, counters=None):
+    medicines = cache.peek(("medicines", pharmacy_id))
+    if medicines is not None:
+        for row in medicines:
+            if row['medicine_id'] in stocks:
+                row['stock'] = stocks[row['medicine_id']]
+            if counters and row['medicine_id'] in counters:
+                row['sales_count'], row['last_sold_at'] = counters[row['medicine_id']]
+    cache.invalidate_prefix(("search", pharmacy_id))
+
+def cache_stats():
+    return cache.stats()
@@ -6,4 +6,153 @@ DB_CONFIG = {
     "user": "gaussdb",
     # 必须与docker run的GS_PASSWORD参数值完全一致
     "password": "StrongPassword@1234567890"
-}
\ No newline at end of file
+}
+
+# 连接池配置
+POOL_CONFIG = {
+    "minconn": 2,
+    "maxconn": 20,
+    # 取连接时最长等待秒数，超时抛出 PoolExhausted
+    "timeout": 10,
+    # 空闲超过该秒数的连接在取出时先做存活检查，失效则重连
+    "health_check_interval": 30
+}
+
+# 进程内查询缓存配置，超过条目上限时按 LRU 淘汰
+CACHE_CONFIG = {
+    "maxsize": 4096
+}
+
+# 性能埋点配置：超过 slow_query_ms 毫秒的语句记入慢查询日志（参数已脱敏），内存中保留最近 slow_log_size 条
+PROFILER_CONFIG = {
+    "slow_query_ms": 200,
+    "slow_log_size": 200
+}
+
+# 销售表月度分区配置
+PARTITION_CONFIG = {
+    # 提前创建的未来月份分区数，init.py 与 partitions.py 都会补齐
+    "months_ahead": 3,
+    # 早于最近该月数的分区归档为 Parquet 文件后移出数据库
+    "retention_months": 24,
+    # 归档文件目录，相对于 Codes 目录
+    "archive_dir": "archive"
+}
+
+# 页面导出：结果先流式写入服务器上的导出目录，不超过 download_limit_mb 的文件才在页面上直接下载，
+# 更大的文件留在导出目录中（或在服务器上运行 python export.py），不经过 streamlit 进程的内存
+EXPORT_CONFIG = {
+    "download_limit_mb": 50,
+    # 导出目录，相对于 Codes 目录
+    "export_dir": "exports",
+    # 导出目录中超过该小时数的文件在下次导出时删除
+    "retention_hours": 24
+}
+
+# 多进程缓存一致性：mode 为 "notify"（LISTEN/NOTIFY）、"poll"（轮询 change_events 表，用于不支持 LISTEN 的数据库）、
+# "auto"（首次使用时探测数据库是否支持 LISTEN/NOTIFY，不支持时用 "poll"）或 "off"（单进程）
+NOTIFY_CONFIG = {
+    "mode": "auto",
+    "channel": "pharmacy_changes",
+    # 轮询模式下的轮询间隔与回看窗口（秒）
+    "poll_interval": 1.0,
+    "poll_overlap": 30,
+    # change_events 中事件的保留秒数
+    "retention_seconds": 600
+}
+
+# 收银终端 HTTP 接口（api.py）配置
+API_CONFIG = {
+    "host": "0.0.0.0",
+    "port": 8600,
+    # 单次批量销售的最大行数
+    "max_batch_lines": 200
+}
+
+# 后台分批删除任务（deletion.py）配置
+DELETION_CONFIG = {
+    # 每批删除的行数，每批单独提交
+    "batch_rows": 1000,
+    # 两批之间暂停的秒数，给收银的写入让出锁与 WAL 带宽
+    "pause": 0.05,
+    # 后台线程检查未完成任务的间隔秒数
+    "poll_interval": 10
+}
+
+# 登录与会话（auth.py）配置
+AUTH_CONFIG = {
+    # PBKDF2-SHA256 迭代次数，调高后旧口令在下次登录成功时自动按新次数重新哈希
+    "pbkdf2_iterations": 200_000,
+    # 计算口令哈希的工作线程数，限制登录高峰占用的 CPU，超出的登录排队等待
+    "hash_workers": 2,
+    # 会话令牌有效秒数
+    "session_ttl": 12 * 3600,
+    # 会话令牌签名密钥；为空时每次启动随机生成，多进程（页面、接口）部署时必须配置为相同的值
+    "secret": "",
+    # 每个进程内存中保留的已验证会话数上限
+    "max_sessions": 100_000
+}
+
+# 读写分离：一个主库加若干只读副本（流式复制的备库）。replicas 中每项为覆盖 DB_CONFIG 的连接参数（如只写 host、port），
+# 为空时所有读写都走主库。只读查询按副本当前占用的连接数选择负载最低的副本
+REPLICA_CONFIG = {
+    "replicas": [],
+    # 复制延迟超过该秒数（或无法连接）的副本暂不接收读请求，读请求回到主库
+    "max_lag_seconds": 5,
+    # 检查副本复制延迟的最短间隔秒数，由发起读请求的线程顺带检查
+    "lag_check_interval": 2,
+    # 写入后该秒数内，同一用户、药店的读请求仍走主库（读己之写）；应不小于 max_lag_seconds + lag_check_interval
+    "sticky_seconds": 10,
+    # 在副本上查询复制延迟秒数：已回放完收到的全部 WAL 且仍在接收时为 0，否则为距最后一次回放事务的秒数；
+    # openGauss 中对应的函数为 pg_last_xlog_receive_location / pg_last_xlog_replay_location
+    "lag_query": """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+                 AND pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END AS lag
+    """
+}
+
+# 本地销售日志（journal.py）：mode 为 "off"（直接写库）、"fallback"（数据库不可达时先记日志）或 "write_behind"（总是先记日志、立即确认）
+JOURNAL_CONFIG = {
+    "mode": "off",
+    # 日志目录，相对于 Codes 目录；每个进程占用其中一个槽位子目录
+    "dir": "journal",
+    # 后台线程把日志写库的间隔秒数
+    "flush_interval": 0.5,
+    # 每个写库事务包含的销售条数
+    "batch_size": 500,
+    # 数据库不可用时的重试间隔秒数
+    "retry_interval": 5,
+    # 已写库的日志键保留天数，保留期内重复回放同一段日志不会重复销售
+    "retention_days": 7
+}
+
+# 补货与调拨建议（replenish.py）配置
+REPLENISH_CONFIG = {
+    # 按最近多少天的日均销量计算销售速度
+    "velocity_days": 28,
+    # 按最近多少天的每日销量计算需求波动（标准差）
+    "history_days": 365,
+    # 补货到货天数
+    "lead_time_days": 3,
+    # 补货周期天数，补货量按补到 补货点 + 周期内销量 计算
+    "review_days": 7,
+    # 安全库存系数，1.65 约对应 95% 的到货前不断货概率
+    "service_z": 1.65,
+    # 库存可售天数超过该值的部分视为积压，可调拨给同款缺货的药店；没有销售的药品全部库存视为积压
+    "overstock_days": 90,
+    # 单条调拨建议的最小数量
+    "min_transfer": 5,
+    # 距上次全量重算超过该天数时做一次全量重算，纠正销售记录删除、迟到的离线销售造成的偏差
+    "full_rebuild_days": 7
+}
+
+# 命名预备语句（statements.py）配置
+STATEMENT_CONFIG = {
+    # 热点查询在每个连接上 PREPARE 一次、之后按名称 EXECUTE；经过事务级连接池中间件（如 PgBouncer 的 transaction 模式）时
+    # 同一会话的连接不固定，应设为 False，改为每次发送完整语句文本
+    "prepare": True
+}
@@ -0,0 +1,478 @@
+import os
+import threading
+from datetime import datetime
+
+import psycopg2
+
+from config import EXPORT_CONFIG
+from db import get_conn, get_read_conn, mark_written
+from cache import cache, cached, invalidate_pharmacy, update_inventory_stock
+import auth
+import notify
+import sales
+import export
+import importer
+import rollups
+import search_index
+import deletion
+import journal
+import replenish
+import statements
+
+# 页面与其他进程（压测、接口）共用的数据访问函数，不依赖 streamlit。
+# 只读查询通过 get_read_conn 走只读副本（见 db.py），写入后用 mark_written 标记涉及的用户、药店，
+# 之后一段时间内这些键的读取回到主库；其他进程的变更事件同样标记，避免从落后的副本重新加载缓存
+
+# 开启跨进程变更通知后，其他进程的写入会及时更新本进程的缓存，库存目录可以缓存得更久
+INVENTORY_TTL = 600 if notify.MODE != "off" else 60
+
+# 热点查询登记为预备语句（见 statements.py），每个连接只解析、规划一次
+INVENTORY = statements.register("inventory", """
+    SELECT medicine_id, name, manufacturer, code, price, stock, sales_count, last_sold_at
+    FROM medicines
+    WHERE pharmacy_id = $1 AND deleted_at IS NULL
+""")
+
+# 预备语句的结果列在 PREPARE 时固定，不用 SELECT *，表结构变化后语句仍然可用
+SEARCH = statements.register("search", """
+    SELECT medicine_id, name, manufacturer, code, price, stock, pharmacy_id, sales_count, last_sold_at
+    FROM medicines
+    WHERE pharmacy_id = $1 AND deleted_at IS NULL
+    AND (name ILIKE $2 OR manufacturer ILIKE $2 OR code ILIKE $2)
+""")
+
+RECENT_SALES = statements.register("recent_sales", """
+    SELECT s.sale_id, s.quantity, s.sale_time, u.username
+    FROM sales s
+    LEFT JOIN users u ON s.user_id = u.user_id
+    WHERE s.medicine_id = $1
+    ORDER BY s.sale_time DESC
+    LIMIT $2
+""")
+
+@cached("medicines", ttl=INVENTORY_TTL)
+def get_medicines(pharmacy_id):
+    with get_read_conn(("pharmacy", pharmacy_id)) as conn:
+        with conn.cursor() as cur:
+            statements.execute(cur, INVENTORY, (pharmacy_id,))
+            return cur.fetchall()
+
+@cached("search", ttl=INVENTORY_TTL)
+def search_medicines(pharmacy_id, keyword):
+    with get_read_conn(("pharmacy", pharmacy_id)) as conn:
+        with conn.cursor() as cur:
+            statements.execute(cur, SEARCH, (pharmacy_id, f'%{keyword}%'))
+            return cur.fetchall()
+
+# 优先使用内存搜索索引，索引未建立时回退到数据库查询
+def find_medicines(pharmacy_id, keyword):
+    results = search_index.search(pharmacy_id, keyword)
+    if results is None:
+        results = search_medicines(pharmacy_id, keyword)
+    return results
+
+# 按编码精确查找本药店的药品（扫码枪场景），与搜索共用内存索引，找不到返回 None
+def find_by_code(pharmacy_id, code):
+    medicines = get_medicines(pharmacy_id)
+    return search_index.ensure_index(pharmacy_id, medicines).by_code.get(code)
+
+# 按药店整理销售后的变化：{pharmacy_id: ({medicine_id: stock}, {medicine_id: (sales_count, last_sold_at)})}
+def _group_stock_changes(rows):
+    by_pharmacy = {}
+    for row in rows:
+        stocks, counters = by_pharmacy.setdefault(row['pharmacy_id'], ({}, {}))
+        stocks[row['medicine_id']] = row['stock']
+        if row.get('sales_count') is not None:
+            counters[row['medicine_id']] = (row['sales_count'], row['last_sold_at'])
+    return by_pharmacy
+
+# 销售后库存变化：rows 为带 medicine_id、pharmacy_id、stock 的行（可带 sales_count、last_sold_at），只更新对应药店的缓存与索引。
+# 行中的库存来自数据库，本进程还有未写库的日志销售（见 journal.py）时减去这部分数量
+def apply_stock_changes(rows):
+    for pharmacy_id, (stocks, counters) in _group_stock_changes(rows).items():
+        _patch_stock(pharmacy_id, journal.unflushed_stock(stocks), counters)
+
+def _patch_stock(pharmacy_id, stocks, counters=None):
+    mark_written(("pharmacy", pharmacy_id))
+    update_inventory_stock(pharmacy_id, stocks, counters)
+    search_index.update_stock(pharmacy_id, stocks)
+
+# 药品目录发生变化（增删改药品、删除药店）：失效该药店的缓存并丢弃其搜索索引
+def inventory_changed(pharmacy_id):
+    mark_written(("pharmacy", pharmacy_id))
+    invalidate_pharmacy(pharmacy_id)
+    search_index.discard(pharmacy_id)
+
+# 其他进程发布的变更事件（见 notify.py），由监听线程调用，只更新本进程的缓存与索引
+def apply_change_event(event):
+    entity = event["entity"]
+    if entity == "stock":
+        counters = event.get("counters", {})
+        rows = []
+        for mid, stock in event["stocks"].items():
+            row = {"pharmacy_id": event["pharmacy_id"], "medicine_id": int(mid), "stock": stock}
+            if mid in counters:
+                row['sales_count'] = counters[mid][0]
+                row['last_sold_at'] = datetime.fromisoformat(counters[mid][1])
+            rows.append(row)
+        apply_stock_changes(rows)
+    elif entity == "inventory":
+        inventory_changed(event["pharmacy_id"])
+    elif entity == "user":
+        mark_written(("users",))
+        for username in event["usernames"]:
+            auth.revoke_user(username)
+    elif entity == "reset":
+        cache.clear()
+        search_index.clear()
+
+def start_change_listener():
+    return notify.start_listener(apply_change_event)
+
+# 在写事务中为库存变化发布事件，每个药店一条
+def publish_stock_changes(conn, rows):
+    with conn.cursor() as cur:
+        for pharmacy_id, (stocks, counters) in _group_stock_changes(rows).items():
+            notify.publish(cur, notify.stock_event(pharmacy_id, stocks, counters))
+
+# 日志销售的库存校验与预扣，保证同一进程内并发的日志销售不会超卖
+_journal_lock = threading.Lock()
+
+# 先记本地日志再确认的销售（见 journal.py）：按缓存中的库存校验并预扣，日志落盘后即返回，由后台线程写库。
+# 库存不足或药品不在本药店时抛出 sales.InsufficientStock；缓存中没有本药店库存时加载，数据库不可达则抛出原错误。
+# 返回 {medicine_id: 行}，行中 stock 为预扣后的库存，sale_id 为空，pending 为真
+def _journal_sales(pharmacy_id, lines, user_id):
+    merged = {}
+    for medicine_id, quantity in lines:
+        if quantity > 0:
+            merged[medicine_id] = merged.get(medicine_id, 0) + quantity
+    medicines = cache.peek(("medicines", pharmacy_id))
+    if medicines is None:
+        medicines = get_medicines(pharmacy_id)
+    rows = search_index.ensure_index(pharmacy_id, medicines).rows
+    sold_at = datetime.now()
+    with _journal_lock:
+        short = {mid for mid, quantity in merged.items() if mid not in rows or rows[mid]['stock'] < quantity}
+        if short:
+            raise sales.InsufficientStock(short)
+        records = [journal.make_record(mid, quantity, user_id, pharmacy_id, rows[mid]['price'], sold_at)
+                   for mid, quantity in merged.items()]
+        journal.reserve(records)
+        _patch_stock(pharmacy_id, {mid: rows[mid]['stock'] - quantity for mid, quantity in merged.items()})
+    try:
+        journal.append(records)
+    except OSError:
+        with _journal_lock:
+            journal.release(records)
+            _patch_stock(pharmacy_id, {mid: rows[mid]['stock'] + quantity for mid, quantity in merged.items()})
+        raise
+    return {r['medicine_id']: {"sale_id": None, "sale_time": sold_at, "medicine_id": r['medicine_id'],
+                               "pharmacy_id": pharmacy_id, "stock": rows[r['medicine_id']]['stock'],
+                               "pending": True, "journal_key": r['key']} for r in records}
+
+# write_behind 模式总是记日志；fallback 模式在取不到连接或语句执行失败时改记日志。
+# 提交时出错则无法确定是否已写入，不改记日志，否则可能重复销售
+def _use_journal(pharmacy_id, error=None, executed=False):
+    if pharmacy_id is None or not journal.enabled():
+        return False
+    if error is None:
+        return journal.MODE == "write_behind"
+    return journal.MODE == "fallback" and not executed
+
+# 成功返回销售结果（含销售后库存），库存不足或药品不存在返回 None。
+# 传入 pharmacy_id 时可以改记本地日志（见 journal.py），此时结果中 pending 为真、sale_id 为空
+def sell_medicine(medicine_id, quantity, user_id, pharmacy_id=None):
+    if quantity <= 0:
+        return None
+    if _use_journal(pharmacy_id):
+        return _journal_sell(pharmacy_id, medicine_id, quantity, user_id)
+    executed = False
+    try:
+        with get_conn() as conn:
+            result = sales.sell(conn, medicine_id, quantity, user_id)
+            if result:
+                publish_stock_changes(conn, [result])
+            executed = True
+    except journal.UNAVAILABLE_ERRORS as e:
+        if not _use_journal(pharmacy_id, e, executed):
+            raise
+        return _journal_sell(pharmacy_id, medicine_id, quantity, user_id)
+    if result:
+        # 只更新本药店的库存缓存与索引，其他药店不受影响；收银员的销售记录随后从主库读取
+        mark_written(("user", user_id))
+        apply_stock_changes([result])
+    return result
+
+def _journal_sell(pharmacy_id, medicine_id, quantity, user_id):
+    try:
+        return _journal_sales(pharmacy_id, [(medicine_id, quantity)], user_id)[medicine_id]
+    except sales.InsufficientStock:
+        return None
+
+# 购物车一次性结算，任一药品库存不足时抛出 sales.InsufficientStock 且整体回滚；pharmacy_id 的含义同 sell_medicine
+def checkout_medicines(lines, user_id, pharmacy_id=None):
+    if _use_journal(pharmacy_id):
+        return _journal_sales(pharmacy_id, lines, user_id)
+    executed = False
+    try:
+        with get_conn() as conn:
+            result = sales.checkout(conn, lines, user_id)
+            publish_stock_changes(conn, result.values())
+            executed = True
+    except journal.UNAVAILABLE_ERRORS as e:
+        if not _use_journal(pharmacy_id, e, executed):
+            raise
+        return _journal_sales(pharmacy_id, lines, user_id)
+    mark_written(("user", user_id))
+    apply_stock_changes(result.values())
+    return result
+
+# 每个进程启动一次本地销售日志的后台写库线程，并接手异常退出的进程遗留的日志；
+# 写库后的库存变化与普通销售一样在事务中发布事件，提交后更新本进程的缓存
+def start_journal():
+    return journal.start(publish_stock_changes, _journal_applied)
+
+def _journal_applied(records, rows):
+    mark_written(*{("user", r['user_id']) for r in records})
+    apply_stock_changes(rows)
+
+# 本药店未处理的日志写库冲突（库存不足、药品已删除），pharmacy_id 为空时列出全部药店
+def journal_conflicts(pharmacy_id=None):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            return journal.list_conflicts(cur, pharmacy_id)
+
+def resolve_journal_conflicts(journal_keys, pharmacy_id=None):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            return journal.resolve_conflicts(cur, journal_keys, pharmacy_id)
+
+# 流式导出到服务器上的导出目录，返回 (文件路径, 是否可以在页面上直接下载)，不读取文件内容；
+# 只有不超过 EXPORT_CONFIG["download_limit_mb"] 的文件才由页面读入并下载
+def export_sales_file(fmt, **filters):
+    path = export.export_sales_to_file(fmt, **filters)
+    return path, os.path.getsize(path) <= EXPORT_CONFIG["download_limit_mb"] * 1e6
+
+# 销售报表全部读汇总表；汇总表随销售实时更新，短暂缓存只为避免同一页面反复刷新时重复查询。
+# 报表容忍副本几秒的延迟，不做读己之写
+@cached("report", ttl=30)
+def sales_report(start, end, pharmacy_id):
+    with get_read_conn() as conn:
+        return {
+            "by_day": rollups.revenue_by_day(conn, start, end, pharmacy_id),
+            "by_pharmacy": [] if pharmacy_id else rollups.revenue_by_pharmacy(conn, start, end),
+            "top_medicines": rollups.top_medicines(conn, start, end, pharmacy_id),
+            "by_hour": rollups.sales_by_hour(conn, start, end, pharmacy_id),
+        }
+
+# 补货统计与调拨建议由 replenish.py 定时计算，一天内只有调拨建议随库存刷新，缓存 10 分钟，读副本即可
+@cached("replenish_run", ttl=600)
+def replenishment_last_run():
+    with get_read_conn() as conn:
+        with conn.cursor() as cur:
+            return replenish.last_run(cur)
+
+@cached("replenish", ttl=600)
+def replenishment_stats(pharmacy_id):
+    with get_read_conn() as conn:
+        with conn.cursor() as cur:
+            return replenish.pharmacy_stats(cur, pharmacy_id)
+
+# pharmacy_id 为空时列出全链的调拨建议
+@cached("transfers", ttl=600)
+def transfer_suggestions(pharmacy_id=None):
+    with get_read_conn() as conn:
+        with conn.cursor() as cur:
+            return replenish.list_transfers(cur, pharmacy_id)
+
+@cached("replenish_summary", ttl=600)
+def replenishment_summary():
+    with get_read_conn() as conn:
+        with conn.cursor() as cur:
+            return replenish.pharmacy_summary(cur)
+
+# 在本进程中运行一次补货计算（增量），完成后失效本进程的补货缓存；其他进程的缓存按过期时间刷新。
+# 另一个计算正在进行时返回 None
+def run_replenishment(full=False):
+    result = replenish.run(full)
+    if result is not None:
+        for namespace in ("replenish_run", "replenish", "transfers", "replenish_summary"):
+            cache.invalidate_prefix((namespace,))
+    return result
+
+# 批量导入药品后统一失效一次本药店的缓存
+def import_medicines_file(file, filename, pharmacy_id):
+    result = importer.import_medicines(file, filename, pharmacy_id)
+    inventory_changed(pharmacy_id)
+    return result
+
+# 用户名已存在或其他约束冲突时返回 False。口令在打开连接前哈希，慢计算期间不占用连接；
+# 更新时 password 为空表示不修改口令
+def manage_users(action, **kwargs):
+    password_hash = auth.hash_password_async(kwargs['password']) if kwargs.get('password') else None
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            try:
+                # 需要移除会话的用户名，提交后再移除，避免其他会话在提交前按旧数据重新校验
+                stale_usernames = []
+                if action == "add":
+                    cur.execute("INSERT INTO users (username, password, role, pharmacy_id) VALUES (%s, %s, %s, %s)",
+                                (kwargs['username'], password_hash, kwargs['role'], kwargs['pharmacy_id']))
+                elif action == "delete":
+                    cur.execute("DELETE FROM users WHERE user_id = %s RETURNING username", (kwargs['user_id'],))
+                    stale_usernames = [row['username'] for row in cur.fetchall()]
+                elif action == "update":
+                    cur.execute("SELECT username FROM users WHERE user_id = %s", (kwargs['user_id'],))
+                    # 旧用户名与新用户名的会话都要移除
+                    stale_usernames = [row['username'] for row in cur.fetchall()] + [kwargs['username']]
+                    cur.execute("""
+                        UPDATE users SET username = %s, password = COALESCE(%s, password), role = %s, pharmacy_id = %s
+                        WHERE user_id = %s
+                    """, (kwargs['username'], password_hash, kwargs['role'], kwargs['pharmacy_id'], kwargs['user_id']))
+                if stale_usernames:
+                    notify.publish(cur, notify.user_event(stale_usernames))
+                conn.commit()
+                mark_written(("users",))
+                for username in stale_usernames:
+                    auth.revoke_user(username)
+            except psycopg2.IntegrityError:
+                conn.rollback()
+                return False
+    return True
+
+def manage_pharmacies(action, **kwargs):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if action == "add":
+                cur.execute("INSERT INTO pharmacies (name, address) VALUES (%s, %s)", (kwargs['name'], kwargs['address']))
+            elif action == "update":
+                cur.execute("UPDATE pharmacies SET name = %s, address = %s WHERE pharmacy_id = %s",
+                            (kwargs['name'], kwargs['address'], kwargs['pharmacy_id']))
+            conn.commit()
+    mark_written(("pharmacies",))
+
+# 药品下架、药店停用后失效相关缓存：本进程直接失效，其他进程通过在事务中发布的事件失效
+def _publish_target_change(cur, pharmacy_id, usernames):
+    notify.publish(cur, notify.inventory_event(pharmacy_id))
+    if usernames:
+        notify.publish(cur, notify.user_event(usernames))
+
+def _apply_target_change(pharmacy_id, usernames):
+    inventory_changed(pharmacy_id)
+    mark_written(("pharmacies",))
+    for username in usernames:
+        auth.revoke_user(username)
+
+# 软删除药品（entity="medicine"）或药店（entity="pharmacy"）：立即从目录、搜索、销售与登录中隐藏（药店账号的会话随之失效），历史销售保持不变。
+# 对象不存在或已软删除时返回 False
+def soft_delete(entity, target_id):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            pharmacy_id, usernames = deletion.soft_delete(cur, entity, target_id)
+            if pharmacy_id is not None:
+                _publish_target_change(cur, pharmacy_id, usernames)
+        conn.commit()
+    if pharmacy_id is None:
+        return False
+    _apply_target_change(pharmacy_id, usernames)
+    return True
+
+# 撤销软删除，已登记彻底删除任务的对象不能恢复，返回 False
+def restore(entity, target_id):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            pharmacy_id, usernames = deletion.restore(cur, entity, target_id)
+            if pharmacy_id is not None:
+                _publish_target_change(cur, pharmacy_id, usernames)
+        conn.commit()
+    if pharmacy_id is None:
+        return False
+    _apply_target_change(pharmacy_id, usernames)
+    return True
+
+# 彻底删除：先软删除，再登记后台分批删除任务并唤醒本进程的删除线程，返回任务号（对象不存在时为 None）
+def start_deletion(entity, target_id, user_id=None):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            pharmacy_id, usernames = deletion.soft_delete(cur, entity, target_id)
+            if pharmacy_id is not None:
+                _publish_target_change(cur, pharmacy_id, usernames)
+            job_id = deletion.create_job(cur, entity, target_id, user_id)
+        conn.commit()
+    if pharmacy_id is not None:
+        _apply_target_change(pharmacy_id, usernames)
+    deletion.wake_worker()
+    return job_id
+
+def deletion_jobs(pharmacy_id=None, entity=None, limit=20):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            return deletion.list_jobs(cur, pharmacy_id, entity, limit)
+
+# 已软删除、尚未登记彻底删除的药品（给定 pharmacy_id）或药店，供恢复或彻底删除
+def list_soft_deleted(entity, pharmacy_id=None):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if entity == "medicine":
+                cur.execute("""
+                    SELECT medicine_id, name, code, sales_count, deleted_at FROM medicines m
+                    WHERE pharmacy_id = %s AND deleted_at IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM deletion_jobs j
+                                    WHERE j.entity = 'medicine' AND j.target_id = m.medicine_id AND j.status <> 'done')
+                    ORDER BY deleted_at DESC
+                """, (pharmacy_id,))
+            else:
+                cur.execute("""
+                    SELECT pharmacy_id, name, address, deleted_at FROM pharmacies p
+                    WHERE deleted_at IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM deletion_jobs j
+                                    WHERE j.entity = 'pharmacy' AND j.target_id = p.pharmacy_id AND j.status <> 'done')
+                    ORDER BY deleted_at DESC
+                """)
+            return cur.fetchall()
+
+# 每个进程启动一次后台删除线程，接手本进程登记的任务以及其他进程中断的任务
+def start_deletion_worker():
+    return deletion.start_worker(lambda pharmacy_ids: [inventory_changed(p) for p in pharmacy_ids])
+
+# 删除面板中某药品最近的销售记录预览，只在用户展开预览时查询
+def recent_sales_of(medicine_id, limit=10):
+    with get_read_conn() as conn:
+        with conn.cursor() as cur:
+            statements.execute(cur, RECENT_SALES, (medicine_id, limit))
+            return cur.fetchall()
+
+# 普通删除时若药品仍被销售记录引用（缓存中的销售计数落后于数据库）返回 False，并失效该药店的缓存以取回最新计数
+def manage_medicines(action, **kwargs):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if action == "delete":
+                try:
+                    cur.execute("DELETE FROM medicines WHERE medicine_id = %s RETURNING pharmacy_id", (kwargs['medicine_id'],))
+                except psycopg2.errors.ForeignKeyViolation:
+                    conn.rollback()
+                    cur.execute("SELECT pharmacy_id FROM medicines WHERE medicine_id = %s", (kwargs['medicine_id'],))
+                    for row in cur.fetchall():
+                        inventory_changed(row['pharmacy_id'])
+                    return False
+                pharmacy_ids = [row['pharmacy_id'] for row in cur.fetchall()]
+            elif action == "add":
+                cur.execute("""
+                    INSERT INTO medicines (name, manufacturer, code, price, stock, pharmacy_id)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, (kwargs['name'], kwargs['manufacturer'], kwargs['code'], kwargs['price'], kwargs['stock'], kwargs['pharmacy_id']))
+                pharmacy_ids = [kwargs['pharmacy_id']]
+            elif action == "update":
+                cur.execute("""
+                    UPDATE medicines 
+                    SET name = %s, manufacturer = %s, code = %s, price = %s, stock = %s
+                    WHERE medicine_id = %s
+                    RETURNING pharmacy_id
+                """, (kwargs['name'], kwargs['manufacturer'], kwargs['code'], kwargs['price'], kwargs['stock'], kwargs['medicine_id']))
+                pharmacy_ids = [row['pharmacy_id'] for row in cur.fetchall()]
+            for pharmacy_id in pharmacy_ids:
+                notify.publish(cur, notify.inventory_event(pharmacy_id))
+            conn.commit()
+            for pharmacy_id in pharmacy_ids:
+                inventory_changed(pharmacy_id)
+    return True
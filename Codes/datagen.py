@@ -0,0 +1,170 @@
+import argparse
+import io
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from config import DB_CONFIG
+import auth
+import partitions
+import rollups
+
+# 合成数据生成器：按连锁规模生成药店、用户、药品与销售记录，全部通过 COPY 批量写入。
+# 生成的用户名为 gen_<user_id>，密码为 <用户名>@pw，与初始数据的账号规则一致，便于压测登录。
+# 口令哈希默认只用很少的迭代次数以免生成大量账号时耗时过长，这些账号首次登录成功时按当前配置重新哈希
+
+DRUG_NAMES = [
+    "阿莫西林胶囊", "板蓝根颗粒", "布洛芬缓释胶囊", "复方丹参片", "维生素C片", "连花清瘟胶囊",
+    "藿香正气水", "阿司匹林肠溶片", "头孢克肟分散片", "盐酸左氧氟沙星胶囊", "感冒灵颗粒", "蒙脱石散",
+    "氯雷他定片", "奥美拉唑肠溶胶囊", "二甲双胍片", "硝苯地平缓释片", "健胃消食片", "六味地黄丸",
+    "甲硝唑片", "对乙酰氨基酚片", "小儿氨酚黄那敏颗粒", "复方甘草片", "葡萄糖酸钙口服液", "云南白药气雾剂",
+]
+MANUFACTURERS = [
+    "云南白药", "同仁堂", "中美天津史克", "广州白云山", "养生堂", "以岭药业", "太极集团", "拜耳医药",
+    "白云山制药", "第一三共制药", "华润三九", "修正药业", "扬子江药业", "石药集团", "哈药集团", "江中制药",
+]
+SPECS = ["0.25g*24粒", "10g*20袋", "0.3g*20粒", "100片", "12粒", "0.5g*36片", "10ml*10支", "60片"]
+
+# 一天 24 小时的销售权重：上午与傍晚两个高峰，夜间极少
+HOUR_WEIGHTS = np.array([1, 1, 1, 1, 1, 2, 4, 8, 12, 16, 16, 14, 11, 10, 10, 11, 13, 16, 17, 15, 11, 7, 4, 2], dtype=float)
+
+def copy_frame(cur, table, frame):
+    buf = io.StringIO()
+    frame.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+def next_id(cur, table, column):
+    cur.execute(f"SELECT COALESCE(MAX({column}), 0) + 1 FROM {table}")
+    return cur.fetchone()[0]
+
+def sync_sequence(cur, table, column):
+    cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), (SELECT MAX({column}) FROM {table}))")
+
+def generate(pharmacies, medicines, sales, users_per_pharmacy, days, chunk_rows, seed, password_iterations):
+    rng = np.random.default_rng(seed)
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+
+    # 药店
+    first_pharmacy = next_id(cur, "pharmacies", "pharmacy_id")
+    pharmacy_ids = np.arange(first_pharmacy, first_pharmacy + pharmacies)
+    copy_frame(cur, "pharmacies", pd.DataFrame({
+        "pharmacy_id": pharmacy_ids,
+        "name": [f"连锁分店{i}" for i in pharmacy_ids],
+        "address": [f"第{i % 300 + 1}街道{i}号" for i in pharmacy_ids],
+    }))
+    sync_sequence(cur, "pharmacies", "pharmacy_id")
+    conn.commit()
+    print(f"Insert {pharmacies} Pharmacies Success!")
+
+    # 用户：每个药店 1 名药店管理员，其余为销售员；第 p 个药店的用户连续编号
+    first_user = next_id(cur, "users", "user_id")
+    user_ids = np.arange(first_user, first_user + pharmacies * users_per_pharmacy)
+    user_pharmacy = np.repeat(pharmacy_ids, users_per_pharmacy)
+    usernames = [f"gen_{i}" for i in user_ids]
+    copy_frame(cur, "users", pd.DataFrame({
+        "user_id": user_ids,
+        "username": usernames,
+        "password": [auth.hash_password(f"{name}@pw", password_iterations) for name in usernames],
+        "role": np.where(np.arange(len(user_ids)) % users_per_pharmacy == 0, 1, 2),
+        "pharmacy_id": user_pharmacy,
+    }))
+    sync_sequence(cur, "users", "user_id")
+    conn.commit()
+    print(f"Insert {len(user_ids)} Users Success!")
+
+    # 药品：第 i 个药品属于第 i % pharmacies 个药店，编码全局唯一
+    first_medicine = next_id(cur, "medicines", "medicine_id")
+    prices = np.round(rng.uniform(3, 300, medicines), 2)
+    for start in range(0, medicines, chunk_rows):
+        idx = np.arange(start, min(start + chunk_rows, medicines))
+        ids = first_medicine + idx
+        names = np.array(DRUG_NAMES)[rng.integers(0, len(DRUG_NAMES), len(idx))]
+        specs = np.array(SPECS)[rng.integers(0, len(SPECS), len(idx))]
+        copy_frame(cur, "medicines", pd.DataFrame({
+            "medicine_id": ids,
+            "name": np.char.add(np.char.add(names, " "), specs),
+            "manufacturer": np.array(MANUFACTURERS)[rng.integers(0, len(MANUFACTURERS), len(idx))],
+            "code": [f"GEN{i:09d}" for i in ids],
+            "price": prices[idx],
+            "stock": rng.integers(50, 5000, len(idx)),
+            "pharmacy_id": pharmacy_ids[idx % pharmacies],
+        }))
+        conn.commit()
+    sync_sequence(cur, "medicines", "medicine_id")
+    conn.commit()
+    print(f"Insert {medicines} Medicines Success!")
+
+    # 销售记录：药品热度服从长尾分布；越接近现在销量越高（门店增长）；一天内按 HOUR_WEIGHTS 分布。
+    # 装载期间停用汇总触发器，装载完成后按日期范围一次性回填汇总表；先为最早的销售日期起的各月份建好分区
+    hour_p = HOUR_WEIGHTS / HOUR_WEIGHTS.sum()
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    partitions.ensure_partitions(cur, first_month=(today - timedelta(days=days - 1)).date())
+    cur.execute("ALTER TABLE sales DISABLE TRIGGER sales_rollup")
+    conn.commit()
+    origin = np.datetime64(today - timedelta(days=days - 1), "s")
+    now = np.datetime64(datetime.now(), "s")
+    loaded = 0
+    begin = time.perf_counter()
+    try:
+        while loaded < sales:
+            n = min(chunk_rows, sales - loaded)
+            medicine_idx = np.minimum((medicines * rng.random(n) ** 3).astype(np.int64), medicines - 1)
+            pharmacy_idx = medicine_idx % pharmacies
+            # 每个药店的第 0 个用户是药店管理员，销售由其余销售员完成
+            user_idx = pharmacy_idx * users_per_pharmacy + rng.integers(1, users_per_pharmacy, n)
+            day = np.minimum((days * np.sqrt(rng.random(n))).astype(np.int64), days - 1)
+            seconds = day * 86400 + rng.choice(24, n, p=hour_p) * 3600 + rng.integers(0, 3600, n)
+            quantity = rng.geometric(0.6, n)
+            copy_frame(cur, "sales", pd.DataFrame({
+                "medicine_id": first_medicine + medicine_idx,
+                "quantity": quantity,
+                "sale_time": np.minimum(origin + seconds.astype("timedelta64[s]"), now),
+                "user_id": user_ids[user_idx],
+                "unit_price": prices[medicine_idx],
+                "amount": np.round(quantity * prices[medicine_idx], 2),
+            }))
+            conn.commit()
+            loaded += n
+            elapsed = time.perf_counter() - begin
+            print(f"\rInsert Sales {loaded}/{sales} ({loaded / elapsed:.0f} rows/s)", end="", flush=True)
+        print()
+    finally:
+        conn.rollback()
+        cur.execute("ALTER TABLE sales ENABLE TRIGGER sales_rollup")
+        conn.commit()
+    rollups.backfill(cur, (today - timedelta(days=days - 1)).date(), None)
+    conn.commit()
+    print("Backfill Sales Rollups Success!")
+    # COPY 写入的销售记录没有经过销售语句，药品上的销售计数同样一次性重算
+    rollups.backfill_medicine_counters(cur)
+    conn.commit()
+    print("Backfill Medicine Sales Counters Success!")
+
+    cur.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    print("Data Generation Success!")
+
+def main():
+    parser = argparse.ArgumentParser(description="生成连锁规模的合成数据")
+    parser.add_argument("--pharmacies", type=int, default=2000)
+    parser.add_argument("--medicines", type=int, default=500_000)
+    parser.add_argument("--sales", type=int, default=100_000_000)
+    parser.add_argument("--users-per-pharmacy", type=int, default=5)
+    parser.add_argument("--days", type=int, default=365, help="销售记录覆盖的天数（截至今天）")
+    parser.add_argument("--chunk-rows", type=int, default=200_000, help="每次 COPY 的行数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--password-iterations", type=int, default=1000, help="生成账号口令哈希的迭代次数")
+    args = parser.parse_args()
+    if args.users_per_pharmacy < 2:
+        parser.error("--users-per-pharmacy 至少为 2（1 名药店管理员 + 销售员）")
+    generate(args.pharmacies, args.medicines, args.sales, args.users_per_pharmacy,
+             args.days, args.chunk_rows, args.seed, args.password_iterations)
+
+if __name__ == "__main__":
+    main()
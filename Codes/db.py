@@ -0,0 +1,329 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from config import DB_CONFIG, POOL_CONFIG, REPLICA_CONFIG
+from profiler import InstrumentedCursor, metrics
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, conn_kwargs, minconn=1, maxconn=10, timeout=10, health_check_interval=30):
+        self.conn_kwargs = conn_kwargs
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        # 空闲连接栈，元素为 (连接, 上次归还时间)
+        self._idle = []
+        self._total = 0
+        self._in_use = 0
+
+        # 连接池指标
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._exhausted = 0
+        self._timeouts = 0
+        self._reconnects = 0
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._total += 1
+
+    def _connect(self):
+        return psycopg2.connect(**self.conn_kwargs, cursor_factory=InstrumentedCursor)
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        # 刚归还的连接不必再探测，只检查空闲较久的连接
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _replace(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._reconnects += 1
+        return self._connect()
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._total < self.maxconn:
+                    # 先占位，在锁外建立新连接
+                    self._total += 1
+                    conn, idle_since = None, None
+                    break
+                if not waited:
+                    self._exhausted += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolExhausted(f"等待数据库连接超时（{self.timeout}秒），连接池已满")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            wait = time.monotonic() - start
+            self._checkouts += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        metrics.record_pool_wait(wait * 1000)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_healthy(conn, idle_since):
+                conn = self._replace(conn)
+        except Exception:
+            # 建连失败时归还占位
+            with self._cond:
+                self._total -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        if not broken and not conn.closed:
+            try:
+                # 未提交的事务不能带回池中，否则会污染下一个使用者
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+        if broken or conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        with self._cond:
+            self._in_use -= 1
+            if broken or conn.closed:
+                self._total -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    # 已借出连接占上限的比例，读路由据此选择负载最低的副本
+    def load(self):
+        with self._cond:
+            return self._in_use / self.maxconn
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+            self._total -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "size": self._total,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "wait_avg_ms": self._wait_total / self._checkouts * 1000 if self._checkouts else 0.0,
+                "wait_max_ms": self._wait_max * 1000,
+                "exhausted": self._exhausted,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_CONFIG, **POOL_CONFIG)
+    return _pool
+
+# 使用已从 pool 借出的连接：正常结束提交，异常回滚，最后归还
+@contextmanager
+def _checked_out(pool, conn):
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # 连接已断开，直接丢弃，由连接池重新建立
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, broken)
+
+# 每次请求从主库连接池中取出一个连接，正常结束提交，异常回滚，最后归还。写入以及读后即写的查询都用它
+@contextmanager
+def get_conn():
+    pool = get_pool()
+    with _checked_out(pool, pool.getconn()) as conn:
+        yield conn
+
+def pool_stats():
+    return get_pool().stats()
+
+
+class Replica:
+    def __init__(self, name, conn_kwargs):
+        self.name = name
+        self.pool = ConnectionPool(conn_kwargs, **{**POOL_CONFIG, "minconn": 0})
+        # 最近一次检查到的复制延迟秒数，None 表示尚未检查或无法连接
+        self.lag = None
+        self.checked_at = 0.0
+        self.error = None
+        self._check_lock = threading.Lock()
+        self.reads = 0
+
+    def available(self):
+        return self.lag is not None and self.lag <= REPLICA_CONFIG["max_lag_seconds"]
+
+    # 距上次检查超过间隔时由当前线程检查一次，其他线程继续使用上次的结果
+    def refresh(self):
+        if time.monotonic() - self.checked_at < REPLICA_CONFIG["lag_check_interval"]:
+            return
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            with _checked_out(self.pool, self.pool.getconn()) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(REPLICA_CONFIG["lag_query"])
+                    lag = cur.fetchone()['lag']
+            self.lag = float(lag) if lag is not None else None
+            self.error = None
+        except (psycopg2.Error, PoolExhausted) as e:
+            self.lag = None
+            self.error = str(e).strip()
+        finally:
+            self.checked_at = time.monotonic()
+            self._check_lock.release()
+
+    def stats(self):
+        return {"name": self.name, "lag_seconds": self.lag, "available": self.available(),
+                "reads": self.reads, "error": self.error, "pool": self.pool.stats()}
+
+
+_replicas = None
+# 读写键 -> 读己之写截止时间（monotonic）
+_sticky = {}
+_sticky_lock = threading.Lock()
+# 读请求的去向计数与各副本的读次数，由连接池的多个线程同时更新
+_routes = {"replica": 0, "primary_sticky": 0, "primary_fallback": 0}
+_routes_lock = threading.Lock()
+
+def _count_route(route, replica=None):
+    with _routes_lock:
+        _routes[route] += 1
+        if replica is not None:
+            replica.reads += 1
+
+def get_replicas():
+    global _replicas
+    if _replicas is None:
+        with _pool_lock:
+            if _replicas is None:
+                _replicas = [Replica(f"{c.get('host', DB_CONFIG['host'])}:{c.get('port', DB_CONFIG['port'])}", {**DB_CONFIG, **c})
+                             for c in REPLICA_CONFIG["replicas"]]
+    return _replicas
+
+# 写入提交后调用：之后 sticky_seconds 秒内带这些键的读请求走主库。键如 ("user", user_id)、("pharmacy", pharmacy_id)
+def mark_written(*keys):
+    if not REPLICA_CONFIG["replicas"]:
+        return
+    now = time.monotonic()
+    until = now + REPLICA_CONFIG["sticky_seconds"]
+    with _sticky_lock:
+        for key in keys:
+            _sticky[key] = until
+        if len(_sticky) > 10_000:
+            for key in [k for k, t in _sticky.items() if t < now]:
+                del _sticky[key]
+
+def _is_sticky(keys):
+    if not keys:
+        return False
+    now = time.monotonic()
+    with _sticky_lock:
+        return any(_sticky.get(key, 0) > now for key in keys)
+
+# 选出负载最低的可用副本，没有可用副本时返回 None；连接已全部借出的副本不参与，避免在副本上排队等待
+def _pick_replica():
+    candidates = []
+    for replica in get_replicas():
+        replica.refresh()
+        if replica.available() and replica.pool.load() < 1:
+            candidates.append(replica)
+    return min(candidates, key=lambda r: r.pool.load(), default=None)
+
+# 只读查询使用的连接：keys 为本次读取涉及的用户、药店等键，其中任一键刚被写入时走主库；
+# 否则取负载最低且延迟在允许范围内的副本，副本都不可用或取不到连接时回到主库
+@contextmanager
+def get_read_conn(*keys):
+    replica = None
+    if REPLICA_CONFIG["replicas"]:
+        if _is_sticky(keys):
+            route = "primary_sticky"
+        else:
+            replica = _pick_replica()
+            route = "replica" if replica else "primary_fallback"
+        # 走副本的读请求在取到副本连接后计数
+        if route != "replica":
+            _count_route(route)
+    conn = None
+    if replica is not None:
+        try:
+            conn = replica.pool.getconn()
+        except (psycopg2.OperationalError, PoolExhausted) as e:
+            # 副本连不上或连接池已满：标记为不可用直到下次检查，本次回到主库
+            replica.lag, replica.error = None, str(e).strip()
+            _count_route("primary_fallback")
+    if conn is None:
+        with get_conn() as conn:
+            yield conn
+        return
+    _count_route("replica", replica)
+    try:
+        with _checked_out(replica.pool, conn) as conn:
+            yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        # 查询中副本断开：本次仍抛出，之后的读请求在下次检查前都回到主库
+        replica.lag, replica.error = None, str(e).strip()
+        raise
+
+def replica_stats():
+    with _routes_lock:
+        routes = dict(_routes)
+    return {"routes": routes, "replicas": [r.stats() for r in get_replicas()]}
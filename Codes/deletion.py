@@ -0,0 +1,324 @@
+import argparse
+import threading
+import time
+
+import psycopg2
+
+from config import DELETION_CONFIG
+from db import get_conn
+import notify
+
+# 药品、药店的删除分两步：先软删除（写 deleted_at），库存目录、搜索、销售与登录立即看不到它，历史销售与报表保持不变；
+# 需要彻底删除时再登记删除任务，由后台线程按批删除关联的销售记录、药品与用户，每批单独提交并记下进度，
+# 不会长时间持锁，也不会在一个事务里写出大量 WAL。
+# 任务执行时持有以任务号为键的会话级咨询锁，执行的进程退出后锁随连接释放，
+# 任何进程的后台线程或 python deletion.py 都会接手，从剩余的行继续删除
+#
+# 任务状态：pending 等待执行，running 执行中（或执行进程已退出、等待接手），done 已完成，failed 出错（可用 --retry 重新执行）
+
+# 咨询锁的第一个键，第二个键为任务号
+DELETION_LOCK_KEY = 20240602
+
+# 删除对象 -> (表, 主键)
+TARGETS = {
+    "medicine": ("medicines", "medicine_id"),
+    "pharmacy": ("pharmacies", "pharmacy_id"),
+}
+
+# 每种删除对象的删除步骤：(步骤名, 表, 行键, 条件)，按顺序逐步删除（BATCH_SQL 中登记的步骤按其语句分批处理），
+# 条件中的 %(target)s 为对象ID。
+# 已完成的步骤重新执行时只做一次索引探测，因此中断后总是从第一步重新走一遍
+PLANS = {
+    "medicine": [
+        ("sales", "sales", "sale_id, sale_time", "medicine_id = %(target)s"),
+        ("medicines", "medicines", "medicine_id", "medicine_id = %(target)s"),
+    ],
+    "pharmacy": [
+        ("sales", "sales", "sale_id, sale_time",
+         "medicine_id IN (SELECT medicine_id FROM medicines WHERE pharmacy_id = %(target)s)"),
+        # 本药店员工在其他药店的销售记录保留，只去掉销售员（见 DETACH_SALES_BATCH_SQL）
+        ("user sales", "sales", "sale_id, sale_time",
+         "user_id IN (SELECT user_id FROM users WHERE pharmacy_id = %(target)s AND role <> 0)"),
+        ("medicines", "medicines", "medicine_id", "pharmacy_id = %(target)s"),
+        ("users", "users", "user_id", "pharmacy_id = %(target)s AND role <> 0"),
+        ("pharmacies", "pharmacies", "pharmacy_id", "pharmacy_id = %(target)s"),
+    ],
+}
+
+# 删除一批销售记录并扣减药品上的销售计数，返回删除行数与计数发生变化的未下架药品所在药店
+DELETE_SALES_BATCH_SQL = """
+    WITH d AS (
+        DELETE FROM sales
+        WHERE (sale_id, sale_time) IN (SELECT sale_id, sale_time FROM sales WHERE {condition} LIMIT %(limit)s)
+        RETURNING medicine_id
+    ), u AS (
+        UPDATE medicines m SET sales_count = m.sales_count - c.n
+        FROM (SELECT medicine_id, COUNT(*) AS n FROM d GROUP BY medicine_id) c
+        WHERE m.medicine_id = c.medicine_id
+        RETURNING m.pharmacy_id, m.deleted_at
+    )
+    SELECT (SELECT COUNT(*) FROM d) AS deleted,
+           ARRAY(SELECT DISTINCT pharmacy_id FROM u WHERE deleted_at IS NULL) AS pharmacy_ids
+"""
+
+# 把一批销售记录的销售员置空，销售、库存计数与汇总表都不变。汇总表中这些销售仍记在原销售员ID下，
+# 按药店、日期的汇总不受影响，已删除的销售员不会再被按人查询
+DETACH_SALES_BATCH_SQL = """
+    WITH d AS (
+        UPDATE sales SET user_id = NULL
+        WHERE (sale_id, sale_time) IN (SELECT sale_id, sale_time FROM sales WHERE {condition} LIMIT %(limit)s)
+        RETURNING 1
+    )
+    SELECT COUNT(*) AS deleted, ARRAY[]::INT[] AS pharmacy_ids FROM d
+"""
+
+# 不是删除行的步骤：步骤名 -> 分批语句
+BATCH_SQL = {
+    "user sales": DETACH_SALES_BATCH_SQL,
+}
+
+DELETE_BATCH_SQL = """
+    WITH d AS (
+        DELETE FROM {table}
+        WHERE ({key}) IN (SELECT {key} FROM {table} WHERE {condition} LIMIT %(limit)s)
+        RETURNING 1
+    )
+    SELECT COUNT(*) AS deleted, ARRAY[]::INT[] AS pharmacy_ids FROM d
+"""
+
+# 药店停用或恢复时，其员工的登录缓存需要失效
+def _usernames(cur, entity, target_id):
+    if entity != "pharmacy":
+        return []
+    cur.execute("SELECT username FROM users WHERE pharmacy_id = %s", (target_id,))
+    return [r['username'] for r in cur.fetchall()]
+
+# 软删除：返回 (对象所在药店, 需要失效登录缓存的用户名)，对象不存在或已软删除时药店为 None。
+# 停用药店时其在售药品一并下架（与药店的 deleted_at 相同），恢复药店时只恢复这一批，之前单独下架的药品保持下架
+def soft_delete(cur, entity, target_id):
+    table, key = TARGETS[entity]
+    cur.execute(f"""
+        UPDATE {table} SET deleted_at = CURRENT_TIMESTAMP
+        WHERE {key} = %s AND deleted_at IS NULL
+        RETURNING pharmacy_id
+    """, (target_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None, []
+    if entity == "pharmacy":
+        cur.execute("""
+            UPDATE medicines SET deleted_at = CURRENT_TIMESTAMP
+            WHERE pharmacy_id = %s AND deleted_at IS NULL
+        """, (target_id,))
+    return row['pharmacy_id'], _usernames(cur, entity, target_id)
+
+def unfinished_job(cur, entity, target_id):
+    cur.execute("""
+        SELECT job_id FROM deletion_jobs
+        WHERE entity = %s AND target_id = %s AND status <> 'done'
+        ORDER BY job_id DESC LIMIT 1
+    """, (entity, target_id))
+    row = cur.fetchone()
+    return row['job_id'] if row else None
+
+# 撤销软删除；已登记彻底删除任务的对象不能恢复，返回 (对象所在药店, 用户名)，不能恢复时药店为 None
+def restore(cur, entity, target_id):
+    if unfinished_job(cur, entity, target_id) is not None:
+        return None, []
+    table, key = TARGETS[entity]
+    cur.execute(f"""
+        UPDATE {table} t SET deleted_at = NULL
+        FROM (SELECT deleted_at FROM {table} WHERE {key} = %s) old
+        WHERE t.{key} = %s AND t.deleted_at IS NOT NULL
+        RETURNING t.pharmacy_id, old.deleted_at
+    """, (target_id, target_id))
+    row = cur.fetchone()
+    if row is None:
+        return None, []
+    if entity == "pharmacy":
+        cur.execute("UPDATE medicines SET deleted_at = NULL WHERE pharmacy_id = %s AND deleted_at = %s",
+                    (target_id, row['deleted_at']))
+    return row['pharmacy_id'], _usernames(cur, entity, target_id)
+
+# 登记彻底删除任务（对象应已软删除），同一对象已有未完成的任务时直接返回该任务号。
+# 预计行数由药品上的销售计数估算，不扫描销售表
+def create_job(cur, entity, target_id, user_id=None):
+    job_id = unfinished_job(cur, entity, target_id)
+    if job_id is not None:
+        return job_id
+    if entity == "medicine":
+        cur.execute("SELECT pharmacy_id, sales_count + 1 AS total FROM medicines WHERE medicine_id = %s", (target_id,))
+    else:
+        cur.execute("""
+            SELECT %(target)s AS pharmacy_id,
+                   COALESCE((SELECT SUM(sales_count + 1) FROM medicines WHERE pharmacy_id = %(target)s), 0)
+                   + (SELECT COUNT(*) FROM users WHERE pharmacy_id = %(target)s AND role <> 0) + 1 AS total
+        """, {"target": target_id})
+    row = cur.fetchone()
+    if row is None:
+        return None
+    cur.execute("""
+        INSERT INTO deletion_jobs (entity, target_id, pharmacy_id, total_rows, created_by)
+        VALUES (%s, %s, %s, %s, %s)
+        RETURNING job_id
+    """, (entity, target_id, row['pharmacy_id'], row['total'], user_id))
+    return cur.fetchone()['job_id']
+
+def list_jobs(cur, pharmacy_id=None, entity=None, limit=20):
+    cur.execute("""
+        SELECT job_id, entity, target_id, pharmacy_id, status, phase, deleted_rows, total_rows, error,
+               created_at, updated_at, finished_at
+        FROM deletion_jobs
+        WHERE (%(pharmacy_id)s::int IS NULL OR pharmacy_id = %(pharmacy_id)s)
+          AND (%(entity)s::text IS NULL OR entity = %(entity)s)
+        ORDER BY job_id DESC LIMIT %(limit)s
+    """, {"pharmacy_id": pharmacy_id, "entity": entity, "limit": limit})
+    return cur.fetchall()
+
+def _delete_batch(cur, phase, table, key, condition, target_id, limit):
+    template = BATCH_SQL.get(phase) or (DELETE_SALES_BATCH_SQL if table == "sales" else DELETE_BATCH_SQL)
+    cur.execute(template.format(table=table, key=key, condition=condition), {"target": target_id, "limit": limit})
+    row = cur.fetchone()
+    return row['deleted'], row['pharmacy_ids']
+
+# 执行一个删除任务直到完成；任务正由其他进程执行时立即返回 False。
+# on_change(pharmacy_ids) 在任务结束后以销售计数发生变化的其他药店调用，用于更新本进程的缓存
+def run_job(conn, job_id, batch_rows=None, pause=None, on_change=None, verbose=False):
+    batch_rows = batch_rows or DELETION_CONFIG["batch_rows"]
+    pause = DELETION_CONFIG["pause"] if pause is None else pause
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s, %s) AS locked", (DELETION_LOCK_KEY, job_id))
+        locked = cur.fetchone()['locked']
+    conn.commit()
+    if not locked:
+        return False
+    changed = set()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT entity, target_id, status FROM deletion_jobs WHERE job_id = %s", (job_id,))
+            job = cur.fetchone()
+            if job is None or job['status'] == 'done':
+                conn.commit()
+                return False
+            cur.execute("""
+                UPDATE deletion_jobs SET status = 'running', error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = %s
+            """, (job_id,))
+            conn.commit()
+            try:
+                for phase, table, key, condition in PLANS[job['entity']]:
+                    while True:
+                        deleted, pharmacy_ids = _delete_batch(cur, phase, table, key, condition, job['target_id'], batch_rows)
+                        cur.execute("""
+                            UPDATE deletion_jobs
+                            SET phase = %s, deleted_rows = deleted_rows + %s, updated_at = clock_timestamp()
+                            WHERE job_id = %s
+                            RETURNING deleted_rows
+                        """, (phase, deleted, job_id))
+                        progress = cur.fetchone()['deleted_rows']
+                        conn.commit()
+                        changed.update(pharmacy_ids)
+                        if verbose and deleted:
+                            print(f"\rDeletion Job {job_id} {phase}: {progress} rows", end="", flush=True)
+                        if deleted < batch_rows:
+                            break
+                        time.sleep(pause)
+                for pharmacy_id in changed:
+                    notify.publish(cur, notify.inventory_event(pharmacy_id))
+                cur.execute("""
+                    UPDATE deletion_jobs
+                    SET status = 'done', phase = NULL, updated_at = clock_timestamp(), finished_at = clock_timestamp()
+                    WHERE job_id = %s
+                """, (job_id,))
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                cur.execute("""
+                    UPDATE deletion_jobs SET status = 'failed', error = %s, updated_at = clock_timestamp()
+                    WHERE job_id = %s
+                """, (str(e).strip(), job_id))
+                conn.commit()
+                raise
+        if verbose:
+            print()
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s, %s)", (DELETION_LOCK_KEY, job_id))
+        conn.commit()
+        if on_change and changed:
+            on_change(changed)
+    return True
+
+# 依次执行所有未完成的任务（包括执行进程已退出的任务），retry_failed 为真时也重新执行出错的任务；返回执行完成的任务号
+def run_pending(on_change=None, retry_failed=False, verbose=False):
+    statuses = ['pending', 'running', 'failed'] if retry_failed else ['pending', 'running']
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT job_id FROM deletion_jobs WHERE status = ANY(%s) ORDER BY job_id", (statuses,))
+            job_ids = [row['job_id'] for row in cur.fetchall()]
+        conn.commit()
+        finished = []
+        for job_id in job_ids:
+            try:
+                if run_job(conn, job_id, on_change=on_change, verbose=verbose):
+                    finished.append(job_id)
+            except psycopg2.Error as e:
+                if verbose:
+                    print(f"\nDeletion Job {job_id} Failed: {e}")
+    return finished
+
+
+class DeletionWorker(threading.Thread):
+    def __init__(self, on_change):
+        super().__init__(name="deletion-worker", daemon=True)
+        self.on_change = on_change
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                run_pending(self.on_change)
+            except psycopg2.Error:
+                pass
+            self._wake.wait(DELETION_CONFIG["poll_interval"])
+            self._wake.clear()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+# 每个进程只启动一个后台删除线程，重复调用直接返回已有的线程
+def start_worker(on_change=None):
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = DeletionWorker(on_change)
+            _worker.start()
+    return _worker
+
+# 登记任务后唤醒本进程的后台线程立即执行，不必等到下一次检查
+def wake_worker():
+    if _worker is not None:
+        _worker.wake()
+
+def main():
+    parser = argparse.ArgumentParser(description="执行后台删除任务：中断的任务从剩余的行继续")
+    parser.add_argument("--list", action="store_true", help="只列出最近的删除任务")
+    parser.add_argument("--retry", action="store_true", help="同时重新执行出错的任务")
+    args = parser.parse_args()
+
+    if args.list:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                for job in list_jobs(cur, limit=50):
+                    print(f"#{job['job_id']} {job['entity']} {job['target_id']} {job['status']} "
+                          f"{job['deleted_rows']}/{job['total_rows']} {job['phase'] or ''} {job['error'] or ''}")
+        return
+    finished = run_pending(retry_failed=args.retry, verbose=True)
+    print(f"Deletion Success! {len(finished)} jobs finished")
+
+if __name__ == "__main__":
+    main()
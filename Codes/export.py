@@ -0,0 +1,232 @@
+import argparse
+import gzip
+import os
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+import psycopg2.extensions
+
+from config import EXPORT_CONFIG
+from db import get_read_conn
+import partitions
+import sales
+
+# 导出列：(表头, SQL 表达式)
+EXPORT_COLUMNS = [
+    ("销售ID", "s.sale_id"),
+    ("销售时间", "date_trunc('second', s.sale_time)"),
+    ("药店ID", "m.pharmacy_id"),
+    ("药品名称", "m.name"),
+    ("生产商", "m.manufacturer"),
+    ("数量", "s.quantity"),
+    ("单价", "s.unit_price"),
+    ("总金额", "s.amount"),
+    ("销售员", "u.username"),
+]
+
+# 导出表头 -> 归档文件中的列名（见 partitions.ARCHIVE_QUERY）
+ARCHIVE_COLUMNS = {
+    "销售ID": "sale_id",
+    "销售时间": "sale_time",
+    "药店ID": "pharmacy_id",
+    "药品名称": "medicine_name",
+    "生产商": "manufacturer",
+    "数量": "quantity",
+    "单价": "unit_price",
+    "总金额": "amount",
+    "销售员": "username",
+}
+
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), EXPORT_CONFIG["export_dir"])
+
+FORMATS = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "parquet": ".parquet",
+}
+
+# 服务端游标每次取回的行数，决定导出时 Python 端驻留的行数上限
+CHUNK_ROWS = 20000
+
+# 按条件拼出导出查询，所有条件都可选：不带条件即导出全部药店的全部记录
+def build_query(user_id=None, pharmacy_id=None, start=None, end=None, time_range=None):
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append("s.user_id = %s")
+        params.append(user_id)
+    if pharmacy_id is not None:
+        conditions.append("m.pharmacy_id = %s")
+        params.append(pharmacy_id)
+    if start is not None:
+        conditions.append("s.sale_time >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("s.sale_time < %s")
+        params.append(end)
+    if time_range is not None:
+        conditions.append(sales.TIME_RANGE_FILTERS[time_range])
+    columns = ", ".join(f'{expr} AS "{name}"' for name, expr in EXPORT_COLUMNS)
+    query = f"""
+        SELECT {columns}
+        FROM sales s
+        JOIN medicines m ON s.medicine_id = m.medicine_id
+        JOIN users u ON s.user_id = u.user_id
+        WHERE {" AND ".join(conditions) or "TRUE"}
+    """
+    # 单个销售员的导出量小，按时间倒序；全量导出不排序，避免在服务端对整表排序
+    if user_id is not None:
+        query += " ORDER BY s.sale_time DESC, s.sale_id DESC"
+    return query, params
+
+# 导出文件（Parquet 及归档转换）的列类型
+def export_schema(pa):
+    return pa.schema([
+        ("销售ID", pa.int64()),
+        ("销售时间", pa.timestamp("us")),
+        ("药店ID", pa.int32()),
+        ("药品名称", pa.string()),
+        ("生产商", pa.string()),
+        ("数量", pa.int32()),
+        ("单价", pa.decimal128(10, 2)),
+        ("总金额", pa.decimal128(14, 2)),
+        ("销售员", pa.string()),
+    ])
+
+def _to_datetime(value):
+    return value if value is None or isinstance(value, datetime) else datetime.combine(value, datetime.min.time())
+
+# 已归档分区中满足条件的记录，按归档月份倒序逐块产出与 EXPORT_COLUMNS 同列的 pyarrow 表；
+# 只导出某个销售员时每个归档内按时间倒序，接在数据库中的记录之后仍保持整体倒序
+def archived_tables(conn, user_id=None, pharmacy_id=None, start=None, end=None, time_range=None):
+    # 今日、最近N天等相对范围总在保留期内，不会落到归档中
+    if time_range not in (None, "全部"):
+        return
+    archives = partitions.archives_for(conn, start, end)
+    if not archives:
+        return
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    schema = export_schema(pa)
+    # 与数据库导出的 JOIN users 一致，跳过没有销售员的记录
+    condition = ds.field("user_id").is_valid()
+    if user_id is not None:
+        condition &= ds.field("user_id") == user_id
+    if pharmacy_id is not None:
+        condition &= ds.field("pharmacy_id") == pharmacy_id
+    if start is not None:
+        condition &= ds.field("sale_time") >= pa.scalar(_to_datetime(start), pa.timestamp("us"))
+    if end is not None:
+        condition &= ds.field("sale_time") < pa.scalar(_to_datetime(end), pa.timestamp("us"))
+    for archive in archives:
+        dataset = ds.dataset(partitions.archive_path(archive), format="parquet")
+        if user_id is not None:
+            table = dataset.to_table(filter=condition).sort_by([("sale_time", "descending"), ("sale_id", "descending")])
+            batches = table.to_batches(CHUNK_ROWS)
+        else:
+            batches = dataset.to_batches(filter=condition, batch_size=CHUNK_ROWS)
+        for batch in batches:
+            if not batch.num_rows:
+                continue
+            table = pa.Table.from_batches([batch]).select(list(ARCHIVE_COLUMNS.values()))
+            table = table.set_column(1, "sale_time", pc.floor_temporal(table["sale_time"], unit="second"))
+            yield table.rename_columns(list(ARCHIVE_COLUMNS)).cast(schema)
+
+# COPY ... TO STDOUT 由服务端直接生成 CSV，psycopg2 按块写入 out，内存占用与结果集大小无关；归档中的记录随后逐块追加
+def write_csv(conn, out, query, params, archives=()):
+    with conn.cursor() as cur:
+        sql = cur.mogrify(query, params).decode()
+        cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", out)
+    for table in archives:
+        out.write(table.to_pandas().to_csv(index=False, header=False, date_format="%Y-%m-%d %H:%M:%S").encode())
+
+def write_csv_gz(conn, out, query, params, archives=()):
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as gz:
+        write_csv(conn, gz, query, params, archives)
+
+# 具名（服务端）游标分块读取，每块写成 Parquet 的一个 row group
+def write_parquet(conn, out, query, params, archives=()):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("导出 Parquet 需要安装 pyarrow")
+
+    schema = export_schema(pa)
+    names = schema.names
+    with conn.cursor(name=f"export_{uuid.uuid4().hex}", cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.itersize = CHUNK_ROWS
+        cur.execute(query, params)
+        with pq.ParquetWriter(out, schema, compression="zstd") as writer:
+            while True:
+                rows = cur.fetchmany(CHUNK_ROWS)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                writer.write_table(pa.table({name: columns[i] for i, name in enumerate(names)}, schema=schema))
+            for table in archives:
+                writer.write_table(table)
+
+WRITERS = {
+    "csv": write_csv,
+    "csv.gz": write_csv_gz,
+    "parquet": write_parquet,
+}
+
+# 把满足条件的销售记录流式导出到二进制文件对象 out；日期范围涉及已归档的分区时一并导出归档中的记录
+def export_sales(out, fmt="csv", **filters):
+    query, params = build_query(**filters)
+    # 长时间的流式读取放到只读副本上，不占用主库的连接
+    with get_read_conn() as conn:
+        WRITERS[fmt](conn, out, query, params, archived_tables(conn, **filters))
+
+# 删除导出目录中超过保留期的文件（包括中途失败留下的临时文件）
+def prune_exports():
+    cutoff = time.time() - EXPORT_CONFIG["retention_hours"] * 3600
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+# 导出到导出目录下的文件并返回路径：先写临时文件，写完再改名，目录中不会出现写了一半的导出文件
+def export_sales_to_file(fmt="csv", **filters):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    prune_exports()
+    fd, tmp_path = tempfile.mkstemp(prefix="sales_export_", suffix=".tmp", dir=EXPORT_DIR)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            export_sales(out, fmt, **filters)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    path = tmp_path[:-len(".tmp")] + FORMATS[fmt]
+    os.replace(tmp_path, path)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="流式导出销售记录")
+    parser.add_argument("--pharmacy", type=int, help="只导出某个药店")
+    parser.add_argument("--user", type=int, help="只导出某个销售员")
+    parser.add_argument("--from", dest="start", type=date.fromisoformat, help="起始日期（含），如 2024-01-01")
+    parser.add_argument("--to", dest="end", type=date.fromisoformat, help="截止日期（含），如 2024-12-31")
+    parser.add_argument("--format", choices=list(FORMATS), default="csv.gz")
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    begin = time.perf_counter()
+    with open(args.output, "wb") as out:
+        export_sales(out, args.format, user_id=args.user, pharmacy_id=args.pharmacy,
+                     start=args.start, end=args.end + timedelta(days=1) if args.end else None)
+    elapsed = time.perf_counter() - begin
+    size = os.path.getsize(args.output)
+    print(f"Export Success! {size / 1e6:.1f} MB in {elapsed:.1f}s -> {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# 管理员的用户、药店表格：过滤、排序与分页都在数据库端完成，页面每次只取一页，
+# 选择器只取前几条匹配项，编辑表单只按ID取所选的一行，页面耗时不随员工数、药店数增长。
+#   - 关键字为数字时按ID精确匹配，同时按名称前缀匹配；前缀匹配走 pattern_ops 索引（见 init.py 迁移 13）
+#   - 按排序列做键集分页：after 为上一页最后一行的排序键，翻页代价只与页大小有关
+#   - 总数只数到 COUNT_LIMIT 为止，超过时显示为"COUNT_LIMIT+"
+
+# 每页行数
+PAGE_SIZE = 50
+# 选择器列出的匹配项上限
+PICKER_LIMIT = 20
+# 过滤结果计数的上限
+COUNT_LIMIT = 10000
+
+# 排序方式：{名称: (排序列, 是否倒序)}，排序列的组合唯一，作为键集分页的游标
+USER_SORTS = {
+    "用户ID 升序": (("user_id",), False),
+    "用户ID 降序": (("user_id",), True),
+    "用户名 升序": (("username",), False),
+    "用户名 降序": (("username",), True),
+}
+
+PHARMACY_SORTS = {
+    "药店ID 升序": (("pharmacy_id",), False),
+    "药店ID 降序": (("pharmacy_id",), True),
+    "药店名称 升序": (("name", "pharmacy_id"), False),
+    "药店名称 降序": (("name", "pharmacy_id"), True),
+}
+
+USER_COLUMNS = "user_id, username, role, pharmacy_id"
+PHARMACY_COLUMNS = "pharmacy_id, name, address"
+
+# LIKE 前缀模式，转义关键字中的通配符
+def _prefix(keyword):
+    return keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+# 关键字条件：数字按ID精确匹配或名称前缀匹配，其他只按名称前缀匹配
+def _keyword_condition(keyword, id_column, name_column, params):
+    params.append(_prefix(keyword))
+    if keyword.isdigit():
+        params.append(int(keyword))
+        return f"({name_column} LIKE %s OR {id_column} = %s)"
+    return f"{name_column} LIKE %s"
+
+def _user_conditions(keyword, role, pharmacy_id):
+    conditions, params = [], []
+    if keyword:
+        conditions.append(_keyword_condition(keyword, "user_id", "username", params))
+    if role is not None:
+        conditions.append("role = %s")
+        params.append(role)
+    if pharmacy_id is not None:
+        conditions.append("pharmacy_id = %s")
+        params.append(pharmacy_id)
+    return conditions, params
+
+# 只列出未停用的药店，已停用的药店在"显示已停用药店与删除任务"中查看
+def _pharmacy_conditions(keyword):
+    conditions, params = ["deleted_at IS NULL"], []
+    if keyword:
+        conditions.append(_keyword_condition(keyword, "pharmacy_id", "name", params))
+    return conditions, params
+
+def _where(conditions):
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+# 取一页：按排序列（倒序时全部倒序）排列，after 为上一页最后一行的排序键。返回 (本页记录, 是否还有下一页)
+def _page(conn, table, columns, conditions, params, sort, after, limit):
+    sort_columns, descending = sort
+    conditions, params = list(conditions), list(params)
+    if after is not None:
+        conditions.append(f"({', '.join(sort_columns)}) {'<' if descending else '>'} ({', '.join(['%s'] * len(after))})")
+        params.extend(after)
+    order = ", ".join(f"{column} DESC" if descending else column for column in sort_columns)
+    # 多取一行用于判断是否还有下一页
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {columns} FROM {table} {_where(conditions)} ORDER BY {order} LIMIT %s",
+                    params + [limit + 1])
+        rows = cur.fetchall()
+    return rows[:limit], len(rows) > limit
+
+def _count(conn, table, conditions, params):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) AS n FROM (SELECT 1 FROM {table} {_where(conditions)} LIMIT %s) t",
+                    params + [COUNT_LIMIT + 1])
+        return cur.fetchone()['n']
+
+# 本页最后一行的排序键，作为下一页的 after
+def page_cursor(rows, sort):
+    last = rows[-1]
+    return tuple(last[column] for column in sort[0])
+
+def user_page(conn, keyword="", role=None, pharmacy_id=None, sort=USER_SORTS["用户ID 升序"], after=None, limit=PAGE_SIZE):
+    conditions, params = _user_conditions(keyword, role, pharmacy_id)
+    return _page(conn, "users", USER_COLUMNS, conditions, params, sort, after, limit)
+
+# 过滤后的用户数，超过 COUNT_LIMIT 时返回 COUNT_LIMIT + 1
+def user_count(conn, keyword="", role=None, pharmacy_id=None):
+    conditions, params = _user_conditions(keyword, role, pharmacy_id)
+    return _count(conn, "users", conditions, params)
+
+def pharmacy_page(conn, keyword="", sort=PHARMACY_SORTS["药店ID 升序"], after=None, limit=PAGE_SIZE):
+    conditions, params = _pharmacy_conditions(keyword)
+    return _page(conn, "pharmacies", PHARMACY_COLUMNS, conditions, params, sort, after, limit)
+
+def pharmacy_count(conn, keyword=""):
+    conditions, params = _pharmacy_conditions(keyword)
+    return _count(conn, "pharmacies", conditions, params)
+
+# 选择器的候选项：按ID或名称前缀匹配的前 limit 行，关键字为空时为ID最小的 limit 行
+def pick_users(conn, keyword, limit=PICKER_LIMIT):
+    return user_page(conn, keyword, limit=limit)[0]
+
+def pick_pharmacies(conn, keyword, limit=PICKER_LIMIT):
+    return pharmacy_page(conn, keyword, limit=limit)[0]
+
+# 编辑表单只取所选的一行，不存在时返回 None
+def get_user(conn, user_id):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id = %s", (user_id,))
+        return cur.fetchone()
+
+def get_pharmacy(conn, pharmacy_id):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {PHARMACY_COLUMNS} FROM pharmacies WHERE pharmacy_id = %s AND deleted_at IS NULL", (pharmacy_id,))
+        return cur.fetchone()
@@ -0,0 +1,173 @@
+import argparse
+import io
+import os
+import time
+
+import pandas as pd
+
+from db import get_conn
+import notify
+
+# 药品批量导入：文件分块读入并做向量化校验，合格行经 COPY 写入临时暂存表，
+# 再用两条集合语句按编码写入 medicines（先更新已有编码，再插入新编码）；整个导入在一个事务内完成。
+# 不使用 ON CONFLICT，PostgreSQL 与 openGauss 都能执行
+
+# 同一药店的导入串行执行（事务级咨询锁的第一个键，第二个键为药店ID），避免两次导入同时插入同一个新编码
+IMPORT_LOCK_KEY = 20240605
+
+# 文件表头 -> 字段名，中文表头与页面上的列名一致
+COLUMN_ALIASES = {
+    "药品名称": "name", "name": "name",
+    "药品产商": "manufacturer", "生产商": "manufacturer", "manufacturer": "manufacturer",
+    "药品编码": "code", "code": "code",
+    "药品价格": "price", "price": "price",
+    "药品库存": "stock", "stock": "stock",
+}
+FIELDS = ["code", "name", "manufacturer", "price", "stock"]
+
+CHUNK_ROWS = 50000
+
+class ImportFileError(Exception):
+    pass
+
+def read_chunks(file, filename):
+    if filename.lower().endswith((".xlsx", ".xls")):
+        try:
+            frame = pd.read_excel(file, dtype=str)
+        except ImportError:
+            raise ImportFileError("读取 Excel 需要安装 openpyxl，或将文件另存为 CSV")
+        for start in range(0, len(frame), CHUNK_ROWS):
+            yield frame.iloc[start:start + CHUNK_ROWS]
+    else:
+        yield from pd.read_csv(file, dtype=str, chunksize=CHUNK_ROWS, keep_default_na=False)
+
+# 对一个数据块做向量化校验，返回 (合格行, 不合格行)；不合格行带文件行号与原因
+def validate(chunk, first_line, seen_codes):
+    chunk = chunk.rename(columns=lambda c: COLUMN_ALIASES.get(str(c).strip(), str(c).strip()))
+    missing = [f for f in ("code", "name", "price", "stock") if f not in chunk.columns]
+    if missing:
+        raise ImportFileError(f"缺少必需的列：{', '.join(missing)}")
+    if "manufacturer" not in chunk.columns:
+        chunk["manufacturer"] = ""
+
+    frame = pd.DataFrame({
+        "line": range(first_line, first_line + len(chunk)),
+        "code": chunk["code"].fillna("").astype(str).str.strip(),
+        "name": chunk["name"].fillna("").astype(str).str.strip(),
+        "manufacturer": chunk["manufacturer"].fillna("").astype(str).str.strip(),
+        "price": pd.to_numeric(chunk["price"], errors="coerce").round(2),
+        "stock": pd.to_numeric(chunk["stock"], errors="coerce"),
+    })
+
+    reason = pd.Series("", index=frame.index)
+    checks = [
+        (frame["code"] == "", "编码为空"),
+        (frame["code"].str.len() > 50, "编码超过50个字符"),
+        (frame["name"] == "", "名称为空"),
+        (frame["name"].str.len() > 100, "名称超过100个字符"),
+        (frame["manufacturer"].str.len() > 100, "生产商超过100个字符"),
+        (frame["price"].isna() | (frame["price"] < 0) | (frame["price"] >= 1e8), "价格无效"),
+        (frame["stock"].isna() | (frame["stock"] < 0) | (frame["stock"] % 1 != 0) | (frame["stock"] > 2**31 - 1), "库存无效"),
+    ]
+    for mask, message in checks:
+        reason = reason.where(~mask | (reason != ""), message)
+    # 重复编码只在其余校验都通过的行之间判断，保留第一次出现的行
+    ok = reason == ""
+    duplicated = ok & (frame["code"].where(ok).duplicated(keep="first") | frame["code"].isin(seen_codes))
+    reason = reason.where(~duplicated, "文件内编码重复")
+
+    bad = reason != ""
+    valid = frame[~bad].copy()
+    valid["stock"] = valid["stock"].astype("int64")
+    seen_codes.update(valid["code"])
+    rejects = frame[bad].assign(reason=reason[bad])
+    return valid, rejects
+
+def import_medicines(file, filename, pharmacy_id):
+    begin = time.perf_counter()
+    rejects = []
+    total = 0
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE medicine_import (
+                    line INT, code VARCHAR(50), name VARCHAR(100), manufacturer VARCHAR(100),
+                    price DECIMAL(10,2), stock INT
+                ) ON COMMIT DROP
+            """)
+            seen_codes = set()
+            # 表头占第 1 行，数据从第 2 行开始
+            line = 2
+            for chunk in read_chunks(file, filename):
+                valid, bad = validate(chunk, line, seen_codes)
+                line += len(chunk)
+                total += len(chunk)
+                rejects.append(bad)
+                if len(valid):
+                    buf = io.StringIO()
+                    valid[["line"] + FIELDS].to_csv(buf, index=False, header=False)
+                    buf.seek(0)
+                    cur.copy_expert("COPY medicine_import (line, code, name, manufacturer, price, stock) FROM STDIN WITH (FORMAT csv)", buf)
+
+            # 加锁后再检查编码归属，检查与下面的更新、插入之间本药店不会有其他导入
+            cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (IMPORT_LOCK_KEY, pharmacy_id))
+            # 编码全局唯一：已属于其他药店的编码不能覆盖，移出暂存表并记为不合格
+            cur.execute("""
+                DELETE FROM medicine_import i
+                USING medicines m
+                WHERE m.code = i.code AND m.pharmacy_id <> %s
+                RETURNING i.line, i.code, i.name
+            """, (pharmacy_id,))
+            conflicts = cur.fetchall()
+            if conflicts:
+                rejects.append(pd.DataFrame(conflicts).assign(reason="编码已被其他药店使用"))
+
+            # 本药店已有的编码更新名称、生产商、价格与库存（已下架且未登记彻底删除的药品重新上架）
+            cur.execute("""
+                UPDATE medicines m
+                SET name = i.name, manufacturer = NULLIF(i.manufacturer, ''), price = i.price, stock = i.stock,
+                    deleted_at = CASE WHEN EXISTS (
+                        SELECT 1 FROM deletion_jobs j
+                        WHERE j.entity = 'medicine' AND j.target_id = m.medicine_id AND j.status <> 'done'
+                    ) THEN m.deleted_at END
+                FROM medicine_import i
+                WHERE m.code = i.code AND m.pharmacy_id = %s
+            """, (pharmacy_id,))
+            updated = cur.rowcount
+            # 新编码插入
+            cur.execute("""
+                INSERT INTO medicines (name, manufacturer, code, price, stock, pharmacy_id)
+                SELECT name, NULLIF(manufacturer, ''), code, price, stock, %s FROM medicine_import i
+                WHERE NOT EXISTS (SELECT 1 FROM medicines m WHERE m.code = i.code)
+            """, (pharmacy_id,))
+            inserted = cur.rowcount
+            notify.publish(cur, notify.inventory_event(pharmacy_id))
+
+    rejects.append(pd.DataFrame(columns=["line", "code", "name", "reason"]))
+    rejects = pd.concat(rejects, ignore_index=True)[["line", "code", "name", "reason"]].sort_values("line")
+    return {
+        "total": total,
+        "inserted": inserted,
+        "updated": updated,
+        "rejected": len(rejects),
+        "rejects": rejects,
+        "elapsed": time.perf_counter() - begin,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="从 CSV/Excel 批量导入药品")
+    parser.add_argument("--pharmacy", type=int, required=True)
+    parser.add_argument("--rejects", help="不合格行输出到该 CSV 文件")
+    parser.add_argument("file")
+    args = parser.parse_args()
+
+    with open(args.file, "rb") as f:
+        result = import_medicines(f, os.path.basename(args.file), args.pharmacy)
+    print(f"Import Success! total={result['total']} inserted={result['inserted']} updated={result['updated']} "
+          f"rejected={result['rejected']} in {result['elapsed']:.1f}s "
+          f"({result['total'] / result['elapsed'] * 60:.0f} rows/min)")
+    if args.rejects and result['rejected']:
+        result['rejects'].to_csv(args.rejects, index=False)
+
+if __name__ == "__main__":
+    main()
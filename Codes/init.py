@@ -1,105 +1,670 @@
 import psycopg2
+from psycopg2.extras import execute_values
 from config import DB_CONFIG
+import auth
+import partitions
+import rollups
+import json
 import sys
 
-def init_database():
-    conn = None
+# 每个迁移是一个函数，接收游标并在同一事务中执行；返回 False 表示当前数据库引擎不支持，本次跳过且不记录版本
+def migrate_base_tables(cursor):
+    # 创建用户表
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id SERIAL PRIMARY KEY,
+        username VARCHAR(50) UNIQUE NOT NULL,
+        password VARCHAR(50) NOT NULL,
+        role INT NOT NULL,   -- 0:系统管理员 1:药店管理员 2:销售员
+        pharmacy_id INT
+    );
+    """)
+    print("Create Users Table Success!")
+
+    # 创建药店表
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pharmacies (
+        pharmacy_id SERIAL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        address TEXT
+    );
+    """)
+    print("Create Pharmacies Table Success!")
+
+    # 创建药品表（添加外键约束）
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS medicines (
+        medicine_id SERIAL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        manufacturer VARCHAR(100),
+        code VARCHAR(50) UNIQUE,
+        price DECIMAL(10,2),
+        stock INT,
+        pharmacy_id INT NOT NULL REFERENCES pharmacies(pharmacy_id)
+    );
+    """)
+    print("Create Medicines Table Success!")
+
+    # 创建销售记录表
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sales (
+        sale_id SERIAL PRIMARY KEY,
+        medicine_id INT REFERENCES medicines(medicine_id),
+        quantity INT,
+        sale_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        user_id INT REFERENCES users(user_id)
+    );
+    """)
+    print("Create Sales Table Success!")
+
+# 按热点查询的访问路径建立索引
+def migrate_hot_query_indexes(cursor):
+    # 药店库存列表：WHERE pharmacy_id = ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_medicines_pharmacy ON medicines (pharmacy_id)")
+    # 销售记录分页：WHERE user_id = ? AND sale_time >= ? ORDER BY sale_time DESC, sale_id DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_user_time ON sales (user_id, sale_time DESC, sale_id DESC)")
+    # 删除药品前的引用计数、关联销售预览（ORDER BY sale_time DESC LIMIT 10）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_medicine_time ON sales (medicine_id, sale_time DESC)")
+
+# ILIKE '%kw%' 子串搜索需要三元组索引，openGauss 等不提供 pg_trgm 的引擎跳过，搜索仍可走药店索引
+def migrate_trigram_indexes(cursor):
     try:
-        # 尝试连接数据库
-        conn = psycopg2.connect(**DB_CONFIG)
-        # 创建表需要自动提交
-        conn.autocommit = True
-        
-        cursor = conn.cursor()
-        print("Database Connect Success!")
-        
-        # 创建用户表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id SERIAL PRIMARY KEY,
-            username VARCHAR(50) UNIQUE NOT NULL,
-            password VARCHAR(50) NOT NULL,
-            role INT NOT NULL,   -- 0:系统管理员 1:药店管理员 2:销售员
-            pharmacy_id INT
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except psycopg2.Error:
+        return False
+    for column in ("name", "manufacturer", "code"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_medicines_{column}_trgm ON medicines USING gin ({column} gin_trgm_ops)")
+
+# 汇总触发器函数，{amount} 为单条销售金额的表达式（r 为新增或删除的销售行）
+SALES_ROLLUP_FUNCTION = """
+CREATE OR REPLACE FUNCTION sales_rollup() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+    v_sign INT;
+    v_pharmacy INT;
+    v_amount DECIMAL(16,2);
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        r := NEW;
+        v_sign := 1;
+    ELSE
+        r := OLD;
+        v_sign := -1;
+    END IF;
+    SELECT pharmacy_id, {amount} INTO v_pharmacy, v_amount
+    FROM medicines WHERE medicine_id = r.medicine_id;
+
+    INSERT INTO sales_daily AS t (bucket, pharmacy_id, medicine_id, user_id, sale_count, quantity, amount)
+    VALUES (r.sale_time::date, v_pharmacy, r.medicine_id, COALESCE(r.user_id, 0),
+            v_sign, v_sign * r.quantity, v_sign * COALESCE(v_amount, 0))
+    ON CONFLICT (bucket, pharmacy_id, medicine_id, user_id) DO UPDATE
+    SET sale_count = t.sale_count + EXCLUDED.sale_count,
+        quantity = t.quantity + EXCLUDED.quantity,
+        amount = t.amount + EXCLUDED.amount;
+
+    INSERT INTO sales_hourly AS t (bucket, pharmacy_id, medicine_id, user_id, sale_count, quantity, amount)
+    VALUES (date_trunc('hour', r.sale_time), v_pharmacy, r.medicine_id, COALESCE(r.user_id, 0),
+            v_sign, v_sign * r.quantity, v_sign * COALESCE(v_amount, 0))
+    ON CONFLICT (bucket, pharmacy_id, medicine_id, user_id) DO UPDATE
+    SET sale_count = t.sale_count + EXCLUDED.sale_count,
+        quantity = t.quantity + EXCLUDED.quantity,
+        amount = t.amount + EXCLUDED.amount;
+
+    IF v_sign < 0 THEN
+        DELETE FROM sales_daily WHERE bucket = r.sale_time::date AND pharmacy_id = v_pharmacy
+            AND medicine_id = r.medicine_id AND user_id = COALESCE(r.user_id, 0) AND sale_count <= 0;
+        DELETE FROM sales_hourly WHERE bucket = date_trunc('hour', r.sale_time) AND pharmacy_id = v_pharmacy
+            AND medicine_id = r.medicine_id AND user_id = COALESCE(r.user_id, 0) AND sale_count <= 0;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# 销售汇总表：按天、按小时对 (药店, 药品, 销售员) 聚合，由触发器随销售记录的写入与删除增量维护，
+# 报表与销售记录面板只读汇总表，查询量与销售明细的多少无关
+def migrate_sales_rollups(cursor):
+    for table, bucket_type in (("sales_daily", "DATE"), ("sales_hourly", "TIMESTAMP")):
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            bucket {bucket_type} NOT NULL,
+            pharmacy_id INT NOT NULL,
+            medicine_id INT NOT NULL,
+            user_id INT NOT NULL,   -- 销售员为空的记录记为 0
+            sale_count BIGINT NOT NULL,
+            quantity BIGINT NOT NULL,
+            amount DECIMAL(16,2) NOT NULL,
+            PRIMARY KEY (bucket, pharmacy_id, medicine_id, user_id)
         );
         """)
-        print("Create Users Table Success!")
-        
-        # 创建药店表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS pharmacies (
-            pharmacy_id SERIAL PRIMARY KEY,
-            name VARCHAR(100) NOT NULL,
-            address TEXT
-        );
+    # 销售记录面板按销售员汇总，链级报表按药店、日期汇总
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_daily_user ON sales_daily (user_id, bucket)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_daily_pharmacy ON sales_daily (pharmacy_id, bucket)")
+    print("Create Sales Rollup Tables Success!")
+
+    cursor.execute(SALES_ROLLUP_FUNCTION.format(amount="r.quantity * price"))
+    cursor.execute("DROP TRIGGER IF EXISTS sales_rollup ON sales")
+    cursor.execute("CREATE TRIGGER sales_rollup AFTER INSERT OR DELETE ON sales FOR EACH ROW EXECUTE PROCEDURE sales_rollup()")
+    print("Create Sales Rollup Trigger Success!")
+
+    # 用已有的历史销售记录回填汇总表
+    for table, bucket in (("sales_daily", "s.sale_time::date"), ("sales_hourly", "date_trunc('hour', s.sale_time)")):
+        cursor.execute(f"""
+        INSERT INTO {table} (bucket, pharmacy_id, medicine_id, user_id, sale_count, quantity, amount)
+        SELECT {bucket}, m.pharmacy_id, s.medicine_id, COALESCE(s.user_id, 0),
+               COUNT(*), SUM(s.quantity), SUM(s.quantity * m.price)
+        FROM sales s
+        JOIN medicines m ON m.medicine_id = s.medicine_id
+        GROUP BY 1, 2, 3, 4
         """)
-        print("Create Pharmacies Table Success!")
-        
-        # 创建药品表（添加外键约束）
+    print("Backfill Sales Rollups Success!")
+
+def column_exists(cursor, table, column):
+    cursor.execute("""
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = %s AND column_name = %s
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+# 回填历史销售单价时每批更新的 sale_id 区间大小
+BACKFILL_BATCH_ROWS = 50000
+
+# 销售记录在写入时记下单价与金额，之后药品调价不会改变历史销售额；
+# 已有记录按当前价格分批回填，每批单独提交，中断后重新运行 init.py 会从未回填的行继续
+def migrate_sale_prices(cursor):
+    conn = cursor.connection
+    if not column_exists(cursor, "sales", "unit_price"):
+        cursor.execute("ALTER TABLE sales ADD COLUMN unit_price DECIMAL(10,2)")
+    if not column_exists(cursor, "sales", "amount"):
+        cursor.execute("ALTER TABLE sales ADD COLUMN amount DECIMAL(14,2)")
+    conn.commit()
+
+    cursor.execute("SELECT MIN(sale_id), MAX(sale_id) FROM sales WHERE unit_price IS NULL")
+    low, high = cursor.fetchone()
+    if low is not None:
+        for start in range(low, high + 1, BACKFILL_BATCH_ROWS):
+            cursor.execute("""
+            UPDATE sales s
+            SET unit_price = m.price, amount = s.quantity * m.price
+            FROM medicines m
+            WHERE m.medicine_id = s.medicine_id AND s.unit_price IS NULL
+              AND s.sale_id >= %s AND s.sale_id < %s
+            """, (start, start + BACKFILL_BATCH_ROWS))
+            conn.commit()
+            print(f"\rBackfill Sale Prices {min(start + BACKFILL_BATCH_ROWS, high + 1) - low}/{high + 1 - low}", end="", flush=True)
+        print()
+
+    # 补齐回填期间旧代码写入的行后加上非空约束
+    cursor.execute("""
+    UPDATE sales s
+    SET unit_price = m.price, amount = s.quantity * m.price
+    FROM medicines m
+    WHERE m.medicine_id = s.medicine_id AND s.unit_price IS NULL
+    """)
+    cursor.execute("ALTER TABLE sales ALTER COLUMN unit_price SET NOT NULL")
+    cursor.execute("ALTER TABLE sales ALTER COLUMN amount SET NOT NULL")
+    print("Add Sale Price Columns Success!")
+
+    # 汇总触发器改为直接使用销售记录上的金额
+    cursor.execute(SALES_ROLLUP_FUNCTION.format(amount="r.amount"))
+    print("Update Sales Rollup Trigger Success!")
+
+# 把 sales 改建为按 sale_time 的月度范围分区表：分区表的主键必须包含分区键，改为 (sale_id, sale_time)。
+# 旧表改名后逐行复制到新表，沿用原来的序列，复制完成后再挂上索引与汇总触发器，复制过程不会重复计入汇总表。
+# 使用 PostgreSQL 的声明式分区；openGauss 等不支持的引擎在改名之前跳过，sales 保持为普通表
+def migrate_partitioned_sales(cursor):
+    if partitions.is_partitioned(cursor):
+        return
+    if not partitions.declarative_partitioning(cursor):
+        return False
+    cursor.execute("ALTER TABLE sales RENAME TO sales_unpartitioned")
+    cursor.execute("ALTER TABLE sales_unpartitioned RENAME CONSTRAINT sales_pkey TO sales_unpartitioned_pkey")
+    cursor.execute("DROP INDEX IF EXISTS idx_sales_user_time")
+    cursor.execute("DROP INDEX IF EXISTS idx_sales_medicine_time")
+    cursor.execute("""
+    CREATE TABLE sales (
+        sale_id INT NOT NULL DEFAULT nextval('sales_sale_id_seq'),
+        medicine_id INT REFERENCES medicines(medicine_id),
+        quantity INT,
+        sale_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        user_id INT REFERENCES users(user_id),
+        unit_price DECIMAL(10,2) NOT NULL,
+        amount DECIMAL(14,2) NOT NULL,
+        PRIMARY KEY (sale_id, sale_time)
+    ) PARTITION BY RANGE (sale_time)
+    """)
+    cursor.execute("SELECT MIN(sale_time) FROM sales_unpartitioned")
+    partitions.ensure_partitions(cursor, cursor.fetchone()[0])
+    print("Create Sales Partitions Success!")
+
+    cursor.execute("""
+    INSERT INTO sales (sale_id, medicine_id, quantity, sale_time, user_id, unit_price, amount)
+    SELECT sale_id, medicine_id, quantity, sale_time, user_id, unit_price, amount FROM sales_unpartitioned
+    """)
+    print(f"Copy {cursor.rowcount} Sales Success!")
+    cursor.execute("ALTER SEQUENCE sales_sale_id_seq OWNED BY sales.sale_id")
+    cursor.execute("DROP TABLE sales_unpartitioned")
+
+    cursor.execute("CREATE INDEX idx_sales_user_time ON sales (user_id, sale_time DESC, sale_id DESC)")
+    cursor.execute("CREATE INDEX idx_sales_medicine_time ON sales (medicine_id, sale_time DESC)")
+    cursor.execute("CREATE TRIGGER sales_rollup AFTER INSERT OR DELETE ON sales FOR EACH ROW EXECUTE PROCEDURE sales_rollup()")
+
+    # 已归档并移出数据库的分区目录
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sales_archive (
+        partition_name VARCHAR(50) PRIMARY KEY,
+        range_start DATE NOT NULL,
+        range_end DATE NOT NULL,
+        path TEXT NOT NULL,
+        row_count BIGINT NOT NULL,
+        file_bytes BIGINT NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    print("Partition Sales Table Success!")
+
+# 跨进程变更事件表，供不支持 LISTEN/NOTIFY 的数据库轮询使用（NOTIFY_CONFIG["mode"] = "poll"，见 notify.py）
+def migrate_change_events(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS change_events (
+        event_id BIGSERIAL PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL DEFAULT clock_timestamp(),
+        payload TEXT NOT NULL
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_events_created ON change_events (created_at)")
+    print("Create Change Events Table Success!")
+
+# 药品上的销售计数：sales_count 为库中引用该药品的销售记录条数，last_sold_at 为最近一次销售时间。
+# 由销售语句在扣减库存的同一次 UPDATE 中维护（见 sales.py），分区归档时扣除移出的记录数（见 partitions.py）；
+# 随药品目录一起缓存，删除面板、库存表与滞销药品视图不再按药品查询 sales
+def migrate_medicine_sales_counters(cursor):
+    if not column_exists(cursor, "medicines", "sales_count"):
+        cursor.execute("ALTER TABLE medicines ADD COLUMN sales_count INT NOT NULL DEFAULT 0")
+    if not column_exists(cursor, "medicines", "last_sold_at"):
+        cursor.execute("ALTER TABLE medicines ADD COLUMN last_sold_at TIMESTAMP")
+    rollups.backfill_medicine_counters(cursor)
+    print("Backfill Medicine Sales Counters Success!")
+
+# 软删除与后台分批删除（见 deletion.py）：药品、药店带 deleted_at，非空表示已下架/停用；
+# deletion_jobs 记录彻底删除任务及其进度，中断后据此继续
+def migrate_deletion_jobs(cursor):
+    for table in ("medicines", "pharmacies"):
+        if not column_exists(cursor, table, "deleted_at"):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN deleted_at TIMESTAMP")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS deletion_jobs (
+        job_id SERIAL PRIMARY KEY,
+        entity VARCHAR(20) NOT NULL,   -- medicine / pharmacy
+        target_id INT NOT NULL,
+        pharmacy_id INT,               -- 删除对象所在药店，药店管理员据此查看本店的任务
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        phase VARCHAR(50),
+        deleted_rows BIGINT NOT NULL DEFAULT 0,
+        total_rows BIGINT,             -- 由销售计数估算的总行数
+        error TEXT,
+        created_by INT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deletion_jobs_target ON deletion_jobs (entity, target_id)")
+    print("Create Deletion Jobs Table Success!")
+
+# 口令改为加盐哈希保存（见 auth.py）：加宽 password 列，把仍为明文的口令原地替换为哈希；
+# 已是哈希格式的行跳过，因此迁移中断后重跑只处理剩余的明文行
+def migrate_password_hashes(cursor):
+    cursor.execute("ALTER TABLE users ALTER COLUMN password TYPE VARCHAR(255)")
+    cursor.execute("SELECT user_id, password FROM users WHERE password NOT LIKE %s", (auth.ALGORITHM + "$%",))
+    rows = cursor.fetchall()
+    hashes = auth.hash_passwords([password for _, password in rows])
+    execute_values(cursor, """
+        UPDATE users u SET password = v.password
+        FROM (VALUES %s) AS v (user_id, password)
+        WHERE u.user_id = v.user_id
+    """, [(user_id, password_hash) for (user_id, _), password_hash in zip(rows, hashes)], page_size=1000)
+    print(f"Hash {len(rows)} User Passwords Success!")
+
+# 本地销售日志（见 journal.py）写库时的幂等键与冲突记录：每条日志记录写库时插入一行，键已存在说明已写过；
+# status 为 applied（正常写入）、short（库存不足，记下缺口 shortfall）或 missing（药品已不存在，未写销售记录）
+def migrate_sales_journal(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS journal_applied (
+        journal_key VARCHAR(32) PRIMARY KEY,
+        medicine_id INT,
+        pharmacy_id INT,
+        user_id INT,
+        quantity INT NOT NULL,
+        sold_at TIMESTAMP NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        shortfall INT NOT NULL DEFAULT 0,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        resolved_at TIMESTAMP
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_journal_applied_pharmacy ON journal_applied (pharmacy_id, status)")
+    print("Create Sales Journal Table Success!")
+
+# 补货统计（见 replenish.py）：replenishment_stats 按药品保存窗口内的销量累计值与由此算出的销售速度、补货点，
+# 每次运行只按新增的日期增量更新；replenishment_transfers 为最近一次运行给出的跨店调拨建议；
+# replenishment_runs 记录每次运行，最近一行的 through 为已计入统计的最后一天
+def migrate_replenishment(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS replenishment_stats (
+        medicine_id INT PRIMARY KEY,
+        pharmacy_id INT NOT NULL,
+        short_qty DOUBLE PRECISION NOT NULL,   -- 最近 velocity_days 天销量
+        long_qty DOUBLE PRECISION NOT NULL,    -- 最近 history_days 天销量
+        long_sq DOUBLE PRECISION NOT NULL,     -- 最近 history_days 天每日销量的平方和
+        velocity REAL NOT NULL,
+        demand_std REAL NOT NULL,
+        reorder_point REAL NOT NULL,
+        target_stock REAL NOT NULL
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_replenishment_stats_pharmacy ON replenishment_stats (pharmacy_id)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS replenishment_transfers (
+        from_medicine_id INT NOT NULL,
+        from_pharmacy_id INT NOT NULL,
+        to_medicine_id INT NOT NULL,
+        to_pharmacy_id INT NOT NULL,
+        quantity INT NOT NULL
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_replenishment_transfers_from ON replenishment_transfers (from_pharmacy_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_replenishment_transfers_to ON replenishment_transfers (to_pharmacy_id)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS replenishment_runs (
+        run_id SERIAL PRIMARY KEY,
+        full_rebuild BOOLEAN NOT NULL,
+        through DATE NOT NULL,
+        params TEXT NOT NULL,
+        medicines INT NOT NULL,
+        transfers INT NOT NULL,
+        seconds REAL NOT NULL,
+        run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    print("Create Replenishment Tables Success!")
+
+# 管理员用户、药店表格的过滤、排序与选择器（见 grids.py）
+def migrate_admin_grid_indexes(cursor):
+    # 用户表格按药店或角色过滤、按用户ID排序分页
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_pharmacy ON users (pharmacy_id, user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users (role, user_id)")
+    # 用户名、药店名称前缀匹配（LIKE 'abc%'）：非 C 排序规则的库只能使用 pattern_ops 索引
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users (username varchar_pattern_ops)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pharmacies_name_prefix ON pharmacies (name varchar_pattern_ops) WHERE deleted_at IS NULL")
+    # 药店表格只列未停用的药店，按名称排序分页
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pharmacies_name ON pharmacies (name, pharmacy_id) WHERE deleted_at IS NULL")
+
+# 不依赖 ON CONFLICT 的汇总触发器函数（金额取销售记录上的 amount），由迁移 14 替换已建好的函数。
+# 迁移 4、5 建立的函数保持原样，新库与已有的库都经过同样的迁移历史
+PORTABLE_SALES_ROLLUP_FUNCTION = """
+CREATE OR REPLACE FUNCTION sales_rollup() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+    v_sign INT;
+    v_pharmacy INT;
+    v_amount DECIMAL(16,2);
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        r := NEW;
+        v_sign := 1;
+    ELSE
+        r := OLD;
+        v_sign := -1;
+    END IF;
+    SELECT pharmacy_id, r.amount INTO v_pharmacy, v_amount
+    FROM medicines WHERE medicine_id = r.medicine_id;
+
+    -- 先更新汇总行，没有该行时插入；并发事务抢先插入了同一行时，插入失败的一方重新更新。
+    -- 不使用 ON CONFLICT，PostgreSQL 与 openGauss 都能执行
+    LOOP
+        UPDATE sales_daily
+        SET sale_count = sale_count + v_sign,
+            quantity = quantity + v_sign * r.quantity,
+            amount = amount + v_sign * COALESCE(v_amount, 0)
+        WHERE bucket = r.sale_time::date AND pharmacy_id = v_pharmacy
+            AND medicine_id = r.medicine_id AND user_id = COALESCE(r.user_id, 0);
+        EXIT WHEN FOUND;
+        BEGIN
+            INSERT INTO sales_daily (bucket, pharmacy_id, medicine_id, user_id, sale_count, quantity, amount)
+            VALUES (r.sale_time::date, v_pharmacy, r.medicine_id, COALESCE(r.user_id, 0),
+                    v_sign, v_sign * r.quantity, v_sign * COALESCE(v_amount, 0));
+            EXIT;
+        EXCEPTION WHEN unique_violation THEN
+            NULL;
+        END;
+    END LOOP;
+
+    LOOP
+        UPDATE sales_hourly
+        SET sale_count = sale_count + v_sign,
+            quantity = quantity + v_sign * r.quantity,
+            amount = amount + v_sign * COALESCE(v_amount, 0)
+        WHERE bucket = date_trunc('hour', r.sale_time) AND pharmacy_id = v_pharmacy
+            AND medicine_id = r.medicine_id AND user_id = COALESCE(r.user_id, 0);
+        EXIT WHEN FOUND;
+        BEGIN
+            INSERT INTO sales_hourly (bucket, pharmacy_id, medicine_id, user_id, sale_count, quantity, amount)
+            VALUES (date_trunc('hour', r.sale_time), v_pharmacy, r.medicine_id, COALESCE(r.user_id, 0),
+                    v_sign, v_sign * r.quantity, v_sign * COALESCE(v_amount, 0));
+            EXIT;
+        EXCEPTION WHEN unique_violation THEN
+            NULL;
+        END;
+    END LOOP;
+
+    IF v_sign < 0 THEN
+        DELETE FROM sales_daily WHERE bucket = r.sale_time::date AND pharmacy_id = v_pharmacy
+            AND medicine_id = r.medicine_id AND user_id = COALESCE(r.user_id, 0) AND sale_count <= 0;
+        DELETE FROM sales_hourly WHERE bucket = date_trunc('hour', r.sale_time) AND pharmacy_id = v_pharmacy
+            AND medicine_id = r.medicine_id AND user_id = COALESCE(r.user_id, 0) AND sale_count <= 0;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+def migrate_portable_rollup_trigger(cursor):
+    cursor.execute(PORTABLE_SALES_ROLLUP_FUNCTION)
+    print("Update Sales Rollup Trigger Success!")
+
+# (版本号, 名称, 迁移函数)，版本号只增不改，已发布的迁移不要修改
+MIGRATIONS = [
+    (1, "base tables", migrate_base_tables),
+    (2, "hot query indexes", migrate_hot_query_indexes),
+    (3, "trigram search indexes", migrate_trigram_indexes),
+    (4, "sales rollups", migrate_sales_rollups),
+    (5, "sale prices", migrate_sale_prices),
+    (6, "partitioned sales", migrate_partitioned_sales),
+    (7, "change events", migrate_change_events),
+    (8, "medicine sales counters", migrate_medicine_sales_counters),
+    (9, "deletion jobs", migrate_deletion_jobs),
+    (10, "password hashes", migrate_password_hashes),
+    (11, "sales journal", migrate_sales_journal),
+    (12, "replenishment", migrate_replenishment),
+    (13, "admin grid indexes", migrate_admin_grid_indexes),
+    (14, "portable rollup trigger", migrate_portable_rollup_trigger),
+]
+
+# 迁移锁的任意常量键，防止两个 init.py 同时迁移
+MIGRATION_LOCK_KEY = 20240601
+
+def run_migrations(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS medicines (
-            medicine_id SERIAL PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
             name VARCHAR(100) NOT NULL,
-            manufacturer VARCHAR(100),
-            code VARCHAR(50) UNIQUE,
-            price DECIMAL(10,2),
-            stock INT,
-            pharmacy_id INT NOT NULL REFERENCES pharmacies(pharmacy_id)
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
         """)
-        print("Create Medicines Table Success!")
-        
-        # 创建销售记录表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sales (
-            sale_id SERIAL PRIMARY KEY,
-            medicine_id INT REFERENCES medicines(medicine_id),
-            quantity INT,
-            sale_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            user_id INT REFERENCES users(user_id)
-        );
-        """)
-        print("Create Sales Table Success!")
-        
-        # 插入初始测试数据，先插入药店
-        cursor.execute("""
-        INSERT INTO pharmacies (name, address) 
-        VALUES ('总店', '北京市朝阳区') 
-        RETURNING pharmacy_id;
-        """)
-        pharmacy_id = cursor.fetchone()[0]
-        print(f"Pharmacy ID: {pharmacy_id}")
-        
-        # 然后插入用户
-        cursor.execute("""
-        INSERT INTO users (username, password, role, pharmacy_id) 
-        VALUES 
-            ('admin', 'admin@pw', 0, %s),
-            ('manager', 'manager@pw', 1, %s),
-            ('sales', 'sales@pw', 2, %s);
-        """, (pharmacy_id, pharmacy_id, pharmacy_id))
-        print("Insert Users Success!")
-        
-        # 然后插入药品
-        cursor.execute("""
-        INSERT INTO medicines (name, manufacturer, code, price, stock, pharmacy_id)
-        VALUES 
-            ('阿莫西林胶囊', '云南白药', 'AMXL123', 25.5, 100, %s),
-            ('板蓝根颗粒', '同仁堂', 'BLG456', 18.0, 80, %s),
-            ('布洛芬缓释胶囊', '中美天津史克', 'BLF789', 30.0, 150, %s),
-            ('复方丹参片', '广州白云山', 'FFDS001', 20.5, 200, %s),
-            ('维生素C片', '养生堂', 'WEISC002', 15.8, 300, %s),
-            ('连花清瘟胶囊', '以岭药业', 'LHWQ003', 28.0, 120, %s),
-            ('藿香正气水', '太极集团', 'HXZQ004', 12.5, 180, %s),
-            ('阿司匹林肠溶片', '拜耳医药', 'ASPL005', 22.0, 100, %s),
-            ('头孢克肟分散片', '白云山制药', 'TBKW006', 45.0, 80, %s),
-            ('盐酸左氧氟沙星胶囊', '第一三共制药', 'YSLY007', 35.0, 90, %s);
-        """, (pharmacy_id,) * 10)
-        print("Insert Medicines Success!")
-        
         conn.commit()
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cursor.fetchall()}
+
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            if migrate(cursor) is False:
+                conn.rollback()
+                print(f"Skip Migration {version} ({name}): not supported by this database")
+                continue
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+            print(f"Apply Migration {version} ({name}) Success!")
+    finally:
+        conn.rollback()
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+
+# 仅在空库中插入初始测试数据，重复运行不会产生重复数据
+def seed_data(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM pharmacies")
+    if cursor.fetchone()[0] > 0:
+        print("Seed Data Exists, Skip Inserting")
+        return
+
+    # 插入初始测试数据，先插入药店
+    cursor.execute("""
+    INSERT INTO pharmacies (name, address)
+    VALUES ('总店', '北京市朝阳区')
+    RETURNING pharmacy_id;
+    """)
+    pharmacy_id = cursor.fetchone()[0]
+    print(f"Pharmacy ID: {pharmacy_id}")
+
+    # 然后插入用户，口令以哈希保存
+    admin_pw, manager_pw, sales_pw = auth.hash_passwords(["admin@pw", "manager@pw", "sales@pw"])
+    cursor.execute("""
+    INSERT INTO users (username, password, role, pharmacy_id)
+    VALUES
+        ('admin', %s, 0, %s),
+        ('manager', %s, 1, %s),
+        ('sales', %s, 2, %s);
+    """, (admin_pw, pharmacy_id, manager_pw, pharmacy_id, sales_pw, pharmacy_id))
+    print("Insert Users Success!")
+
+    # 然后插入药品
+    cursor.execute("""
+    INSERT INTO medicines (name, manufacturer, code, price, stock, pharmacy_id)
+    VALUES
+        ('阿莫西林胶囊', '云南白药', 'AMXL123', 25.5, 100, %s),
+        ('板蓝根颗粒', '同仁堂', 'BLG456', 18.0, 80, %s),
+        ('布洛芬缓释胶囊', '中美天津史克', 'BLF789', 30.0, 150, %s),
+        ('复方丹参片', '广州白云山', 'FFDS001', 20.5, 200, %s),
+        ('维生素C片', '养生堂', 'WEISC002', 15.8, 300, %s),
+        ('连花清瘟胶囊', '以岭药业', 'LHWQ003', 28.0, 120, %s),
+        ('藿香正气水', '太极集团', 'HXZQ004', 12.5, 180, %s),
+        ('阿司匹林肠溶片', '拜耳医药', 'ASPL005', 22.0, 100, %s),
+        ('头孢克肟分散片', '白云山制药', 'TBKW006', 45.0, 80, %s),
+        ('盐酸左氧氟沙星胶囊', '第一三共制药', 'YSLY007', 35.0, 90, %s);
+    """, (pharmacy_id,) * 10)
+    print("Insert Medicines Success!")
+    conn.commit()
+
+# 已知热点查询：(名称, SQL, 取样本参数的 SQL)，样本参数取真实存在的值，使执行计划贴近线上
+HOT_QUERIES = [
+    ("inventory by pharmacy",
+     "SELECT medicine_id, name, manufacturer, code, price, stock, sales_count, last_sold_at FROM medicines WHERE pharmacy_id = %s AND deleted_at IS NULL",
+     "SELECT pharmacy_id FROM medicines GROUP BY pharmacy_id ORDER BY COUNT(*) DESC LIMIT 1"),
+    ("medicine search",
+     "SELECT * FROM medicines WHERE pharmacy_id = %s AND deleted_at IS NULL AND (name ILIKE '%%片%%' OR manufacturer ILIKE '%%片%%' OR code ILIKE '%%片%%')",
+     "SELECT pharmacy_id FROM medicines GROUP BY pharmacy_id ORDER BY COUNT(*) DESC LIMIT 1"),
+    ("login",
+     "SELECT user_id, role, pharmacy_id FROM users WHERE username = %s",
+     "SELECT username FROM users LIMIT 1"),
+    ("sales history page",
+     """SELECT s.sale_id, s.sale_time, m.name, s.quantity, s.unit_price, s.amount
+        FROM sales s JOIN medicines m ON s.medicine_id = m.medicine_id
+        WHERE s.user_id = %s AND s.sale_time >= CURRENT_DATE - INTERVAL '29 days'
+        ORDER BY s.sale_time DESC, s.sale_id DESC LIMIT 51""",
+     "SELECT user_id FROM sales GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1"),
+    ("recent sales of medicine",
+     "SELECT s.sale_id, s.quantity, s.sale_time FROM sales s WHERE s.medicine_id = %s ORDER BY s.sale_time DESC LIMIT 10",
+     "SELECT medicine_id FROM sales GROUP BY medicine_id ORDER BY COUNT(*) DESC LIMIT 1"),
+    ("replenishment by pharmacy",
+     "SELECT medicine_id, velocity, demand_std, reorder_point, target_stock FROM replenishment_stats WHERE pharmacy_id = %s",
+     "SELECT pharmacy_id FROM medicines GROUP BY pharmacy_id ORDER BY COUNT(*) DESC LIMIT 1"),
+    ("user grid by pharmacy",
+     "SELECT user_id, username, role, pharmacy_id FROM users WHERE pharmacy_id = %s ORDER BY user_id LIMIT 51",
+     "SELECT pharmacy_id FROM users GROUP BY pharmacy_id ORDER BY COUNT(*) DESC LIMIT 1"),
+    ("user picker by name prefix",
+     "SELECT user_id, username, role, pharmacy_id FROM users WHERE username LIKE %s ORDER BY user_id LIMIT 21",
+     "SELECT left(username, 4) || '%' FROM users ORDER BY user_id DESC LIMIT 1"),
+    ("pharmacy grid by name",
+     "SELECT pharmacy_id, name, address FROM pharmacies WHERE deleted_at IS NULL AND name LIKE %s ORDER BY name, pharmacy_id LIMIT 51",
+     "SELECT left(name, 3) || '%' FROM pharmacies ORDER BY pharmacy_id DESC LIMIT 1"),
+]
+
+# 行数超过该值的表不允许出现在热点查询的顺序扫描中
+LARGE_TABLE_ROWS = 10000
+
+def iter_plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from iter_plan_nodes(child)
+
+# 对每个热点查询做 EXPLAIN，若在大表上出现顺序扫描则报告并返回 False
+def check_query_plans(conn):
+    cursor = conn.cursor()
+    cursor.execute("ANALYZE")
+    cursor.execute("""
+        SELECT relname, reltuples FROM pg_class
+        WHERE relname IN ('users', 'pharmacies', 'medicines', 'sales')
+    """)
+    table_rows = dict(cursor.fetchall())
+
+    ok = True
+    for name, query, sample_query in HOT_QUERIES:
+        cursor.execute(sample_query)
+        sample = cursor.fetchone()
+        if sample is None:
+            print(f"Skip Plan Check ({name}): no sample data")
+            continue
+        cursor.execute("EXPLAIN (FORMAT JSON) " + query, sample)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        seq_scans = [
+            node["Relation Name"] for node in iter_plan_nodes(plan[0]["Plan"])
+            if node["Node Type"] == "Seq Scan" and table_rows.get(node["Relation Name"], 0) > LARGE_TABLE_ROWS
+        ]
+        if seq_scans:
+            ok = False
+            print(f"Plan Check Failed ({name}): sequential scan on {', '.join(seq_scans)}")
+        else:
+            print(f"Plan Check Passed ({name})")
+    conn.rollback()
+    return ok
+
+def init_database(check_plans=False):
+    conn = None
+    try:
+        # 尝试连接数据库
+        conn = psycopg2.connect(**DB_CONFIG)
+        print("Database Connect Success!")
+
+        # 按版本执行尚未应用的迁移，每个迁移一个事务
+        run_migrations(conn)
+        # 补齐未来月份的销售分区
+        with conn.cursor() as cursor:
+            partitions.ensure_partitions(cursor)
+        conn.commit()
+        seed_data(conn)
         print("Database Initialization Success!")
-        
+
+        if check_plans and not check_query_plans(conn):
+            return False
+        return True
+
     except psycopg2.OperationalError as oe:
         print(f"Link Error: {str(oe)}")
         print("Please check the configurations in config.py")
@@ -115,6 +680,9 @@ def init_database():
     finally:
         if conn:
             conn.close()
+    return False
 
 if __name__ == "__main__":
-    init_database()
\ No newline at end of file
+    # python init.py --check-plans：迁移后检查热点查询的执行计划，存在大表顺序扫描时以非零状态退出
+    ok = init_database(check_plans="--check-plans" in sys.argv)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,467 @@
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from config import JOURNAL_CONFIG
+from db import get_conn, PoolExhausted
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，用 msvcrt 的字节锁代替
+    fcntl = None
+    import msvcrt
+
+# 本地销售日志：数据库变慢或不可达（例如维护窗口）时，销售先以 JSON 行追加到本地日志文件，落盘后立即向收银员确认，
+# 由后台线程按批写入 medicines / sales。
+#   - 每条销售带唯一的日志键，写库时先把键插入 journal_applied（见 init.py 迁移 11），已存在的键跳过，重复回放不会重复销售
+#   - 多个线程同时追加时合并 fsync：一个线程执行 fsync，期间写入的其他线程等它（或下一次）fsync 完成后返回
+#   - 日志按段存放，后台线程每次先切换到新段，再把已关闭的段整段写库，全部写入后删除该段
+#   - 写库时库存已不足（其他终端在此期间卖掉了）的销售照常记账，库存扣到 0，记为 short 冲突并记下缺口；
+#     药品已被彻底删除的记为 missing，不写销售记录。冲突显示在药店管理员的页面上，由人工核对
+#   - 每个进程独占 journal 目录下的一个槽位目录（文件锁），进程异常退出后锁随之释放，
+#     任何进程的后台线程或 python journal.py 都会接手该槽位中剩余的段
+#
+# mode：off 直接写库；fallback 正常直接写库，取不到数据库连接或执行失败（尚未提交）时改记日志；write_behind 总是先记日志
+
+MODE = JOURNAL_CONFIG["mode"]
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), JOURNAL_CONFIG["dir"])
+
+# 可以改记日志的数据库错误：连接失败、连接池已满
+UNAVAILABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolExhausted)
+
+def _try_lock(f):
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+def _segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+
+# 按槽位编号依次尝试加锁，返回 (槽位目录, 锁文件)；锁文件保持打开，进程退出时由操作系统释放
+def _lock_slot(skip=None):
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    for name in sorted(os.listdir(JOURNAL_DIR)) + [None]:
+        if name is None:
+            name = f"slot-{uuid.uuid4().hex[:8]}"
+        directory = os.path.join(JOURNAL_DIR, name)
+        if directory == skip or not name.startswith("slot-"):
+            continue
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, "lock"), "a+b")
+        if _try_lock(lock):
+            return directory, lock
+        lock.close()
+    return None, None
+
+
+class Journal:
+    def __init__(self, directory, lock_file):
+        self.directory = directory
+        # 槽位的锁文件，保持打开直到进程退出
+        self.lock_file = lock_file
+        # 写文件与切换段
+        self._lock = threading.Lock()
+        # 合并 fsync：_written 为已写入操作系统的追加次数，_synced 为已落盘的追加次数
+        self._sync_cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._fsyncs = 0
+        existing = _segments(directory)
+        self._next_segment = int(existing[-1].split(".")[0]) + 1 if existing else 0
+        self._size = 0
+        self._fd = self._open_segment()
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f"{self._next_segment:010d}.log")
+        self._next_segment += 1
+        self._size = 0
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0), 0o644)
+
+    # 追加一组记录，落盘后返回；fsync 失败时抛出 OSError，调用方不能向收银员确认
+    def append(self, records):
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode()
+        with self._lock:
+            os.write(self._fd, data)
+            self._size += len(data)
+            self._written += 1
+            ticket = self._written
+        with self._sync_cond:
+            while self._synced < ticket:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                # 由本线程执行这一次 fsync，覆盖到此刻为止所有线程写入的记录；fsync 期间不持有条件锁
+                self._syncing = True
+                self._sync_cond.release()
+                try:
+                    with self._lock:
+                        target = self._written
+                        fd = os.dup(self._fd)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                    self._sync_cond.notify_all()
+                self._synced = max(self._synced, target)
+                self._fsyncs += 1
+
+    # 当前段有内容时切换到新段，之前的段交给后台线程写库；返回是否切换
+    def rotate(self):
+        with self._lock:
+            if self._size == 0:
+                return False
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = self._open_segment()
+            written = self._written
+        with self._sync_cond:
+            self._synced = max(self._synced, written)
+            self._sync_cond.notify_all()
+        return True
+
+    # 已关闭（不再写入）的段
+    def closed_segments(self):
+        with self._lock:
+            current = f"{self._next_segment - 1:010d}.log"
+        return [name for name in _segments(self.directory) if name != current]
+
+    def stats(self):
+        with self._sync_cond:
+            return {"directory": self.directory, "appends": self._written, "fsyncs": self._fsyncs}
+
+
+# 读取一个段中的记录，返回 (记录, 跳过的不完整行数)；进程在写入中途退出时最后一行可能不完整，
+# 这样的行从未被确认，跳过。写库时跳过的行数计入 stats()，python journal.py --status 按槽位显示
+def read_segment(path):
+    records = []
+    torn = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                torn += 1
+    return records, torn
+
+def make_record(medicine_id, quantity, user_id, pharmacy_id, unit_price, sold_at):
+    return {"key": uuid.uuid4().hex, "medicine_id": medicine_id, "quantity": quantity, "user_id": user_id,
+            "pharmacy_id": pharmacy_id, "unit_price": str(unit_price), "sold_at": sold_at.isoformat(sep=" ")}
+
+# 在给定连接上写入一批日志记录（不提交），返回写库后的药品行 [{medicine_id, pharmacy_id, stock, sales_count, last_sold_at}]
+# 与本批新记下的冲突数；已写过的记录跳过
+def apply_records(conn, records):
+    if not records:
+        return [], 0
+    with conn.cursor() as cur:
+        # 按 medicine_id 顺序锁住涉及的药品行，与结算的加锁顺序一致
+        cur.execute("""
+            SELECT medicine_id, pharmacy_id, stock FROM medicines
+            WHERE medicine_id = ANY(%s) ORDER BY medicine_id FOR UPDATE
+        """, (list({r['medicine_id'] for r in records}),))
+        medicines = {row['medicine_id']: row for row in cur.fetchall()}
+        # 销售员在此期间被删除时销售记录不再关联到人
+        cur.execute("SELECT user_id FROM users WHERE user_id = ANY(%s)", (list({r['user_id'] for r in records}),))
+        users = {row['user_id'] for row in cur.fetchall()}
+        # 跳过已写过的记录，其余记下幂等键（不使用 ON CONFLICT，openGauss 同样可用）。
+        # 另一进程同时写入同一条记录时主键冲突，本批回滚，段保留到下次重试时再跳过
+        cur.execute("SELECT journal_key FROM journal_applied WHERE journal_key = ANY(%s)",
+                    ([r['key'] for r in records],))
+        fresh = set()
+        applied = {row['journal_key'] for row in cur.fetchall()}
+        rows = []
+        for r in records:
+            if r['key'] in applied or r['key'] in fresh:
+                continue
+            fresh.add(r['key'])
+            rows.append((r['key'], r['medicine_id'], r['pharmacy_id'], r['user_id'], r['quantity'], r['sold_at'],
+                         "applied" if r['medicine_id'] in medicines else "missing"))
+        if rows:
+            execute_values(cur, """
+                INSERT INTO journal_applied (journal_key, medicine_id, pharmacy_id, user_id, quantity, sold_at, status)
+                VALUES %s
+            """, rows, page_size=len(rows))
+
+        # 按日志顺序分配库存，库存不够的部分记为缺口
+        stocks = {mid: row['stock'] for mid, row in medicines.items()}
+        sales_rows, updates, conflicts = [], {}, []
+        for r in records:
+            if r['key'] not in fresh or r['medicine_id'] not in medicines:
+                continue
+            fresh.discard(r['key'])
+            mid = r['medicine_id']
+            taken = min(r['quantity'], max(stocks[mid], 0))
+            stocks[mid] -= taken
+            if taken < r['quantity']:
+                conflicts.append((r['key'], r['quantity'] - taken))
+            price = Decimal(r['unit_price'])
+            user_id = r['user_id'] if r['user_id'] in users else None
+            sales_rows.append((mid, r['quantity'], user_id, r['sold_at'], price, r['quantity'] * price))
+            count, last = updates.get(mid, (0, r['sold_at']))
+            updates[mid] = (count + 1, max(last, r['sold_at']))
+        missing = sum(1 for r in records if r['key'] in fresh)
+        if not sales_rows:
+            return [], missing
+
+        execute_values(cur, """
+            INSERT INTO sales (medicine_id, quantity, user_id, sale_time, unit_price, amount) VALUES %s
+        """, sales_rows, page_size=len(sales_rows))
+        changed = execute_values(cur, """
+            UPDATE medicines m
+            SET stock = v.stock, sales_count = m.sales_count + v.sale_count,
+                last_sold_at = GREATEST(m.last_sold_at, v.last_sold_at::timestamp)
+            FROM (VALUES %s) AS v (medicine_id, stock, sale_count, last_sold_at)
+            WHERE m.medicine_id = v.medicine_id
+            RETURNING m.medicine_id, m.pharmacy_id, m.stock, m.sales_count, m.last_sold_at
+        """, [(mid, stocks[mid], count, last) for mid, (count, last) in updates.items()],
+            page_size=len(updates), fetch=True)
+        if conflicts:
+            execute_values(cur, """
+                UPDATE journal_applied j SET status = 'short', shortfall = v.shortfall
+                FROM (VALUES %s) AS v (journal_key, shortfall)
+                WHERE j.journal_key = v.journal_key
+            """, conflicts, page_size=len(conflicts))
+    return changed, len(conflicts) + missing
+
+# 段 -> 本进程已提交并交给 on_applied 的记录数。中途某批失败时段保留，重试从第一个未提交的批开始，
+# 已提交的批不会再次交给 on_applied（否则待写库计数被重复扣减）；进程重启后从头开始，由 journal_applied 跳过已写过的记录
+_committed = {}
+
+# 把一个段按批写库，每批单独提交；全部成功后删除该段并返回本次写入的记录数，数据库不可用时抛出异常、段保留
+def flush_segment(path, publish=None, on_applied=None):
+    global _torn_lines
+    records, torn = read_segment(path)
+    done = _committed.get(path, 0)
+    for start in range(done, len(records), JOURNAL_CONFIG["batch_size"]):
+        batch = records[start:start + JOURNAL_CONFIG["batch_size"]]
+        with get_conn() as conn:
+            changed, conflicts = apply_records(conn, batch)
+            if publish and changed:
+                publish(conn, changed)
+        _committed[path] = start + len(batch)
+        if on_applied:
+            on_applied(batch, changed)
+    os.remove(path)
+    _committed.pop(path, None)
+    _torn_lines += torn
+    return len(records) - done
+
+# 接手没有进程持有的其他槽位：把剩余的段全部写库，返回写入的记录数
+def recover_orphans(own_directory=None, publish=None, on_applied=None):
+    if not os.path.isdir(JOURNAL_DIR):
+        return 0
+    flushed = 0
+    for name in sorted(os.listdir(JOURNAL_DIR)):
+        directory = os.path.join(JOURNAL_DIR, name)
+        if directory == own_directory or not name.startswith("slot-"):
+            continue
+        with open(os.path.join(directory, "lock"), "a+b") as lock:
+            if not _try_lock(lock):
+                continue
+            for segment in _segments(directory):
+                flushed += flush_segment(os.path.join(directory, segment), publish, on_applied)
+    return flushed
+
+# 本进程已写库并删除的段中跳过的不完整行数
+_torn_lines = 0
+
+# 已记入日志、尚未写库的销售：按销售员统计条数，按药品统计数量
+_pending = Counter()
+_pending_quantity = Counter()
+_pending_lock = threading.Lock()
+
+def _count_pending(records, sign):
+    with _pending_lock:
+        for r in records:
+            _pending[r['user_id']] += sign
+            _pending_quantity[r['medicine_id']] += sign * r['quantity']
+        # Counter 的 += 不会删除归零的键，保持字典只含未写库的部分
+        for counter in (_pending, _pending_quantity):
+            for key in [k for k, v in counter.items() if v <= 0]:
+                del counter[key]
+
+# 记账前登记待写库的销售；追加失败时调用 release 撤销
+def reserve(records):
+    _count_pending(records, 1)
+
+def release(records):
+    _count_pending(records, -1)
+
+def pending_count(user_id=None):
+    with _pending_lock:
+        return _pending.get(user_id, 0) if user_id is not None else sum(_pending.values())
+
+# 数据库中的库存 {medicine_id: stock} 减去本进程尚未写库的数量，即收银台应看到的库存
+def unflushed_stock(stocks):
+    with _pending_lock:
+        if not _pending_quantity:
+            return stocks
+        return {mid: stock - _pending_quantity.get(mid, 0) for mid, stock in stocks.items()}
+
+
+class JournalFlusher(threading.Thread):
+    def __init__(self, journal, publish, on_applied):
+        super().__init__(name="journal-flusher", daemon=True)
+        self.journal = journal
+        self.publish = publish
+        self.on_applied = on_applied
+        self._wake = threading.Event()
+        self.flushed = 0
+        self.last_error = None
+        self._cleaned_at = 0.0
+
+    def wake(self):
+        self._wake.set()
+
+    def _applied(self, records, changed):
+        release(records)
+        if self.on_applied:
+            self.on_applied(records, changed)
+
+    def flush_once(self):
+        if self.journal is not None:
+            self.journal.rotate()
+            for segment in self.journal.closed_segments():
+                self.flushed += flush_segment(os.path.join(self.journal.directory, segment),
+                                              self.publish, self._applied)
+        self.flushed += recover_orphans(self.journal.directory if self.journal else None, self.publish, self.on_applied)
+        if time.monotonic() - self._cleaned_at > 3600:
+            cleanup()
+            self._cleaned_at = time.monotonic()
+
+    def run(self):
+        while True:
+            try:
+                self.flush_once()
+                self.last_error = None
+                interval = JOURNAL_CONFIG["flush_interval"]
+            except (psycopg2.Error, PoolExhausted) as e:
+                # 数据库不可用：段保留在磁盘上，稍后重试
+                self.last_error = str(e).strip()
+                interval = JOURNAL_CONFIG["retry_interval"]
+            self._wake.wait(interval)
+            self._wake.clear()
+
+
+_journal = None
+_flusher = None
+_start_lock = threading.Lock()
+
+# 每个进程启动一次：占用一个槽位并启动后台写库线程；本槽位中上次遗留的段会先被写库。
+# mode 为 off 时不写日志，但仍接手其他进程遗留的段。publish(conn, rows) 在写库事务中调用，
+# on_applied(records, rows) 在每批提交后调用，records 为本批日志记录，rows 为写库后的药品行
+def start(publish=None, on_applied=None):
+    global _journal, _flusher
+    with _start_lock:
+        if _flusher is not None and _flusher.is_alive():
+            return _flusher
+        if MODE != "off" and _journal is None:
+            directory, _lock_file = _lock_slot()
+            if directory is not None:
+                _journal = Journal(directory, _lock_file)
+                # 遗留的段计入待写库数量
+                for segment in _journal.closed_segments():
+                    reserve(read_segment(os.path.join(directory, segment))[0])
+        if _journal is None and not (os.path.isdir(JOURNAL_DIR) and os.listdir(JOURNAL_DIR)):
+            return None
+        _flusher = JournalFlusher(_journal, publish, on_applied)
+        _flusher.start()
+    return _flusher
+
+def enabled():
+    return _journal is not None
+
+# 把一组已 reserve 的销售记入日志，落盘后返回；日志未启用时抛出 RuntimeError
+def append(records):
+    if _journal is None:
+        raise RuntimeError("销售日志未启用")
+    _journal.append(records)
+
+def wake_flusher():
+    if _flusher is not None:
+        _flusher.wake()
+
+def stats():
+    return {
+        "mode": MODE,
+        "pending": pending_count(),
+        "journal": _journal.stats() if _journal else None,
+        "flushed": _flusher.flushed if _flusher else 0,
+        "torn_lines": _torn_lines,
+        "last_error": _flusher.last_error if _flusher else None,
+    }
+
+# 删除早于保留天数的已写库记录；冲突记录在处理后同样按保留天数删除
+def cleanup():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM journal_applied
+                WHERE applied_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+                AND (status = 'applied' OR resolved_at IS NOT NULL)
+            """, (JOURNAL_CONFIG["retention_days"],))
+            return cur.rowcount
+
+def list_conflicts(cur, pharmacy_id=None, limit=200):
+    cur.execute("""
+        SELECT j.journal_key, j.medicine_id, m.name, j.user_id, u.username, j.quantity, j.shortfall,
+               j.status, j.sold_at, j.applied_at
+        FROM journal_applied j
+        LEFT JOIN medicines m ON m.medicine_id = j.medicine_id
+        LEFT JOIN users u ON u.user_id = j.user_id
+        WHERE j.status <> 'applied' AND j.resolved_at IS NULL
+        AND (%(pharmacy_id)s::int IS NULL OR j.pharmacy_id = %(pharmacy_id)s)
+        ORDER BY j.sold_at DESC LIMIT %(limit)s
+    """, {"pharmacy_id": pharmacy_id, "limit": limit})
+    return cur.fetchall()
+
+def resolve_conflicts(cur, journal_keys, pharmacy_id=None):
+    cur.execute("""
+        UPDATE journal_applied SET resolved_at = CURRENT_TIMESTAMP
+        WHERE journal_key = ANY(%(keys)s) AND resolved_at IS NULL
+        AND (%(pharmacy_id)s::int IS NULL OR pharmacy_id = %(pharmacy_id)s)
+    """, {"keys": list(journal_keys), "pharmacy_id": pharmacy_id})
+    return cur.rowcount
+
+def main():
+    parser = argparse.ArgumentParser(description="把本地销售日志中未写库的销售写入数据库")
+    parser.add_argument("--status", action="store_true", help="只显示各槽位待写库的记录数与未处理的冲突")
+    args = parser.parse_args()
+
+    if args.status:
+        if os.path.isdir(JOURNAL_DIR):
+            for name in sorted(os.listdir(JOURNAL_DIR)):
+                directory = os.path.join(JOURNAL_DIR, name)
+                segments = [read_segment(os.path.join(directory, s)) for s in _segments(directory)]
+                count = sum(len(records) for records, _ in segments)
+                torn = sum(torn for _, torn in segments)
+                print(f"{name}: {count} pending, {torn} torn lines skipped")
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                for c in list_conflicts(cur):
+                    print(f"{c['sold_at']} {c['status']} medicine {c['medicine_id']} {c['name'] or ''} "
+                          f"quantity {c['quantity']} shortfall {c['shortfall']} user {c['username'] or c['user_id']}")
+        return
+    flushed = recover_orphans()
+    print(f"Journal Recovery Success! {flushed} sales written")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from db import get_conn, get_pool
+import auth
+import data
+import profiler
+import export
+import sales
+
+# 压测驱动：多线程按权重随机调用 data.py 中的页面数据函数，统计每种操作的延迟分位数与吞吐。
+# 登录使用 datagen.py 生成的 gen_ 账号（密码为 <用户名>@pw）
+
+# 操作名 -> 默认权重，大致对应收银台高峰期的调用比例
+OPERATION_WEIGHTS = {
+    "login": 2,
+    "inventory": 30,
+    "search": 30,
+    "sell": 25,
+    "history": 10,
+    "export": 1,
+}
+
+SEARCH_KEYWORDS = ["阿莫西林", "颗粒", "片", "胶囊", "同仁堂", "GEN0000", "维生素", "白云山"]
+
+class _Discard:
+    def write(self, chunk):
+        return len(chunk)
+
+# 压测前从库中抽样销售员及其药店的药品，压测过程中不再为选参数访问数据库
+def load_fixtures(sample_users):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT user_id, username, pharmacy_id FROM users
+                WHERE role = 2 AND username LIKE 'gen\\_%%' AND pharmacy_id IS NOT NULL
+                ORDER BY random() LIMIT %s
+            """, (sample_users,))
+            users = cur.fetchall()
+            if not users:
+                raise SystemExit("没有可用的 gen_ 销售员，请先运行 python datagen.py")
+            cur.execute("""
+                SELECT pharmacy_id, array_agg(medicine_id) AS medicine_ids
+                FROM medicines WHERE pharmacy_id = ANY(%s)
+                GROUP BY pharmacy_id
+            """, (list({u['pharmacy_id'] for u in users}),))
+            medicines = {row['pharmacy_id']: row['medicine_ids'] for row in cur.fetchall()}
+    return [u for u in users if u['pharmacy_id'] in medicines], medicines
+
+def make_operations(use_cache):
+    # --no-cache 时绕过进程内缓存，直接测量数据库路径
+    unwrap = (lambda f: f) if use_cache else (lambda f: f.__wrapped__)
+    get_medicines = unwrap(data.get_medicines)
+    search_medicines = unwrap(data.search_medicines)
+
+    # 登录总要计算一次口令哈希，不受 --no-cache 影响
+    def login(user, medicines):
+        return auth.login(user['username'], f"{user['username']}@pw") is not None
+
+    def inventory(user, medicines):
+        return get_medicines(user['pharmacy_id']) is not None
+
+    def search(user, medicines):
+        return search_medicines(user['pharmacy_id'], random.choice(SEARCH_KEYWORDS)) is not None
+
+    def sell(user, medicines):
+        medicine_id = random.choice(medicines[user['pharmacy_id']])
+        return data.sell_medicine(medicine_id, 1, user['user_id'], user['pharmacy_id']) is not None
+
+    def history(user, medicines):
+        with get_conn() as conn:
+            sales.history_totals(conn, user['user_id'], "最近30天")
+            sales.history_page(conn, user['user_id'], "最近30天")
+        return True
+
+    def export_recent(user, medicines):
+        export.export_sales(_Discard(), "csv", user_id=user['user_id'], time_range="最近7天")
+        return True
+
+    return {
+        "login": login,
+        "inventory": inventory,
+        "search": search,
+        "sell": sell,
+        "history": history,
+        "export": export_recent,
+    }
+
+def percentile_ms(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+def run(operations, weights, concurrency, duration, users, medicines):
+    names = list(weights)
+    probs = [weights[n] for n in names]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def worker():
+        local_lat = defaultdict(list)
+        local_err = defaultdict(int)
+        while time.perf_counter() < stop_at:
+            name = random.choices(names, probs)[0]
+            user = random.choice(users)
+            begin = time.perf_counter()
+            try:
+                ok = operations[name](user, medicines)
+            except Exception:
+                ok = False
+            local_lat[name].append(time.perf_counter() - begin)
+            if not ok:
+                local_err[name] += 1
+        with lock:
+            for name, values in local_lat.items():
+                latencies[name].extend(values)
+            for name, count in local_err.items():
+                errors[name] += count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    begin = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors, time.perf_counter() - begin
+
+def report(latencies, errors, elapsed):
+    print(f"{'operation':<10} {'count':>8} {'errors':>7} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    total = 0
+    for name in OPERATION_WEIGHTS:
+        values = latencies.get(name, [])
+        if not values:
+            continue
+        total += len(values)
+        print(f"{name:<10} {len(values):>8} {errors.get(name, 0):>7} {len(values) / elapsed:>9.1f} "
+              f"{percentile_ms(values, 50):>9.2f} {percentile_ms(values, 95):>9.2f} {percentile_ms(values, 99):>9.2f}")
+    print(f"{'total':<10} {total:>8} {sum(errors.values()):>7} {total / elapsed:>9.1f}")
+    print(f"pool: {get_pool().stats()}")
+
+def main():
+    parser = argparse.ArgumentParser(description="对页面数据函数做并发压测")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="压测秒数")
+    parser.add_argument("--ops", default=",".join(OPERATION_WEIGHTS),
+                        help="参与压测的操作，逗号分隔，可写成 name:weight 覆盖默认权重")
+    parser.add_argument("--sample-users", type=int, default=500)
+    parser.add_argument("--no-cache", action="store_true", help="绕过进程内缓存")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--metrics", help="压测结束后把按语句统计的指标写入该 JSON 文件")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    weights = {}
+    for item in args.ops.split(","):
+        name, _, weight = item.partition(":")
+        if name not in OPERATION_WEIGHTS:
+            parser.error(f"未知操作 {name}，可选：{', '.join(OPERATION_WEIGHTS)}")
+        weights[name] = float(weight) if weight else OPERATION_WEIGHTS[name]
+
+    users, medicines = load_fixtures(args.sample_users)
+    print(f"Load Test: {args.concurrency} workers, {args.duration}s, {len(users)} sampled cashiers, "
+          f"cache {'off' if args.no_cache else 'on'}")
+    latencies, errors, elapsed = run(make_operations(not args.no_cache), weights,
+                                     args.concurrency, args.duration, users, medicines)
+    report(latencies, errors, elapsed)
+    if args.metrics:
+        profiler.dump(args.metrics)
+
+if __name__ == "__main__":
+    main()
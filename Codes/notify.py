@@ -0,0 +1,239 @@
+import json
+import os
+import select
+import threading
+import time
+import uuid
+
+import psycopg2
+
+from config import DB_CONFIG, NOTIFY_CONFIG
+
+# 多进程部署时的缓存一致性：写操作在自己的事务里发布变更事件，事务提交时事件才对其他进程可见；
+# 每个进程的后台监听线程收到其他进程的事件后，按事件内容原地更新或精确失效本进程的缓存。
+# mode 为 "notify" 时使用 LISTEN/NOTIFY；数据库不支持 LISTEN/NOTIFY 时（如 openGauss）用 "poll"，
+# 事件写入 change_events 表，由监听线程定时轮询；"off" 表示单进程部署，不发布也不监听。
+# 默认的 "auto" 在本进程第一次发布或监听前用单独的连接探测一次，不支持时用 "poll"，写事务不会因 pg_notify 不可用而失败
+#
+# 事件格式：{"entity": "stock" | "inventory" | "user", "pharmacy_id": ..., "ids": [...], ...}
+#   stock      销售后库存变化，带 stocks: {medicine_id: 销售后库存}，
+#              以及 counters: {medicine_id: [销售计数, 最近销售时间]}
+#   inventory  药品目录变化（增删改药品、导入、删除药店），接收方失效该药店的缓存
+#   user       用户变化，带 usernames，接收方失效这些用户的登录缓存
+#   reset      监听连接断开重连后由本进程生成，期间可能漏掉事件，接收方清空全部缓存
+
+MODE = NOTIFY_CONFIG["mode"]
+CHANNEL = NOTIFY_CONFIG["channel"]
+
+_resolved_mode = None
+_mode_lock = threading.Lock()
+
+# 能执行 LISTEN 且有 pg_notify 函数时返回 "notify"，否则返回 "poll"；连接失败返回 None，下次再探测
+def _detect_mode():
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+    except psycopg2.Error:
+        return None
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM pg_proc WHERE proname = 'pg_notify'")
+            if cur.fetchone()[0] == 0:
+                return "poll"
+            cur.execute(f"LISTEN {CHANNEL}")
+            cur.execute(f"UNLISTEN {CHANNEL}")
+        return "notify"
+    except psycopg2.Error:
+        return "poll"
+    finally:
+        conn.close()
+
+# 实际使用的模式：MODE 为 "auto" 时取探测结果，探测结果在进程内缓存；暂时无法探测时按 "poll" 处理
+def mode():
+    global _resolved_mode
+    if MODE != "auto":
+        return MODE
+    if _resolved_mode is None:
+        with _mode_lock:
+            if _resolved_mode is None:
+                _resolved_mode = _detect_mode()
+    return _resolved_mode or "poll"
+
+# 本进程的标识，监听线程据此跳过自己发布的事件（本进程在提交后已直接更新过缓存）；
+# 带上进程号，fork 出的子进程不会与父进程混淆
+_TOKEN = uuid.uuid4().hex[:8]
+
+def origin():
+    return f"{os.getpid()}-{_TOKEN}"
+
+# NOTIFY 的载荷上限为 8000 字节，超出时退化为整个药店的目录失效
+MAX_PAYLOAD_BYTES = 7900
+
+def stock_event(pharmacy_id, stocks, counters=None):
+    event = {"entity": "stock", "pharmacy_id": pharmacy_id, "ids": list(stocks),
+             "stocks": {str(k): v for k, v in stocks.items()}}
+    if counters:
+        event["counters"] = {str(k): [count, last_sold_at.isoformat()] for k, (count, last_sold_at) in counters.items()}
+    return event
+
+def inventory_event(pharmacy_id, ids=None):
+    return {"entity": "inventory", "pharmacy_id": pharmacy_id, "ids": ids or []}
+
+def user_event(usernames):
+    return {"entity": "user", "usernames": list(usernames)}
+
+# 在调用方的事务中发布事件，随事务提交而送达，回滚则不会送达
+def publish(cur, event):
+    current = mode()
+    if current == "off":
+        return
+    payload = json.dumps(dict(event, origin=origin()), ensure_ascii=False)
+    if len(payload.encode()) > MAX_PAYLOAD_BYTES:
+        if event.get("entity") not in ("stock", "inventory"):
+            raise ValueError(f"变更事件过大：{len(payload)} 字节")
+        payload = json.dumps(dict(inventory_event(event["pharmacy_id"]), origin=origin()))
+    if current == "notify":
+        cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+    else:
+        cur.execute("INSERT INTO change_events (payload) VALUES (%s)", (payload,))
+
+
+class ChangeListener(threading.Thread):
+    def __init__(self, handler):
+        super().__init__(name="change-listener", daemon=True)
+        self.handler = handler
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {
+            "mode": mode(),
+            "connected": False,
+            "received": 0,
+            "applied": 0,
+            "skipped_own": 0,
+            "errors": 0,
+            "reconnects": 0,
+            "last_event_at": None,
+        }
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def stop(self):
+        self._stopping.set()
+
+    def _dispatch(self, payload):
+        self._count("received")
+        try:
+            event = json.loads(payload)
+            if event.get("origin") == origin():
+                self._count("skipped_own")
+                return
+            self.handler(event)
+            self._count("applied")
+            with self._lock:
+                self._stats["last_event_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        except Exception:
+            self._count("errors")
+
+    def run(self):
+        first = True
+        backoff = 1
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**DB_CONFIG)
+                conn.autocommit = True
+                current = mode()
+                with self._lock:
+                    self._stats["mode"] = current
+                if current == "notify":
+                    with conn.cursor() as cur:
+                        cur.execute(f"LISTEN {CHANNEL}")
+                    listen = self._listen
+                else:
+                    listen = self._poll
+                # 首次连接之前的变化已体现在数据库中；重连时断开期间的事件可能已丢失，只能整体清空缓存
+                if not first:
+                    self._count("reconnects")
+                    self.handler({"entity": "reset"})
+                first = False
+                backoff = 1
+                with self._lock:
+                    self._stats["connected"] = True
+                listen(conn)
+            except psycopg2.Error:
+                self._count("errors")
+            finally:
+                with self._lock:
+                    self._stats["connected"] = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            self._stopping.wait(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _listen(self, conn):
+        while not self._stopping.is_set():
+            if select.select([conn], [], [], 5) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                self._dispatch(conn.notifies.pop(0).payload)
+
+    # 轮询模式：event_id 由序列分配，不保证按提交顺序可见，因此每次除了读取更大的 event_id，
+    # 还回看最近 overlap 秒内写入的事件，用已处理过的 event_id 去重
+    def _poll(self, conn):
+        interval = NOTIFY_CONFIG["poll_interval"]
+        overlap = NOTIFY_CONFIG["poll_overlap"]
+        seen = {}
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(event_id), 0) FROM change_events")
+            last_id = cur.fetchone()[0]
+            last_prune = time.monotonic()
+            # 启动时数据库不可用、暂按 "poll" 处理的，探测出支持 LISTEN/NOTIFY 后退出轮询，重连后改为监听
+            while not self._stopping.is_set() and mode() == "poll":
+                cur.execute("""
+                    SELECT event_id, payload FROM change_events
+                    WHERE event_id > %s OR created_at >= clock_timestamp() - %s * INTERVAL '1 second'
+                    ORDER BY event_id
+                """, (last_id, overlap))
+                now = time.monotonic()
+                for event_id, payload in cur.fetchall():
+                    if event_id in seen:
+                        continue
+                    seen[event_id] = now
+                    last_id = max(last_id, event_id)
+                    self._dispatch(payload)
+                seen = {k: t for k, t in seen.items() if now - t < overlap * 2}
+                if now - last_prune > 60:
+                    cur.execute("DELETE FROM change_events WHERE created_at < clock_timestamp() - %s * INTERVAL '1 second'",
+                                (NOTIFY_CONFIG["retention_seconds"],))
+                    last_prune = now
+                self._stopping.wait(interval)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+# 每个进程只启动一个监听线程，重复调用直接返回已有的线程
+def start_listener(handler):
+    global _listener
+    if MODE == "off":
+        return None
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = ChangeListener(handler)
+            _listener.start()
+    return _listener
+
+def listener_stats():
+    if _listener is None:
+        return {"mode": mode(), "connected": False}
+    return _listener.stats()
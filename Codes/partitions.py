@@ -0,0 +1,258 @@
+import argparse
+import os
+import uuid
+from datetime import date
+
+import psycopg2
+import psycopg2.extensions
+
+from config import PARTITION_CONFIG
+from db import get_conn
+
+# sales 按 sale_time 做月度范围分区（见 init.py 迁移 6），分区名为 sales_yYYYYmMM。
+# 本模块负责提前创建未来月份的分区，并把超过保留期的分区归档为本地 Parquet 文件后移出数据库；
+# 归档文件登记在 sales_archive 表中，导出时按日期范围自动读取（见 export.py）。
+# 这里使用 PostgreSQL 的声明式分区语法（PARTITION OF、DEFAULT 分区、ATTACH/DETACH）。openGauss 等不支持的引擎上
+# 迁移 6 跳过，sales 保持为普通表，本模块的创建与归档都不做任何事，导出也不会读取归档
+
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), PARTITION_CONFIG["archive_dir"])
+
+# 归档文件的列，除销售记录本身外，还冗余保存药店、药品名称、生产商与销售员，药品或用户删除后归档仍可独立导出
+ARCHIVE_QUERY = """
+    SELECT s.sale_id, s.sale_time, m.pharmacy_id, s.medicine_id, m.name AS medicine_name, m.manufacturer,
+           s.quantity, s.unit_price, s.amount, s.user_id, u.username
+    FROM {table} s
+    LEFT JOIN medicines m ON m.medicine_id = s.medicine_id
+    LEFT JOIN users u ON u.user_id = s.user_id
+"""
+
+# 服务端游标每次取回并写成一个 row group 的行数
+CHUNK_ROWS = 50000
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month):
+    return f"sales_y{month.year:04d}m{month.month:02d}"
+
+def _values(row):
+    return tuple(row.values()) if isinstance(row, dict) else tuple(row)
+
+# 当前数据库能否建声明式分区表：在保存点内试建一个带默认分区的临时分区表，随即回滚
+def declarative_partitioning(cur):
+    cur.execute("SAVEPOINT partition_probe")
+    try:
+        cur.execute("CREATE TEMP TABLE partition_probe (d DATE) PARTITION BY RANGE (d)")
+        cur.execute("CREATE TEMP TABLE partition_probe_default PARTITION OF partition_probe DEFAULT")
+        supported = True
+    except psycopg2.Error:
+        supported = False
+    cur.execute("ROLLBACK TO SAVEPOINT partition_probe")
+    return supported
+
+# sales 是否已改建为分区表（迁移 6 已执行）
+def is_partitioned(cur):
+    cur.execute("SELECT relkind FROM pg_class WHERE relname = 'sales'")
+    row = cur.fetchone()
+    return row is not None and _values(row)[0] == "p"
+
+# 当前挂在 sales 下的分区：[(分区名, 月份)]，按月份排序
+def list_partitions(cur):
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'sales'
+        ORDER BY c.relname
+    """)
+    result = []
+    for (name,) in map(_values, cur.fetchall()):
+        if name.startswith("sales_y"):
+            result.append((name, date(int(name[7:11]), int(name[12:14]), 1)))
+    return result
+
+# 没有对应月份分区的销售（补录更早的历史、或未按时运行 init.py 创建未来月份时）落入默认分区，写入不会失败
+DEFAULT_PARTITION = "sales_default"
+
+def ensure_default_partition(cur):
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF sales DEFAULT")
+
+# 创建一个月份的分区。默认分区中已有该月的销售时，先把这些行移到新表再挂为分区：
+# 移动期间停用默认分区上的汇总触发器，移出、移入都不改变销售汇总表
+def create_partition(cur, month):
+    table, end = partition_name(month), add_months(month, 1)
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE sale_time >= %s AND sale_time < %s) AS pending",
+                (month, end))
+    if not _values(cur.fetchone())[0]:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table} PARTITION OF sales FOR VALUES FROM (%s) TO (%s)", (month, end))
+        return
+    cur.execute(f"CREATE TABLE {table} (LIKE sales INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"ALTER TABLE {DEFAULT_PARTITION} DISABLE TRIGGER sales_rollup")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE sale_time >= %s AND sale_time < %s RETURNING *
+        )
+        INSERT INTO {table} SELECT * FROM moved
+    """, (month, end))
+    cur.execute(f"ALTER TABLE {DEFAULT_PARTITION} ENABLE TRIGGER sales_rollup")
+    cur.execute(f"ALTER TABLE sales ATTACH PARTITION {table} FOR VALUES FROM (%s) TO (%s)", (month, end))
+
+# 确保默认分区以及从 first_month（为空时从已有的最后一个分区或本月）到本月之后 months_ahead 个月的分区都存在；
+# 已归档的月份不会重建。装载历史数据的脚本先以最早的销售日期调用，使历史月份各有分区而不是都落入默认分区。
+# sales 不是分区表时返回 0
+def ensure_partitions(cur, first_month=None, months_ahead=None):
+    if not is_partitioned(cur):
+        return 0
+    ensure_default_partition(cur)
+    if months_ahead is None:
+        months_ahead = PARTITION_CONFIG["months_ahead"]
+    this_month = month_start(date.today())
+    if first_month is None:
+        existing = list_partitions(cur)
+        first_month = existing[-1][1] if existing else this_month
+    month = min(month_start(first_month), this_month)
+    created = 0
+    while month <= add_months(this_month, months_ahead):
+        cur.execute("SELECT to_regclass(%s) IS NULL AS missing", (partition_name(month),))
+        if _values(cur.fetchone())[0]:
+            create_partition(cur, month)
+            created += 1
+        month = add_months(month, 1)
+    return created
+
+# 把一个月份的分区写成 Parquet 文件，核对行数后登记到 sales_archive，再从 sales 上摘下并删除该分区。
+# 直接删除分区不会触发行级触发器，销售汇总表中的历史数据保持不变；药品上的销售计数扣除移出的记录数，
+# 最近销售时间保留。各进程缓存中的计数在库存目录缓存过期后更新
+def archive_partition(conn, month):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = partition_name(month)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"{table}.parquet")
+    tmp_path = f"{path}.tmp"
+    schema = pa.schema([
+        ("sale_id", pa.int64()),
+        ("sale_time", pa.timestamp("us")),
+        ("pharmacy_id", pa.int32()),
+        ("medicine_id", pa.int32()),
+        ("medicine_name", pa.string()),
+        ("manufacturer", pa.string()),
+        ("quantity", pa.int32()),
+        ("unit_price", pa.decimal128(10, 2)),
+        ("amount", pa.decimal128(14, 2)),
+        ("user_id", pa.int32()),
+        ("username", pa.string()),
+    ])
+    rows = 0
+    with conn.cursor() as cur:
+        # 归档期间锁住该分区，阻止对这个月份的补录写入，保证文件与分区内容一致
+        cur.execute(f"LOCK TABLE {table} IN SHARE MODE")
+    with conn.cursor(name=f"archive_{uuid.uuid4().hex}", cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.itersize = CHUNK_ROWS
+        cur.execute(ARCHIVE_QUERY.format(table=table))
+        with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+            while True:
+                chunk = cur.fetchmany(CHUNK_ROWS)
+                if not chunk:
+                    break
+                columns = list(zip(*chunk))
+                writer.write_table(pa.table({name: columns[i] for i, name in enumerate(schema.names)}, schema=schema))
+                rows += len(chunk)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) AS n FROM {table}")
+        if _values(cur.fetchone())[0] != rows or pq.ParquetFile(tmp_path).metadata.num_rows != rows:
+            os.remove(tmp_path)
+            raise RuntimeError(f"归档 {table} 时行数不一致，已放弃")
+        os.replace(tmp_path, path)
+        # 先更新已有的登记行，没有时再插入（不使用 ON CONFLICT）；分区已上锁，同一月份不会被并发登记
+        entry = (os.path.relpath(path, ARCHIVE_DIR), rows, os.path.getsize(path), table)
+        cur.execute("""
+            UPDATE sales_archive SET path = %s, row_count = %s, file_bytes = %s, archived_at = CURRENT_TIMESTAMP
+            WHERE partition_name = %s
+        """, entry)
+        if cur.rowcount == 0:
+            cur.execute("""
+                INSERT INTO sales_archive (partition_name, range_start, range_end, path, row_count, file_bytes)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (table, month, add_months(month, 1)) + entry[:3])
+        cur.execute(f"""
+            UPDATE medicines m SET sales_count = m.sales_count - c.n
+            FROM (SELECT medicine_id, COUNT(*) AS n FROM {table} GROUP BY medicine_id) c
+            WHERE m.medicine_id = c.medicine_id
+        """)
+        cur.execute(f"ALTER TABLE sales DETACH PARTITION {table}")
+        cur.execute(f"DROP TABLE {table}")
+    conn.commit()
+    return rows, path
+
+# 早于保留期（不含本月在内往前 retention_months 个月）的分区逐个归档，每个分区单独提交
+def archive_old_partitions(retention_months=None, dry_run=False):
+    if retention_months is None:
+        retention_months = PARTITION_CONFIG["retention_months"]
+    cutoff = add_months(month_start(date.today()), -retention_months)
+    archived = []
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            candidates = [month for _, month in list_partitions(cur) if month < cutoff]
+        conn.commit()
+        for month in candidates:
+            if dry_run:
+                print(f"Would Archive {partition_name(month)}")
+                continue
+            rows, path = archive_partition(conn, month)
+            print(f"Archive {partition_name(month)} Success! {rows} rows -> {path}")
+            archived.append(month)
+    return archived
+
+# 与 [start, end) 有交集的归档：[{partition_name, range_start, range_end, path}]，按月份倒序；start/end 为空表示不设限
+def archives_for(conn, start=None, end=None):
+    with conn.cursor() as cur:
+        # sales_archive 随迁移 6 创建，sales 未分区时没有归档
+        if not is_partitioned(cur):
+            return []
+        cur.execute("""
+            SELECT partition_name, range_start, range_end, path FROM sales_archive
+            WHERE (%(start)s::timestamp IS NULL OR range_end > %(start)s)
+              AND (%(end)s::timestamp IS NULL OR range_start < %(end)s)
+            ORDER BY range_start DESC
+        """, {"start": start, "end": end})
+        return [dict(zip(("partition_name", "range_start", "range_end", "path"), _values(row)))
+                for row in cur.fetchall()]
+
+# 已归档月份的结束日期（最后一个归档分区的 range_end），之前的销售都已移出数据库；没有归档时为 None
+def archived_until(conn):
+    with conn.cursor() as cur:
+        if not is_partitioned(cur):
+            return None
+        cur.execute("SELECT MAX(range_end) AS range_end FROM sales_archive")
+        return _values(cur.fetchone())[0]
+
+def archive_path(archive):
+    return os.path.join(ARCHIVE_DIR, archive["path"])
+
+def main():
+    parser = argparse.ArgumentParser(description="销售分区维护：创建未来月份的分区，归档超过保留期的分区")
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_CONFIG["months_ahead"])
+    parser.add_argument("--archive", action="store_true", help="归档超过保留期的分区")
+    parser.add_argument("--retention-months", type=int, default=PARTITION_CONFIG["retention_months"])
+    parser.add_argument("--dry-run", action="store_true", help="只列出将要归档的分区")
+    args = parser.parse_args()
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            created = ensure_partitions(cur, months_ahead=args.months_ahead)
+    print(f"Ensure Partitions Success! {created} created")
+    if args.archive:
+        archived = archive_old_partitions(args.retention_months, args.dry_run)
+        print(f"Archive Success! {len(archived)} partitions archived")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import functools
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+from psycopg2.extras import RealDictCursor
+
+from config import PROFILER_CONFIG
+
+# 统一的性能埋点：连接池中的每个连接都使用 InstrumentedCursor，所有 SQL 执行都会按语句记录延迟分布、
+# 返回行数与出错次数；取连接的等待时间由连接池上报，页面各模块的渲染时间由 timed_section 装饰器记录。
+# 指标只保存在本进程内，可在管理员的"性能分析"页面查看，或用 snapshot()/dump() 导出为 JSON
+
+logger = logging.getLogger("pharmacy.slow_query")
+
+# 延迟直方图的桶上界（毫秒），最后一个桶收纳更慢的样本
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+
+# 按语句名分别统计的条目上限
+MAX_QUERY_NAMES = 1000
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    # 由直方图估算分位数：返回累计计数首次达到 q 的桶的上界（最后一个桶返回最大值）
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        target = self.count * q / 100
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= target:
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": {("+inf" if b == float("inf") else str(b)): n for b, n in zip(BUCKETS_MS, self.counts)},
+        }
+
+
+class QueryStats(Histogram):
+    def __init__(self, sql):
+        super().__init__()
+        self.sql = sql
+        self.rows = 0
+        self.errors = 0
+
+
+class Metrics:
+    def __init__(self, slow_query_ms, slow_log_size):
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self._queries = {}
+        self._sections = {}
+        self._pool_wait = Histogram()
+        self._slow = deque(maxlen=slow_log_size)
+        self._started = time.time()
+
+    def record_query(self, name, sql, ms, rows, params, error=False):
+        with self._lock:
+            stats = self._queries.get(name)
+            if stats is None:
+                # 动态拼接的语句过多时不再新建条目，统一计入 "other"
+                if len(self._queries) >= MAX_QUERY_NAMES:
+                    name = "other"
+                    stats = self._queries.get(name)
+                if stats is None:
+                    stats = self._queries[name] = QueryStats(normalize(sql))
+            stats.observe(ms)
+            if rows > 0:
+                stats.rows += rows
+            if error:
+                stats.errors += 1
+        if ms >= self.slow_query_ms:
+            entry = {
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "query": name,
+                "ms": round(ms, 3),
+                "rows": rows,
+                "sql": normalize(sql),
+                "params": redact(params),
+            }
+            with self._lock:
+                self._slow.append(entry)
+            logger.warning("slow query %s %.1fms rows=%s params=%s", name, ms, rows, entry["params"])
+
+    def record_section(self, name, ms):
+        with self._lock:
+            stats = self._sections.get(name)
+            if stats is None:
+                stats = self._sections[name] = Histogram()
+            stats.observe(ms)
+
+    def record_pool_wait(self, ms):
+        with self._lock:
+            self._pool_wait.observe(ms)
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self._sections.clear()
+            self._pool_wait = Histogram()
+            self._slow.clear()
+            self._started = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            queries = {name: dict(s.summary(), rows=s.rows, errors=s.errors, sql=s.sql)
+                       for name, s in self._queries.items()}
+            return {
+                "since": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._started)),
+                "slow_query_ms": self.slow_query_ms,
+                "queries": queries,
+                "sections": {name: s.summary() for name, s in self._sections.items()},
+                "pool_wait": self._pool_wait.summary(),
+                "slow_queries": list(self._slow),
+            }
+
+
+metrics = Metrics(PROFILER_CONFIG["slow_query_ms"], PROFILER_CONFIG["slow_log_size"])
+
+# 慢查询日志不记录参数值，只保留类型与长度，避免账号密码等敏感信息落入日志
+def redact(params):
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {k: redact(v) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        if len(params) > 10:
+            return f"<{type(params).__name__} len={len(params)}>"
+        return [redact(v) for v in params]
+    if isinstance(params, bool):
+        return params
+    if isinstance(params, (str, bytes)):
+        return f"<{type(params).__name__} len={len(params)}>"
+    return f"<{type(params).__name__}>"
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_VALUE_ROWS = re.compile(r"(\((?:\s*(?:\?|NULL)\s*(?:::\w+)?\s*,?)+\))(?:\s*,\s*\((?:\s*(?:\?|NULL)\s*(?:::\w+)?\s*,?)+\))+")
+# 首个表名；EXTRACT(HOUR FROM col) 之类括号内的 FROM 不算
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+([A-Za-z_][A-Za-z0-9_.]*)\b(?!\s*\))", re.IGNORECASE)
+_names = {}
+
+# 语句指纹：字面量替换为 ?，多行 VALUES 折叠为一行。execute_values 与 mogrify 会把参数值拼进语句文本，
+# 归一化后同一条语句的指纹不随参数变化，记录下来的语句文本中也不含参数值
+def normalize(sql):
+    text = _LITERAL.sub("?", _WHITESPACE.sub(" ", sql).strip())
+    return _VALUE_ROWS.sub(r"\1, ...", text)
+
+# 语句名：首个关键字 + 首个表名 + 语句文本的短哈希，如 "SELECT medicines#1a2b3c"；
+# 预备语句（见 statements.py）的 PREPARE / EXECUTE 以语句名命名，如 "EXECUTE login"。
+# 参数不参与命名，同一条语句无论参数如何都归入同一名下
+def query_name(sql):
+    name = _names.get(sql)
+    if name is None:
+        text = normalize(sql)
+        words = text.split(" ", 2) if text else ["?"]
+        verb = words[0].upper()
+        if verb in ("PREPARE", "EXECUTE") and len(words) > 1:
+            name = f"{verb} {words[1]}"
+        else:
+            table = _TABLE.search(text)
+            digest = hashlib.md5(text.encode()).hexdigest()[:6]
+            name = f"{verb} {table.group(1) if table else ''}#{digest}".replace(" #", "#")
+        if len(sql) < 4096 and len(_names) < 10000:
+            _names[sql] = name
+    return name
+
+
+class InstrumentedCursor(RealDictCursor):
+    def _timed(self, sql, params, run):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        begin = time.perf_counter()
+        error = False
+        try:
+            return run()
+        except Exception:
+            error = True
+            raise
+        finally:
+            ms = (time.perf_counter() - begin) * 1000
+            metrics.record_query(query_name(sql), sql, ms, self.rowcount, params, error)
+
+    def execute(self, query, vars=None):
+        return self._timed(query, vars, lambda: super(InstrumentedCursor, self).execute(query, vars))
+
+    def executemany(self, query, vars_list):
+        return self._timed(query, None, lambda: super(InstrumentedCursor, self).executemany(query, vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(sql, None, lambda: super(InstrumentedCursor, self).copy_expert(sql, file, size))
+
+# 记录页面模块的渲染时间：用于 app.py 中的各 *_section 函数
+def timed_section(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.record_section(name, (time.perf_counter() - begin) * 1000)
+        return wrapper
+    return decorator
+
+def snapshot():
+    return metrics.snapshot()
+
+def dump(path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f, ensure_ascii=False, indent=2, default=str)
@@ -0,0 +1,336 @@
+import argparse
+import io
+import json
+import time
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from config import REPLENISH_CONFIG
+from db import get_conn
+
+# 补货与调拨建议：从销售日汇总表 sales_daily 批量取出 (药品, 日期) 的销量，用 NumPy 向量化计算每个药品的
+# 销售速度（最近 velocity_days 天日均销量）、需求波动（最近 history_days 天每日销量的标准差）、补货点与补货目标，
+# 写入 replenishment_stats（见 init.py 迁移 12）；再结合实时库存，为同款药品（名称与生产商相同）
+# 在积压的药店与低于补货点的药店之间给出调拨建议，写入 replenishment_transfers。
+#   - 补货点 = 速度 × 到货天数 + 安全系数 × 标准差 × √到货天数；补货目标 = 补货点 + 速度 × 补货周期
+#   - 统计只计入完整的天（到昨天为止）。增量运行只读取新进入窗口与移出窗口的日期，对窗口累计值加减，
+#     数据量与窗口长度、药品总数无关；参数变化或距上次全量超过 full_rebuild_days 时全量重算
+#   - 可售天数、建议补货量依赖实时库存，在读取时结合库存计算（见 low_stock）
+#
+# 建议用 cron 定时运行 python replenish.py（如每小时），调拨建议随之按当时的库存刷新
+
+# 防止两个 replenish.py 同时运行的任意常量键
+RUN_LOCK_KEY = 20240612
+
+STAT_COLUMNS = ["medicine_id", "pharmacy_id", "short_qty", "long_qty", "long_sq",
+                "velocity", "demand_std", "reorder_point", "target_stock"]
+TRANSFER_COLUMNS = ["from_medicine_id", "from_pharmacy_id", "to_medicine_id", "to_pharmacy_id", "quantity"]
+
+# 窗口参数变化后累计值不再可用，必须全量重算；到货天数等只影响补货点，同样随全量重算一并更新
+def _params():
+    return json.dumps({k: REPLENISH_CONFIG[k] for k in
+                       ("velocity_days", "history_days", "lead_time_days", "review_days", "service_z")}, sort_keys=True)
+
+# 用 COPY 把查询结果以 CSV 读成 DataFrame，比逐行取回快一个数量级
+def _read_frame(cur, sql, params=None, **kwargs):
+    buf = io.StringIO()
+    cur.copy_expert(f"COPY ({cur.mogrify(sql, params).decode()}) TO STDOUT WITH (FORMAT csv, HEADER true)", buf)
+    buf.seek(0)
+    return pd.read_csv(buf, **kwargs)
+
+def _write_frame(cur, table, frame):
+    buf = io.StringIO()
+    frame.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+# 一批 (药品, 距 through 的天数 age, 销量) 对窗口累计值的增量；同一药品同一天的多行先合并为当天销量。
+# gap 为本次新计入的天数：age < gap 的日期新进入窗口，计正；age 落在 [窗口长度, 窗口长度 + gap) 的日期移出窗口，计负。
+# 全量重算相当于从空的统计开始、gap 取 history_days。返回 (药品ID 数组, {累计列: 增量数组})
+def window_deltas(medicine_ids, ages, quantities, gap,
+                  velocity_days=None, history_days=None):
+    velocity_days = velocity_days or REPLENISH_CONFIG["velocity_days"]
+    history_days = history_days or REPLENISH_CONFIG["history_days"]
+    # 按 (药品, 日期) 合并：对组合键 药品ID × 天数跨度 + age 排序一次，相同键的销量用 reduceat 相加，
+    # 比在数据库中 GROUP BY 快得多；内存与行数成正比，与药品数 × 天数无关
+    if len(ages) == 0:
+        return np.empty(0, np.int64), {c: np.empty(0) for c in ("short_qty", "long_qty", "long_sq")}
+    span = int(ages.max()) + 1
+    keys = medicine_ids.astype(np.int64) * span + ages
+    order = np.argsort(keys)
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    q = np.add.reduceat(quantities[order].astype(np.float64), starts)
+    cells = keys[starts]
+    medicine, ages = cells // span, cells % span
+    first = np.r_[True, medicine[1:] != medicine[:-1]]
+    ids, index = medicine[first], np.cumsum(first) - 1
+
+    entering = (ages < gap).astype(np.int8)
+    long_sign = entering - ((ages >= history_days) & (ages < history_days + gap))
+    short_sign = entering - ((ages >= velocity_days) & (ages < velocity_days + gap))
+    return ids, {
+        "short_qty": np.bincount(index, short_sign * q, len(ids)),
+        "long_qty": np.bincount(index, long_sign * q, len(ids)),
+        "long_sq": np.bincount(index, long_sign * q * q, len(ids)),
+    }
+
+# 由窗口累计值算出速度、波动、补货点与补货目标，原地添加到 frame
+def derive(frame):
+    velocity_days = REPLENISH_CONFIG["velocity_days"]
+    history_days = REPLENISH_CONFIG["history_days"]
+    lead_time = REPLENISH_CONFIG["lead_time_days"]
+    mean = frame["long_qty"].to_numpy() / history_days
+    variance = frame["long_sq"].to_numpy() / history_days - mean * mean
+    frame["velocity"] = frame["short_qty"].to_numpy() / velocity_days
+    frame["demand_std"] = np.sqrt(np.maximum(variance, 0))
+    frame["reorder_point"] = frame["velocity"] * lead_time + REPLENISH_CONFIG["service_z"] * frame["demand_std"] * np.sqrt(lead_time)
+    frame["target_stock"] = frame["reorder_point"] + frame["velocity"] * REPLENISH_CONFIG["review_days"]
+    return frame
+
+# 读取日期在任一 (起, 止] 区间内的汇总行 (药品, 药店, age, 销量)，同一天按销售员分开的多行留给 window_deltas 合并
+def _load_days(cur, through, ranges):
+    condition = " OR ".join("(bucket > %s AND bucket <= %s)" for _ in ranges)
+    params = [through] + [d for r in ranges for d in r]
+    return _read_frame(cur, f"""
+        SELECT medicine_id, pharmacy_id, %s - bucket AS age, quantity
+        FROM sales_daily WHERE {condition}
+    """, params, dtype={"medicine_id": np.int64, "pharmacy_id": np.int64, "age": np.int64, "quantity": np.int64})
+
+def _deltas_frame(days, gap):
+    ids, deltas = window_deltas(days["medicine_id"].to_numpy(), days["age"].to_numpy(),
+                                days["quantity"].to_numpy(), gap)
+    frame = pd.DataFrame(deltas, index=pd.Index(ids, name="medicine_id"))
+    frame["pharmacy_id"] = days.drop_duplicates("medicine_id").set_index("medicine_id")["pharmacy_id"].reindex(ids).to_numpy()
+    return frame
+
+# 全量重算：读取整个 history_days 窗口，替换全部统计行
+def _rebuild(cur, through):
+    days = _load_days(cur, through, [(through - timedelta(days=REPLENISH_CONFIG["history_days"]), through)])
+    frame = derive(_deltas_frame(days, REPLENISH_CONFIG["history_days"]).reset_index())
+    cur.execute("DELETE FROM replenishment_stats")
+    _write_frame(cur, "replenishment_stats", frame[STAT_COLUMNS])
+    return len(frame)
+
+# 增量更新：只读取 (last, through] 新进入窗口的日期与对应移出两个窗口的日期，叠加到已有的累计值上
+def _update(cur, last, through):
+    gap = (through - last).days
+    velocity_days = timedelta(days=REPLENISH_CONFIG["velocity_days"])
+    history_days = timedelta(days=REPLENISH_CONFIG["history_days"])
+    days = _load_days(cur, through, [(last, through), (last - velocity_days, through - velocity_days),
+                                     (last - history_days, through - history_days)])
+    if days.empty:
+        return 0
+    frame = _deltas_frame(days, gap)
+    cur.execute("""
+        SELECT medicine_id, short_qty, long_qty, long_sq FROM replenishment_stats WHERE medicine_id = ANY(%s)
+    """, (frame.index.tolist(),))
+    existing = pd.DataFrame(cur.fetchall(), columns=["medicine_id", "short_qty", "long_qty", "long_sq"])
+    existing = existing.set_index("medicine_id").reindex(frame.index, fill_value=0.0)
+    for column in ("short_qty", "long_qty", "long_sq"):
+        # 浮点加减后的极小负值归零
+        frame[column] = np.maximum(existing[column].to_numpy(dtype=np.float64) + frame[column].to_numpy(), 0)
+    frame = derive(frame.reset_index())
+
+    # 窗口内已没有销售的药品删除统计行，读取时按没有销售处理
+    empty = frame["long_qty"] < 1e-9
+    cur.execute("DELETE FROM replenishment_stats WHERE medicine_id = ANY(%s)",
+                (frame.loc[empty, "medicine_id"].tolist(),))
+    cur.execute("CREATE TEMP TABLE replenishment_stage (LIKE replenishment_stats) ON COMMIT DROP")
+    _write_frame(cur, "replenishment_stage", frame.loc[~empty, STAT_COLUMNS])
+    # 先更新已有的统计行，再插入新出现的药品（不使用 ON CONFLICT）；运行锁保证同时只有一次更新
+    cur.execute(f"""
+        UPDATE replenishment_stats r SET
+        {', '.join(f"{c} = s.{c}" for c in STAT_COLUMNS[1:])}
+        FROM replenishment_stage s
+        WHERE r.medicine_id = s.medicine_id
+    """)
+    cur.execute("""
+        INSERT INTO replenishment_stats SELECT * FROM replenishment_stage s
+        WHERE NOT EXISTS (SELECT 1 FROM replenishment_stats r WHERE r.medicine_id = s.medicine_id)
+    """)
+    return len(frame)
+
+# 全链在售药品的实时库存与补货统计，没有统计行的药品速度、补货点都为 0
+def load_chain(cur):
+    return _read_frame(cur, """
+        SELECT m.medicine_id, m.pharmacy_id, m.name, COALESCE(m.manufacturer, '') AS manufacturer,
+               COALESCE(m.stock, 0) AS stock, COALESCE(r.velocity, 0) AS velocity,
+               COALESCE(r.reorder_point, 0) AS reorder_point, COALESCE(r.target_stock, 0) AS target_stock
+        FROM medicines m
+        JOIN pharmacies p ON p.pharmacy_id = m.pharmacy_id AND p.deleted_at IS NULL
+        LEFT JOIN replenishment_stats r ON r.medicine_id = m.medicine_id
+        WHERE m.deleted_at IS NULL
+    """, dtype={"name": str, "manufacturer": str}, keep_default_na=False)
+
+# 调拨建议。库存不高于补货点的药品需要补到补货目标；库存超过 max(补货目标, 速度 × overstock_days) 的部分可以调出。
+# 同款药品内，调出方按可调出量、调入方按需求量从大到小排列，各自首尾相接排在一条数轴上，
+# 两组区间的重叠部分即调拨量（贪心匹配）。不同款式在数轴上分段错开，全部款式一次向量化完成
+def suggest_transfers(chain):
+    stock = chain["stock"].to_numpy(dtype=np.int64)
+    velocity = chain["velocity"].to_numpy(dtype=np.float64)
+    target = chain["target_stock"].to_numpy(dtype=np.float64)
+    need = np.where(stock <= chain["reorder_point"].to_numpy(), np.ceil(target - stock), 0).clip(0).astype(np.int64)
+    keep = np.maximum(target, velocity * REPLENISH_CONFIG["overstock_days"])
+    surplus = np.floor(stock - keep).clip(0).astype(np.int64)
+    product = pd.factorize(chain["name"] + "\x00" + chain["manufacturer"])[0]
+
+    both = np.intersect1d(product[surplus > 0], product[need > 0])
+    donors = np.flatnonzero((surplus > 0) & np.isin(product, both))
+    takers = np.flatnonzero((need > 0) & np.isin(product, both))
+    if len(donors) == 0:
+        return pd.DataFrame(columns=TRANSFER_COLUMNS)
+    donors = donors[np.lexsort((-surplus[donors], product[donors]))]
+    takers = takers[np.lexsort((-need[takers], product[takers]))]
+
+    # 每个款式在数轴上占 max(可调出总量, 需求总量) 的一段
+    groups = product.max() + 1
+    width = np.maximum(np.bincount(product[donors], surplus[donors], groups),
+                       np.bincount(product[takers], need[takers], groups)).astype(np.int64)
+    base = np.cumsum(width) - width
+
+    def intervals(rows, amount):
+        ends = base[product[rows]] + pd.Series(amount[rows]).groupby(product[rows]).cumsum().to_numpy()
+        return ends - amount[rows], ends
+
+    d_start, d_end = intervals(donors, surplus)
+    t_start, t_end = intervals(takers, need)
+    points = np.unique(np.concatenate([d_start, d_end, t_start, t_end]))
+    seg_start, seg_len = points[:-1], np.diff(points)
+    di = np.searchsorted(d_end, seg_start, side="right")
+    ti = np.searchsorted(t_end, seg_start, side="right")
+    valid = (di < len(donors)) & (ti < len(takers))
+    di, ti, seg_start, seg_len = di[valid], ti[valid], seg_start[valid], seg_len[valid]
+    valid = (d_start[di] <= seg_start) & (t_start[ti] <= seg_start)
+    di, ti, seg_len = di[valid], ti[valid], seg_len[valid]
+
+    medicine_id = chain["medicine_id"].to_numpy()
+    pharmacy_id = chain["pharmacy_id"].to_numpy()
+    transfers = pd.DataFrame({
+        "from_medicine_id": medicine_id[donors[di]],
+        "from_pharmacy_id": pharmacy_id[donors[di]],
+        "to_medicine_id": medicine_id[takers[ti]],
+        "to_pharmacy_id": pharmacy_id[takers[ti]],
+        "quantity": seg_len,
+    }).groupby(TRANSFER_COLUMNS[:4], as_index=False)["quantity"].sum()
+    transfers = transfers[(transfers["quantity"] >= REPLENISH_CONFIG["min_transfer"])
+                          & (transfers["from_pharmacy_id"] != transfers["to_pharmacy_id"])]
+    return transfers.sort_values("quantity", ascending=False, ignore_index=True)
+
+def last_run(cur):
+    cur.execute("""
+        SELECT run_id, full_rebuild, through, params, medicines, transfers, seconds, run_at,
+               (SELECT MAX(run_at) FROM replenishment_runs WHERE full_rebuild) AS full_at
+        FROM replenishment_runs ORDER BY run_id DESC LIMIT 1
+    """)
+    return cur.fetchone()
+
+# 运行一次：更新补货统计（到昨天为止），并按当前库存重算调拨建议。整个运行在一个事务中完成，
+# 读取方要么看到上一次、要么看到本次的完整结果。另一个运行正在进行时返回 None
+def run(full=False):
+    begin = time.perf_counter()
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked, CURRENT_DATE - 1 AS through", (RUN_LOCK_KEY,))
+            row = cur.fetchone()
+            if not row['locked']:
+                return None
+            through = row['through']
+            previous = last_run(cur)
+            full = (full or previous is None or previous['params'] != _params()
+                    or previous['full_at'] is None
+                    or (through - previous['full_at'].date()).days >= REPLENISH_CONFIG["full_rebuild_days"]
+                    or (through - previous['through']).days >= REPLENISH_CONFIG["history_days"])
+            if full:
+                medicines = _rebuild(cur, through)
+            elif through > previous['through']:
+                medicines = _update(cur, previous['through'], through)
+            else:
+                medicines = 0
+
+            transfers = suggest_transfers(load_chain(cur))
+            cur.execute("DELETE FROM replenishment_transfers")
+            _write_frame(cur, "replenishment_transfers", transfers[TRANSFER_COLUMNS])
+            seconds = time.perf_counter() - begin
+            cur.execute("""
+                INSERT INTO replenishment_runs (full_rebuild, through, params, medicines, transfers, seconds)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (full, through, _params(), medicines, len(transfers), seconds))
+    return {"full_rebuild": full, "through": through, "medicines": medicines,
+            "transfers": len(transfers), "seconds": seconds}
+
+# 本药店的补货统计：[{medicine_id, velocity, demand_std, reorder_point, target_stock}]
+def pharmacy_stats(cur, pharmacy_id):
+    cur.execute("""
+        SELECT medicine_id, velocity, demand_std, reorder_point, target_stock
+        FROM replenishment_stats WHERE pharmacy_id = %s
+    """, (pharmacy_id,))
+    return cur.fetchall()
+
+# 结合实时库存（get_medicines 的缓存行）给出低于补货点的药品，按可售天数升序：
+# 可售天数 = 库存 / 速度，建议补货量 = 补货目标 - 库存（向上取整）
+def low_stock(medicines, stats):
+    frame = pd.DataFrame(medicines, columns=["medicine_id", "name", "manufacturer", "code", "stock"])
+    stats = pd.DataFrame(stats, columns=["medicine_id", "velocity", "demand_std", "reorder_point", "target_stock"])
+    frame = frame.merge(stats, on="medicine_id", how="inner")
+    frame["stock"] = frame["stock"].fillna(0)
+    frame = frame[(frame["velocity"] > 0) & (frame["stock"] <= frame["reorder_point"])].copy()
+    frame["days_of_cover"] = (frame["stock"].clip(lower=0) / frame["velocity"]).round(1)
+    frame["order_qty"] = np.ceil(frame["target_stock"] - frame["stock"]).astype(int)
+    for column in ("velocity", "reorder_point", "target_stock"):
+        frame[column] = frame[column].astype(float).round(1)
+    return frame.sort_values(["days_of_cover", "order_qty"], ascending=[True, False], ignore_index=True)
+
+# 调拨建议，pharmacy_id 不为空时只列出调入或调出本药店的
+def list_transfers(cur, pharmacy_id=None, limit=500):
+    cur.execute("""
+        SELECT t.from_pharmacy_id, fp.name AS from_pharmacy, t.to_pharmacy_id, tp.name AS to_pharmacy,
+               m.name, m.manufacturer, t.quantity, t.from_medicine_id, t.to_medicine_id
+        FROM replenishment_transfers t
+        JOIN medicines m ON m.medicine_id = t.to_medicine_id
+        JOIN pharmacies fp ON fp.pharmacy_id = t.from_pharmacy_id
+        JOIN pharmacies tp ON tp.pharmacy_id = t.to_pharmacy_id
+        WHERE %(pharmacy_id)s::int IS NULL OR t.from_pharmacy_id = %(pharmacy_id)s OR t.to_pharmacy_id = %(pharmacy_id)s
+        ORDER BY t.quantity DESC LIMIT %(limit)s
+    """, {"pharmacy_id": pharmacy_id, "limit": limit})
+    return cur.fetchall()
+
+# 各药店低于补货点、已缺货的药品数与调入、调出建议数，供系统管理员查看全链情况
+def pharmacy_summary(cur):
+    cur.execute("""
+        SELECT p.pharmacy_id, p.name,
+               COUNT(m.medicine_id) AS medicines,
+               SUM(CASE WHEN r.velocity > 0 AND m.stock <= r.reorder_point THEN 1 ELSE 0 END) AS below_reorder,
+               SUM(CASE WHEN m.stock <= 0 THEN 1 ELSE 0 END) AS out_of_stock,
+               (SELECT COUNT(*) FROM replenishment_transfers t WHERE t.to_pharmacy_id = p.pharmacy_id) AS transfers_in,
+               (SELECT COUNT(*) FROM replenishment_transfers t WHERE t.from_pharmacy_id = p.pharmacy_id) AS transfers_out
+        FROM pharmacies p
+        LEFT JOIN medicines m ON m.pharmacy_id = p.pharmacy_id AND m.deleted_at IS NULL
+        LEFT JOIN replenishment_stats r ON r.medicine_id = m.medicine_id
+        WHERE p.deleted_at IS NULL
+        GROUP BY p.pharmacy_id, p.name
+        ORDER BY below_reorder DESC, p.pharmacy_id
+    """)
+    return cur.fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description="计算补货统计与跨店调拨建议")
+    parser.add_argument("--full", action="store_true", help="全量重算补货统计，不做增量更新")
+    parser.add_argument("--status", action="store_true", help="只显示最近一次运行")
+    args = parser.parse_args()
+    if args.status:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                print(dict(last_run(cur) or {}))
+        return
+    result = run(args.full)
+    if result is None:
+        print("Another Replenishment Run Is in Progress, Skip")
+        return
+    print(f"Replenishment Success! {'full' if result['full_rebuild'] else 'incremental'} through {result['through']}, "
+          f"{result['medicines']} medicines updated, {result['transfers']} transfers, {result['seconds']:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import argparse
+from datetime import date, timedelta
+
+from db import get_conn
+import statements
+
+# 销售汇总表（sales_daily / sales_hourly）由 init.py 中的 sales_rollup 触发器随销售记录的写入与删除增量维护；
+# 本模块负责从历史明细回填汇总表与药品上的销售计数，以及报表与销售记录面板对汇总表的查询
+
+ROLLUP_TABLES = {
+    "sales_daily": "s.sale_time::date",
+    "sales_hourly": "date_trunc('hour', s.sale_time)",
+}
+
+# 与 sales.TIME_RANGE_FILTERS 的时间范围一一对应，按天的桶足以精确表达
+ROLLUP_RANGE_FILTERS = {
+    "今日": "bucket >= CURRENT_DATE",
+    "最近7天": "bucket >= CURRENT_DATE - 6",
+    "最近30天": "bucket >= CURRENT_DATE - 29",
+    "全部": "TRUE",
+}
+
+# 时间范围在预备语句名中的写法（见 statements.py）
+RANGE_NAMES = {
+    "今日": "today",
+    "最近7天": "last7",
+    "最近30天": "last30",
+    "全部": "all",
+}
+
+# 用明细重算 [start, end) 日期范围内的汇总行，start/end 为空表示不设限。
+# 先以 EXCLUSIVE 锁住汇总表：进行中的销售事务（已写过汇总表）会先提交，之后的销售在触发器处等待本事务结束，
+# 因此重算结果与明细严格一致；锁只持有到调用方提交为止，大范围回填应按月分批提交
+def backfill(cursor, start=None, end=None):
+    cursor.execute("LOCK TABLE sales_daily, sales_hourly IN EXCLUSIVE MODE")
+    bucket_filter = "TRUE"
+    sale_filter = "TRUE"
+    params = {"start": start, "end": end}
+    if start is not None:
+        bucket_filter += " AND bucket >= %(start)s"
+        sale_filter += " AND s.sale_time >= %(start)s"
+    if end is not None:
+        bucket_filter += " AND bucket < %(end)s"
+        sale_filter += " AND s.sale_time < %(end)s"
+    for table, bucket in ROLLUP_TABLES.items():
+        cursor.execute(f"DELETE FROM {table} WHERE {bucket_filter}", params)
+        cursor.execute(f"""
+            INSERT INTO {table} (bucket, pharmacy_id, medicine_id, user_id, sale_count, quantity, amount)
+            SELECT {bucket}, m.pharmacy_id, s.medicine_id, COALESCE(s.user_id, 0),
+                   COUNT(*), SUM(s.quantity), SUM(s.amount)
+            FROM sales s
+            JOIN medicines m ON m.medicine_id = s.medicine_id
+            WHERE {sale_filter}
+            GROUP BY 1, 2, 3, 4
+        """, params)
+
+# 按月分批回填，每批单独提交，避免长时间持锁
+def backfill_range(start, end):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT MIN(sale_time)::date AS first, MAX(sale_time)::date AS last FROM sales")
+            bounds = cur.fetchone()
+    if bounds['first'] is None:
+        return 0
+    start = max(start or bounds['first'], bounds['first'])
+    end = min(end or bounds['last'] + timedelta(days=1), bounds['last'] + timedelta(days=1))
+    batches = 0
+    while start < end:
+        batch_end = min(date(start.year + start.month // 12, start.month % 12 + 1, 1), end)
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                backfill(cur, start, batch_end)
+        print(f"Backfill Sales Rollups {start} ~ {batch_end - timedelta(days=1)} Success!")
+        start = batch_end
+        batches += 1
+    return batches
+
+# 用明细一次分组重算药品上的销售计数（见 init.py 迁移 8），只改写与明细不一致的行；pharmacy_id 为空时重算全部药店。
+# 计数由销售语句在药品行上维护，先锁住药品表阻止并发销售，避免重算期间的销售被覆盖；
+# 已归档的记录不再计入 sales_count，last_sold_at 取明细与原值中较晚者，归档不会抹掉最近销售时间
+def backfill_medicine_counters(cursor, pharmacy_id=None):
+    cursor.execute("LOCK TABLE medicines IN SHARE ROW EXCLUSIVE MODE")
+    cursor.execute("""
+        UPDATE medicines m
+        SET sales_count = c.sales_count,
+            last_sold_at = GREATEST(m.last_sold_at, c.last_sold_at)
+        FROM (
+            SELECT m.medicine_id, COUNT(s.medicine_id) AS sales_count, MAX(s.sale_time) AS last_sold_at
+            FROM medicines m
+            LEFT JOIN sales s ON s.medicine_id = m.medicine_id
+            WHERE %(pharmacy_id)s::int IS NULL OR m.pharmacy_id = %(pharmacy_id)s
+            GROUP BY m.medicine_id
+        ) c
+        WHERE m.medicine_id = c.medicine_id
+          AND (m.sales_count <> c.sales_count OR c.last_sold_at > m.last_sold_at
+               OR (m.last_sold_at IS NULL AND c.last_sold_at IS NOT NULL))
+    """, {"pharmacy_id": pharmacy_id})
+    return cursor.rowcount
+
+# 销售记录面板的汇总指标：只读按天汇总表，查询量只与天数、药品种类有关。每个时间范围一条预备语句
+USER_TOTALS_STATEMENTS = {
+    time_range: statements.register(f"totals_{RANGE_NAMES[time_range]}", f"""
+        SELECT COALESCE(SUM(sale_count), 0)::BIGINT AS sale_count,
+               COALESCE(SUM(quantity), 0)::BIGINT AS total_quantity,
+               COALESCE(SUM(amount), 0) AS total_amount
+        FROM sales_daily
+        WHERE user_id = $1 AND {condition}
+    """)
+    for time_range, condition in ROLLUP_RANGE_FILTERS.items()
+}
+
+def user_totals(conn, user_id, time_range):
+    with conn.cursor() as cur:
+        statements.execute(cur, USER_TOTALS_STATEMENTS[time_range], (user_id,))
+        return cur.fetchone()
+
+# 自 start 起的汇总指标，"全部"范围在有归档时只统计未归档的月份（见 sales.history_totals）
+def user_totals_since(conn, user_id, start):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT COALESCE(SUM(sale_count), 0)::BIGINT AS sale_count,
+                   COALESCE(SUM(quantity), 0)::BIGINT AS total_quantity,
+                   COALESCE(SUM(amount), 0) AS total_amount
+            FROM sales_daily
+            WHERE user_id = %s AND bucket >= %s
+        """, (user_id, start))
+        return cur.fetchone()
+
+def _report_filter(start, end, pharmacy_id):
+    where = "bucket >= %(start)s AND bucket < %(end)s"
+    if pharmacy_id:
+        where += " AND pharmacy_id = %(pharmacy_id)s"
+    return where, {"start": start, "end": end, "pharmacy_id": pharmacy_id}
+
+# 链级报表：日期范围 [start, end)，pharmacy_id 为空表示全部药店
+def revenue_by_day(conn, start, end, pharmacy_id=None):
+    where, params = _report_filter(start, end, pharmacy_id)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT bucket AS day, SUM(sale_count) AS sale_count, SUM(quantity) AS quantity, SUM(amount) AS amount
+            FROM sales_daily WHERE {where}
+            GROUP BY bucket ORDER BY bucket
+        """, params)
+        return cur.fetchall()
+
+def revenue_by_pharmacy(conn, start, end, limit=20):
+    where, params = _report_filter(start, end, None)
+    params["limit"] = limit
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT r.pharmacy_id, p.name, SUM(r.sale_count) AS sale_count,
+                   SUM(r.quantity) AS quantity, SUM(r.amount) AS amount
+            FROM sales_daily r
+            LEFT JOIN pharmacies p ON p.pharmacy_id = r.pharmacy_id
+            WHERE {where}
+            GROUP BY r.pharmacy_id, p.name
+            ORDER BY amount DESC LIMIT %(limit)s
+        """, params)
+        return cur.fetchall()
+
+def top_medicines(conn, start, end, pharmacy_id=None, limit=20):
+    where, params = _report_filter(start, end, pharmacy_id)
+    params["limit"] = limit
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT t.medicine_id, m.name, m.manufacturer, t.quantity, t.amount
+            FROM (
+                SELECT medicine_id, SUM(quantity) AS quantity, SUM(amount) AS amount
+                FROM sales_daily WHERE {where}
+                GROUP BY medicine_id ORDER BY amount DESC LIMIT %(limit)s
+            ) t
+            LEFT JOIN medicines m ON m.medicine_id = t.medicine_id
+            ORDER BY t.amount DESC
+        """, params)
+        return cur.fetchall()
+
+# 一天中各小时的销售分布，读按小时汇总表
+def sales_by_hour(conn, start, end, pharmacy_id=None):
+    where, params = _report_filter(start, end, pharmacy_id)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT EXTRACT(HOUR FROM bucket)::INT AS hour, SUM(sale_count) AS sale_count, SUM(amount) AS amount
+            FROM sales_hourly WHERE {where}
+            GROUP BY 1 ORDER BY 1
+        """, params)
+        return cur.fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description="从销售明细回填销售汇总表")
+    parser.add_argument("--from", dest="start", type=date.fromisoformat, help="起始日期（含）")
+    parser.add_argument("--to", dest="end", type=date.fromisoformat, help="结束日期（含）")
+    parser.add_argument("--medicine-counters", action="store_true", help="只重算药品上的销售计数")
+    args = parser.parse_args()
+    if args.medicine_counters:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                updated = backfill_medicine_counters(cur)
+        print(f"Backfill Medicine Sales Counters Success! {updated} medicines updated")
+        return
+    end = args.end + timedelta(days=1) if args.end else None
+    batches = backfill_range(args.start, end)
+    print(f"Backfill Success! {batches} batches")
+
+if __name__ == "__main__":
+    main()
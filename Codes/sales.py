@@ -0,0 +1,145 @@
+from psycopg2.extras import execute_values
+
+import partitions
+import rollups
+import statements
+
+# 单条语句完成"校验库存 + 扣减库存 + 写入销售记录"：
+# 库存不足（或药品已下架）时 UPDATE 不命中任何行，INSERT 的 SELECT 也就为空，整条语句什么都不写；
+# 行锁由 UPDATE 在服务端获取，并发销售同一药品时不会超卖；单价与金额取自同一行，在销售时固定下来。
+# 药品上的销售计数在同一次 UPDATE 中累加，不额外写药品行；CURRENT_TIMESTAMP 为事务开始时间，与 sale_time 的默认值相同。
+# 参数：$1 medicine_id，$2 quantity，$3 user_id
+SELL = statements.register("sell", """
+    WITH upd AS (
+        UPDATE medicines
+        SET stock = stock - $2, sales_count = sales_count + 1, last_sold_at = CURRENT_TIMESTAMP
+        WHERE medicine_id = $1 AND stock >= $2 AND deleted_at IS NULL
+        RETURNING medicine_id, pharmacy_id, stock, price, sales_count, last_sold_at
+    ), ins AS (
+        INSERT INTO sales (medicine_id, quantity, user_id, unit_price, amount)
+        SELECT medicine_id, $2, $3, price, $2 * price FROM upd
+        RETURNING sale_id, sale_time
+    )
+    SELECT ins.sale_id, ins.sale_time, upd.medicine_id, upd.pharmacy_id, upd.stock, upd.sales_count, upd.last_sold_at
+    FROM upd, ins
+""")
+
+# 在给定连接上执行一次销售，成功返回 {sale_id, sale_time, medicine_id, pharmacy_id, stock, sales_count, last_sold_at}
+# （均为销售后的值），库存不足或药品不存在返回 None；提交由调用方负责
+def sell(conn, medicine_id, quantity, user_id):
+    if quantity <= 0:
+        return None
+    with conn.cursor() as cur:
+        statements.execute(cur, SELL, (medicine_id, quantity, user_id))
+        return cur.fetchone()
+
+class InsufficientStock(Exception):
+    def __init__(self, medicine_ids):
+        super().__init__(f"库存不足或药品不存在：{sorted(medicine_ids)}")
+        self.medicine_ids = medicine_ids
+
+# 先按 medicine_id 顺序锁定全部行，避免两个购物车交叉锁行导致死锁，再一次性扣减所有行的库存；
+# 合并后每个药品写入一条销售记录，销售计数加一
+CHECKOUT_UPDATE_SQL = """
+    WITH locked AS (
+        SELECT medicine_id FROM medicines
+        WHERE medicine_id = ANY(%s)
+        ORDER BY medicine_id
+        FOR UPDATE
+    )
+    UPDATE medicines m
+    SET stock = m.stock - v.quantity, sales_count = m.sales_count + 1, last_sold_at = CURRENT_TIMESTAMP
+    FROM (VALUES %%s) AS v(medicine_id, quantity), locked l
+    WHERE m.medicine_id = v.medicine_id AND l.medicine_id = m.medicine_id
+      AND m.stock >= v.quantity AND m.deleted_at IS NULL
+    RETURNING m.medicine_id, m.pharmacy_id, m.stock, m.price, m.sales_count, m.last_sold_at
+"""
+
+# 购物车结算：lines 为 [(medicine_id, quantity), ...]，同一药品的多行会被合并；
+# 在同一事务里扣减全部库存并批量写入销售记录，任一行库存不足即抛出 InsufficientStock，
+# 由调用方回滚整个事务，不会留下部分写入。成功返回 {medicine_id: {medicine_id, pharmacy_id, stock, price, sales_count, last_sold_at}}，均为销售后的值
+def checkout(conn, lines, user_id):
+    merged = {}
+    for medicine_id, quantity in lines:
+        if quantity <= 0:
+            continue
+        merged[medicine_id] = merged.get(medicine_id, 0) + quantity
+    if not merged:
+        return {}
+
+    with conn.cursor() as cur:
+        updated = execute_values(
+            cur,
+            cur.mogrify(CHECKOUT_UPDATE_SQL, (list(merged),)).decode(),
+            list(merged.items()),
+            page_size=len(merged),
+            fetch=True,
+        )
+        result = {row['medicine_id']: row for row in updated}
+        missing = set(merged) - set(result)
+        if missing:
+            raise InsufficientStock(missing)
+
+        execute_values(
+            cur,
+            "INSERT INTO sales (medicine_id, quantity, user_id, unit_price, amount) VALUES %s",
+            [(medicine_id, quantity, user_id, result[medicine_id]['price'], quantity * result[medicine_id]['price'])
+             for medicine_id, quantity in merged.items()],
+            page_size=len(merged),
+        )
+    return result
+
+# 销售记录的时间范围过滤条件，只允许从这里取值拼接 SQL
+TIME_RANGE_FILTERS = {
+    "今日": "s.sale_time >= CURRENT_DATE",
+    "最近7天": "s.sale_time >= CURRENT_DATE - INTERVAL '6 days'",
+    "最近30天": "s.sale_time >= CURRENT_DATE - INTERVAL '29 days'",
+    "全部": "TRUE",
+}
+
+# 每页销售记录条数，也是每个会话在内存中持有的记录上限
+HISTORY_PAGE_SIZE = 50
+
+HISTORY_SQL = """
+    SELECT s.sale_id, s.sale_time,
+           to_char(s.sale_time, 'YYYY-MM-DD HH24:MI:SS') AS sale_time_text,
+           m.name AS medicine_name, m.manufacturer, s.quantity,
+           s.unit_price AS price, s.amount AS total_amount
+    FROM sales s
+    JOIN medicines m ON s.medicine_id = m.medicine_id
+    WHERE s.user_id = $1 AND {condition}
+    ORDER BY s.sale_time DESC, s.sale_id DESC LIMIT $2
+"""
+
+# 每个时间范围登记首页与翻页两条预备语句，{时间范围: (首页, 翻页)}；翻页语句的 $3、$4 为上一页最后一行的 (sale_time, sale_id)
+HISTORY_STATEMENTS = {
+    time_range: (
+        statements.register(f"history_{rollups.RANGE_NAMES[time_range]}",
+                            HISTORY_SQL.format(condition=condition)),
+        statements.register(f"history_{rollups.RANGE_NAMES[time_range]}_after",
+                            HISTORY_SQL.format(condition=f"{condition} AND (s.sale_time, s.sale_id) < ($3, $4)")),
+    )
+    for time_range, condition in TIME_RANGE_FILTERS.items()
+}
+
+# 按 (sale_time, sale_id) 倒序做键集分页：after 为上一页最后一行的 (sale_time, sale_id)，
+# 翻页代价只与页大小有关，与历史总量无关。返回 (本页记录, 是否还有下一页)
+def history_page(conn, user_id, time_range, after=None, limit=HISTORY_PAGE_SIZE):
+    first, following = HISTORY_STATEMENTS[time_range]
+    # 多取一行用于判断是否还有下一页
+    with conn.cursor() as cur:
+        if after is None:
+            statements.execute(cur, first, (user_id, limit + 1))
+        else:
+            statements.execute(cur, following, (user_id, limit + 1, *after))
+        rows = cur.fetchall()
+    return rows[:limit], len(rows) > limit
+
+# 汇总指标读销售汇总表（见 rollups.py），不随销售明细的增长而变慢。汇总表保留已归档月份的销售，
+# "全部"只统计最后一个归档月份之后的部分，与下方能翻到的记录一致；其他时间范围总在保留期内
+def history_totals(conn, user_id, time_range):
+    if time_range == "全部":
+        start = partitions.archived_until(conn)
+        if start is not None:
+            return rollups.user_totals_since(conn, user_id, start)
+    return rollups.user_totals(conn, user_id, time_range)
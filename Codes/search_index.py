@@ -0,0 +1,130 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# 药店库存的进程内搜索索引：对名称/生产商/编码及名称、生产商的拼音首字母建立一元与二元 n-gram 倒排表，
+# 收银员边输边搜时直接在内存中求交集，不访问数据库。索引中的行与库存缓存中的行是同一批对象，
+# 销售后只需原地更新库存数量，不需要重建索引
+
+try:
+    from pypinyin import Style, lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+# GB2312 一级汉字按拼音排序，可由区位码直接得出首字母：(该字母第一个汉字的编码, 字母)
+_GB2312_INITIALS = [
+    (-20319, "a"), (-20283, "b"), (-19775, "c"), (-19218, "d"), (-18710, "e"), (-18526, "f"),
+    (-18239, "g"), (-17922, "h"), (-17417, "j"), (-16474, "k"), (-16212, "l"), (-15640, "m"),
+    (-15165, "n"), (-14922, "o"), (-14914, "p"), (-14630, "q"), (-14149, "r"), (-14090, "s"),
+    (-13318, "t"), (-12838, "w"), (-12556, "x"), (-11847, "y"), (-11055, "z"),
+]
+_GB2312_KEYS = [code for code, _ in _GB2312_INITIALS]
+_GB2312_LEVEL1_END = -10247
+
+# 药名中常见、但不在 GB2312 一级字库中的汉字
+_EXTRA_INITIALS = {
+    "藿": "h", "孢": "b", "肟": "w", "噻": "s", "唑": "z", "吲": "y", "哚": "d", "嗪": "q", "啶": "d",
+    "呋": "f", "喹": "k", "萘": "n", "羟": "q", "酯": "z", "苷": "g", "芪": "q", "苄": "b", "胍": "g",
+    "脲": "n", "铵": "a", "缬": "x", "哌": "p", "咪": "m", "嘧": "m", "吡": "b", "莨": "l", "菪": "d",
+    "茴": "h", "芎": "x", "蒡": "b", "芩": "q", "栀": "z", "苓": "l", "蚧": "j",
+}
+
+def _char_initial(ch):
+    if ch in _EXTRA_INITIALS:
+        return _EXTRA_INITIALS[ch]
+    try:
+        encoded = ch.encode("gb2312")
+    except UnicodeEncodeError:
+        return ch.lower()
+    if len(encoded) != 2:
+        return ch.lower()
+    code = encoded[0] * 256 + encoded[1] - 65536
+    if code < _GB2312_KEYS[0] or code > _GB2312_LEVEL1_END:
+        return ch
+    return _GB2312_INITIALS[bisect.bisect_right(_GB2312_KEYS, code) - 1][1]
+
+# 汉字转拼音首字母，其他字符原样转小写，如 "板蓝根颗粒" -> "blgkl"；安装了 pypinyin 时使用其完整字库
+def pinyin_initials(text):
+    if lazy_pinyin is not None:
+        return "".join(lazy_pinyin(text, style=Style.FIRST_LETTER, errors=lambda s: s)).lower()
+    return "".join(_char_initial(ch) for ch in text)
+
+def _grams(text):
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+class InventoryIndex:
+    def __init__(self, medicines):
+        self.source = medicines
+        self.rows = {}
+        self.by_code = {}
+        self._texts = {}
+        self._postings = defaultdict(set)
+        for row in medicines:
+            self._add(row)
+
+    def _add(self, row):
+        medicine_id = row['medicine_id']
+        name = (row['name'] or "").lower()
+        manufacturer = (row['manufacturer'] or "").lower()
+        fields = [name, manufacturer, (row['code'] or "").lower(),
+                  pinyin_initials(name), pinyin_initials(manufacturer)]
+        self.rows[medicine_id] = row
+        if row['code']:
+            self.by_code[row['code']] = row
+        self._texts[medicine_id] = fields
+        for field in fields:
+            for gram in _grams(field):
+                self._postings[gram].add(medicine_id)
+
+    def update_stock(self, medicine_id, stock):
+        row = self.rows.get(medicine_id)
+        if row is not None:
+            row['stock'] = stock
+
+    # 先用关键字的 n-gram 倒排表求交集得到候选，再逐个做子串校验，结果与 ILIKE '%kw%' 一致（另外支持拼音首字母）
+    def search(self, keyword):
+        keyword = keyword.strip().lower()
+        if not keyword:
+            return []
+        grams = [keyword] if len(keyword) == 1 else [keyword[i:i + 2] for i in range(len(keyword) - 1)]
+        postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return [self.rows[mid] for mid in sorted(candidates)
+                if any(keyword in field for field in self._texts[mid])]
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+# 用药店的库存目录建立索引；目录对象未变化时直接复用（库存缓存过期重新加载后才会重建）
+def ensure_index(pharmacy_id, medicines):
+    index = _indexes.get(pharmacy_id)
+    if index is None or index.source is not medicines:
+        index = InventoryIndex(medicines)
+        with _lock:
+            _indexes[pharmacy_id] = index
+    return index
+
+# 索引未建立（冷启动）时返回 None，调用方应回退到数据库查询
+def search(pharmacy_id, keyword):
+    index = _indexes.get(pharmacy_id)
+    if index is None:
+        return None
+    return index.search(keyword)
+
+def update_stock(pharmacy_id, stocks):
+    index = _indexes.get(pharmacy_id)
+    if index is not None:
+        for medicine_id, stock in stocks.items():
+            index.update_stock(medicine_id, stock)
+
+# 药品的名称、编码等发生变化或被删除时丢弃整个药店的索引，下次加载目录时重建
+def discard(pharmacy_id):
+    with _lock:
+        _indexes.pop(pharmacy_id, None)
+
+def clear():
+    with _lock:
+        _indexes.clear()
@@ -0,0 +1,109 @@
+import re
+import threading
+import time
+import weakref
+
+from config import STATEMENT_CONFIG
+
+# 命名预备语句注册表：热点查询（登录、库存、搜索、销售、销售记录分页与汇总等）在各自模块中用 register 登记一次，
+# 执行时通过 execute 按名称调用。每个连接第一次用到某条语句时发送 PREPARE，之后只发送 EXECUTE 名称与参数，
+# 服务端不再重复解析与生成执行计划（前几次执行按参数生成计划，之后通常改用通用计划，见 bench_prepare.py）。
+#   - 语句文本用 $1、$2 ... 表示参数，同一参数可以出现多次
+#   - 预备语句属于数据库会话，不随事务回滚消失；连接池重建连接后，新连接在首次使用时重新 PREPARE
+#   - STATEMENT_CONFIG["prepare"] 为 False 时（如经过事务级连接池中间件）退回每次发送完整语句文本
+#   - 每条语句的 PREPARE 次数、执行次数与耗时在管理员的"性能分析"页面查看
+
+_PARAM = re.compile(r"\$(\d+)")
+
+
+class Statement:
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.param_count = max((int(n) for n in _PARAM.findall(sql)), default=0)
+        self.execute_sql = f"EXECUTE {name}" + (f" ({', '.join(['%s'] * self.param_count)})" if self.param_count else "")
+        # 不预备时直接发送的文本：$n 换成按位置取值的命名占位符，语句中原有的 % 转义
+        self.text_sql = _PARAM.sub(r"%(\1)s", sql.replace("%", "%%"))
+        self.prepares = 0
+        self.executions = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+
+_registry = {}
+_lock = threading.Lock()
+# 连接 -> 已在该连接上 PREPARE 的语句名；连接关闭并被回收后条目随之消失
+_prepared = weakref.WeakKeyDictionary()
+
+# 登记一条语句，返回语句名；同名语句只能登记一次，名称须是合法的 SQL 标识符
+def register(name, sql):
+    if not name.isidentifier():
+        raise ValueError(f"语句名不是合法的标识符：{name}")
+    with _lock:
+        if name in _registry:
+            raise ValueError(f"语句已登记：{name}")
+        _registry[name] = Statement(name, sql)
+    return name
+
+def _ensure_prepared(cur, statement):
+    conn = cur.connection
+    with _lock:
+        prepared = _prepared.setdefault(conn, set())
+    if statement.name in prepared:
+        return
+    cur.execute(f"PREPARE {statement.name} AS {statement.sql}")
+    prepared.add(statement.name)
+    with _lock:
+        statement.prepares += 1
+
+# 在游标上按名称执行语句，params 按 $1、$2 ... 的顺序给出；结果照常用 cur.fetchone()/fetchall() 取回
+def execute(cur, name, params=(), prepare=None):
+    statement = _registry[name]
+    if len(params) != statement.param_count:
+        raise ValueError(f"语句 {name} 需要 {statement.param_count} 个参数，传入了 {len(params)} 个")
+    if prepare is None:
+        prepare = STATEMENT_CONFIG["prepare"]
+    begin = time.perf_counter()
+    error = False
+    try:
+        if prepare:
+            _ensure_prepared(cur, statement)
+            cur.execute(statement.execute_sql, tuple(params))
+        else:
+            cur.execute(statement.text_sql, {str(i + 1): v for i, v in enumerate(params)})
+    except Exception:
+        error = True
+        raise
+    finally:
+        ms = (time.perf_counter() - begin) * 1000
+        with _lock:
+            statement.executions += 1
+            statement.total_ms += ms
+            statement.max_ms = max(statement.max_ms, ms)
+            if error:
+                statement.errors += 1
+
+def registered():
+    return dict(_registry)
+
+# 每条语句的 PREPARE 次数（约等于用过它的连接数）、执行次数与耗时，供性能分析页面展示
+def stats():
+    with _lock:
+        return {
+            name: {
+                "prepares": s.prepares,
+                "executions": s.executions,
+                "errors": s.errors,
+                "avg_ms": round(s.total_ms / s.executions, 3) if s.executions else 0.0,
+                "max_ms": round(s.max_ms, 3),
+                "total_ms": round(s.total_ms, 3),
+            }
+            for name, s in _registry.items()
+        }
+
+def reset_stats():
+    with _lock:
+        for s in _registry.values():
+            s.prepares = s.executions = s.errors = 0
+            s.total_ms = s.max_ms = 0.0